@@ -0,0 +1,80 @@
+"""
+Compares the Flask app under gunicorn (one gthread worker with 32 threads)
+with the ASGI app under uvicorn (one process) when many slow clients
+upload at the same time. Every client uploads an object of `--chunks`
+chunks of 64 KiB and waits `--delay` seconds after each chunk, like a CI
+job on a slow link.
+
+    $ python benchmarks/bench_asgi.py --clients 32 128
+"""
+
+import argparse
+import asyncio
+import base64
+import time
+
+import common
+
+CHUNK_SIZE = 64 * 1024
+AUTHORIZATION = 'Basic ' + base64.b64encode(b'root:alpine').decode()
+
+
+async def upload(port, path, chunks, delay):
+  reader, writer = await asyncio.open_connection('127.0.0.1', port)
+  writer.write((
+    'PUT /api/location/{} HTTP/1.1\r\n'
+    'Host: localhost\r\n'
+    'Authorization: {}\r\n'
+    'Content-Type: application/vnd.fatartifacts+putobject\r\n'
+    'X-Metadata-Length: 2\r\n'
+    'X-File-Name: file.bin\r\n'
+    'X-File-ContentType: application/octet-stream\r\n'
+    'Content-Length: {}\r\n'
+    'Connection: close\r\n\r\n{{}}').format(path, AUTHORIZATION, 2 + chunks * CHUNK_SIZE).encode())
+  chunk = b'x' * CHUNK_SIZE
+  for _ in range(chunks):
+    writer.write(chunk)
+    await writer.drain()
+    await asyncio.sleep(delay)
+  response = await reader.read()
+  writer.close()
+  return b'"Created"' in response
+
+
+async def run_clients(port, prefix, clients, chunks, delay):
+  start = time.perf_counter()
+  results = await asyncio.gather(*[
+    upload(port, '{}{}'.format(prefix, i), chunks, delay) for i in range(clients)])
+  return sum(results), time.perf_counter() - start
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--clients', type=int, nargs='+', default=[32, 128])
+  parser.add_argument('--chunks', type=int, default=128)
+  parser.add_argument('--delay', type=float, default=0.008)
+  parser.add_argument('--port', type=int, default=8902)
+  args = parser.parse_args()
+
+  config = common.make_config()
+  client = common.make_flask_app(config).test_client()
+  common.create_locations(client, 'root', 'root:a', 'root:a:1')
+  bind = '127.0.0.1:{}'.format(args.port)
+  servers = [
+    ('flask', ['gunicorn', '-w', '1', '-k', 'gthread', '--threads', '32', '-b', bind,
+               '--log-level', 'warning', 'benchapp:app']),
+    ('asgi', ['uvicorn', '--port', str(args.port), '--log-level', 'warning',
+              'benchapp:asgi_app']),
+  ]
+
+  print('clients  server  ok        duration')
+  for clients in args.clients:
+    for name, command in servers:
+      with common.run_server(command, args.port, config.directory):
+        prefix = 'root:a:1:{}-{}-'.format(name, clients)
+        ok, seconds = asyncio.run(run_clients(args.port, prefix, clients, args.chunks, args.delay))
+      print('{:7}  {:6}  {:>8}  {:6.2f} s'.format(clients, name, '{}/{}'.format(ok, clients), seconds))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,61 @@
+"""
+Compares the download modes of `GET /read/<location>` under gunicorn (one
+sync worker): the file copied through Python (`--no-sendfile`), the file
+passed to `wsgi.file_wrapper` (gunicorn uses sendfile()), and the
+`x-accel-redirect` offload, where the app only sends a header (without a
+frontend server, this measures the app's share of the request). The client
+is curl.
+
+    $ python benchmarks/bench_download.py --size 512
+"""
+
+import argparse
+import os
+import subprocess
+
+import common
+
+MODES = [
+  ('python copy', ['--no-sendfile'], None),
+  ('sendfile', [], None),
+  ('x-accel-redirect', [], 'x-accel-redirect'),
+]
+
+
+def download(url):
+  output = subprocess.check_output(['curl', '-s', '-o', os.devnull, '-u', 'root:alpine',
+    '-D', '-', '-w', '%{http_code} %{size_download} %{time_total}', url])
+  headers, _, summary = output.decode().rpartition('\r\n\r\n')
+  status, size, seconds = summary.split()
+  assert status == '200', output
+  return int(size), float(seconds), 'X-Accel-Redirect' in headers
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--size', type=int, default=256, help='file size in MiB')
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--port', type=int, default=8901)
+  args = parser.parse_args()
+
+  config = common.make_config()
+  client = common.make_flask_app(config).test_client()
+  common.create_locations(client, 'root', 'root:a', 'root:a:1')
+  common.put_object(client, 'root:a:1:big', os.urandom(args.size * 1024 * 1024))
+  url = 'http://127.0.0.1:{}/api/read/root:a:1:big'.format(args.port)
+
+  for name, options, offload in MODES:
+    command = ['gunicorn', '-w', '1', '-b', '127.0.0.1:{}'.format(args.port),
+               '--log-level', 'warning'] + options + ['benchapp:app']
+    with common.run_server(command, args.port, config.directory, offload=offload or ''):
+      results = [download(url) for _ in range(args.repeat)]
+    seconds = min(x[1] for x in results)
+    if results[0][2]:
+      print('{:18} header only       {:8.1f} ms'.format(name, seconds * 1000))
+    else:
+      print('{:18} {:8.0f} MiB/s     {:8.1f} ms'.format(
+        name, results[0][0] / seconds / 1024 / 1024, seconds * 1000))
+
+
+if __name__ == '__main__':
+  main()
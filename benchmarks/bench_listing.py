@@ -0,0 +1,66 @@
+"""
+Measures the number of SQL queries and the latency of `GET /location/<path>`
+for a location with many children, at the object level (a version with
+many tags) and at the namespace level.
+
+    $ python benchmarks/bench_listing.py --children 2000
+"""
+
+import argparse
+import logging
+import time
+
+import common
+from fatartifacts.database.base import Location, LocationInfo, ObjectInfo
+from pony import orm
+
+
+class QueryCounter(logging.Handler):
+
+  def __init__(self):
+    super().__init__()
+    self.count = 0
+
+  def emit(self, record):
+    self.count += 1
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--children', type=int, default=2000)
+  parser.add_argument('--repeat', type=int, default=5)
+  args = parser.parse_args()
+
+  config = common.make_config()
+  client = common.make_flask_app(config).test_client()
+  common.create_locations(client, 'root', 'root:a', 'root:a:1')
+  with config.database.query_context():
+    for i in range(args.children):
+      config.database.create_object(ObjectInfo(Location('root:a:1:t{}'.format(i)), {},
+        filename='file.bin', mime='application/octet-stream', uri='file:///dev/null'))
+      config.database.create_location(LocationInfo(Location('root:b{}'.format(i)), {}))
+
+  # Pony prints its log messages unless logging is configured.
+  logging.basicConfig()
+  counter = QueryCounter()
+  logger = logging.getLogger('pony.orm.sql')
+  logger.addHandler(counter)
+  logger.setLevel(logging.INFO)
+  logger.propagate = False
+
+  for name, path in [('object level', 'root:a:1'), ('namespace level', 'root')]:
+    counter.count = 0
+    orm.set_sql_debug(True)
+    response = client.get('/api/location/' + path, headers=common.AUTH)
+    orm.set_sql_debug(False)
+    assert response.status_code == 200, response.data
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+      client.get('/api/location/' + path, headers=common.AUTH)
+    latency = (time.perf_counter() - start) / args.repeat
+    print('{:16} {} children  {:5} queries  {:8.1f} ms'.format(
+      name, args.children, counter.count, latency * 1000))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,74 @@
+"""
+Encodes and decodes the JSON listing of a location with many objects (the
+response of `GET /location/<path>`) with every available backend of
+#fatartifacts.utils.serialize, and with a #json.JSONEncoder subclass that
+converts dates in its `default()` hook like the REST-Api's encoder before
+the serializers were added.
+
+    $ python benchmarks/bench_serialize.py --objects 10000
+"""
+
+import argparse
+import datetime
+import json
+import timeit
+
+import common  # adds the repository to the import path
+from fatartifacts.database.base import Location, ObjectInfo
+from fatartifacts.utils import serialize
+from fatartifacts.web import rest
+
+
+class DefaultHookEncoder(json.JSONEncoder):
+
+  def default(self, obj):
+    if isinstance(obj, datetime.datetime):
+      return str(obj)
+    return super().default(obj)
+
+
+def make_listing(num_objects):
+  now = datetime.datetime(2026, 1, 1, 12, 30)
+  read_url = lambda location: '/api/read/' + str(location)
+  children = []
+  for i in range(num_objects):
+    info = ObjectInfo(Location('com.example:app:1.0:tag{}'.format(i)),
+      {'commit': '{:040x}'.format(i), 'branch': 'main', 'ci': {'job': i}},
+      date_created=now, date_updated=now, filename='app-{}.zip'.format(i),
+      mime='application/zip', uri='file:///dev/null', digest='sha256:' + '0' * 64)
+    children.append(rest.object_to_json(info, read_url=read_url))
+  return {'status': 'Result', 'location': {'location': 'com.example:app:1.0',
+          'metadata': {}, 'dateCreated': now, 'dateUpdated': now, 'children': children}}
+
+
+def measure(func, repeat):
+  return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--objects', type=int, default=10000)
+  parser.add_argument('--repeat', type=int, default=5)
+  args = parser.parse_args()
+
+  listing = make_listing(args.objects)
+  encoder = DefaultHookEncoder()
+  print('{:18} {:>10} {:>10}'.format('', 'dumps', 'loads'))
+  data = encoder.encode(listing)
+  print('{:18} {:7.1f} ms {:7.1f} ms   ({:.1f} MB)'.format('default() hook',
+    measure(lambda: encoder.encode(listing), args.repeat) * 1000,
+    measure(lambda: json.loads(data), args.repeat) * 1000, len(data) / 1e6))
+  for cls in serialize.BACKENDS:
+    try:
+      serializer = cls()
+    except ImportError:
+      print('{:18} not installed'.format(cls.__name__))
+      continue
+    data = serializer.dumps(listing)
+    print('{:18} {:7.1f} ms {:7.1f} ms'.format(cls.__name__,
+      measure(lambda: serializer.dumps(listing), args.repeat) * 1000,
+      measure(lambda: serializer.loads(data), args.repeat) * 1000))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,18 @@
+"""
+The Flask (`app`) and ASGI (`asgi_app`) applications of a benchmark
+repository, for servers started with #common.run_server().
+"""
+
+import os
+
+import common
+from fatartifacts.web import asgi
+
+directory = os.environ['FATARTIFACTS_BENCH_DIR']
+config = common.make_config(directory,
+  download_offload=os.environ.get('FATARTIFACTS_BENCH_OFFLOAD') or None,
+  download_offload_root=os.path.join(directory, 'files'),
+  download_offload_prefix='/_storage/')
+
+app = common.make_flask_app(config)
+asgi_app = asgi.App(config, prefix=config.rest_prefix)
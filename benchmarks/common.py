@@ -0,0 +1,109 @@
+"""
+Shared setup of the benchmarks: a throwaway repository with a SQLite
+database and a filesystem storage in a temporary directory, and a user
+`root` with the password `alpine`.
+"""
+
+import base64
+import contextlib
+import hashlib
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fatartifacts.accesscontrol.userspace import UserSpaceAccessControl
+from fatartifacts.database.ponyorm import PonyDatabase
+from fatartifacts.storage.fs import FsStorage
+from fatartifacts.web import rest
+from fatartifacts.web.auth import HardcodedAuthorizer
+from flask import Flask
+
+AUTH = {'Authorization': 'Basic ' + base64.b64encode(b'root:alpine').decode()}
+
+
+def make_config(directory=None, **options):
+  """
+  Returns a server configuration for a repository in *directory* (a new
+  temporary directory by default). The *options* are set on the
+  configuration, eg. `download_offload`.
+  """
+
+  directory = directory or tempfile.mkdtemp(prefix='fatartifacts-bench-')
+  config = types.SimpleNamespace(directory=directory, rest_prefix='/api',
+                                 web_urls_are_public=False)
+  config.auth = HardcodedAuthorizer({
+    'root': 'sha1:' + hashlib.sha1(b'alpine').hexdigest()})
+  config.accesscontrol = UserSpaceAccessControl()
+  config.database = PonyDatabase(num_levels=4)
+  config.database.connect('sqlite', os.path.join(directory, 'db.sqlite'), create_db=True)
+  config.storage = FsStorage(os.path.join(directory, 'files'))
+  vars(config).update(options)
+  rest.check_config(config)
+  return config
+
+
+def make_flask_app(config):
+  app = Flask('fatartifacts-bench')
+  rest.app.config = config
+  app.register_blueprint(rest.app, url_prefix=config.rest_prefix)
+  return app
+
+
+def create_locations(client, *paths):
+  """
+  Creates the locations *paths* with the Flask test *client*.
+  """
+
+  for path in paths:
+    response = client.put('/api/location/' + path, headers=AUTH)
+    assert response.status_code in (200, 201), response.data
+
+
+def put_object(client, path, data):
+  """
+  Uploads an object with the file content *data* with the Flask test
+  *client*.
+  """
+
+  headers = dict(AUTH, **{
+    'Content-Type': 'application/vnd.fatartifacts+putobject',
+    'X-Metadata-Length': '2',
+    'X-File-Name': 'file.bin',
+    'X-File-ContentType': 'application/octet-stream',
+    'Content-Length': str(len(data) + 2)})
+  response = client.put('/api/location/' + path, data=b'{}' + data, headers=headers)
+  assert response.status_code in (200, 201), response.data
+
+
+@contextlib.contextmanager
+def run_server(command, port, directory, **env):
+  """
+  Runs the server *command* (eg. gunicorn or uvicorn serving an app from
+  `benchapp.py`) for the repository in *directory* and waits until it
+  accepts connections on *port*. The *env* variables are passed to the
+  server with the prefix `FATARTIFACTS_BENCH_`.
+  """
+
+  env = dict(os.environ, FATARTIFACTS_BENCH_DIR=directory,
+             **{'FATARTIFACTS_BENCH_' + k.upper(): v for k, v in env.items()})
+  process = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+  try:
+    deadline = time.time() + 30
+    while True:
+      try:
+        socket.create_connection(('127.0.0.1', port), timeout=1).close()
+        break
+      except OSError:
+        if process.poll() is not None or time.time() > deadline:
+          raise RuntimeError('server did not start: {}'.format(' '.join(command)))
+        time.sleep(0.1)
+    yield process
+  finally:
+    process.terminate()
+    process.wait()
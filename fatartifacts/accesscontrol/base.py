@@ -3,6 +3,7 @@ Abstraction of access-control.
 """
 
 from fatartifacts.database.base import Location
+from typing import *
 from typing import NamedTuple
 import abc
 
@@ -41,3 +42,15 @@ class AccessControl(metaclass=abc.ABCMeta):
     """
 
     raise NotImplementedError
+
+  def get_permissions_many(self, locations:Iterable[Location],
+                           account:str=None) -> List[Permissions]:
+    """
+    Return the permissions for *account* for each of the *locations*, in
+    the same order. This is used to filter location listings, thus the
+    *locations* are usually siblings. The default implementation calls
+    #get_permissions() for every location, implementations can override it
+    to evaluate their rules only once for the whole batch.
+    """
+
+    return [self.get_permissions(x, account) for x in locations]
@@ -0,0 +1,161 @@
+
+from fatartifacts.accesscontrol import base
+from fatartifacts.database.base import Location
+from fatartifacts.utils.cache import TTLCache
+from typing import *
+from typing import NamedTuple
+
+_ALLOW_ALL = base.Permissions.allow_all()
+_DENY_ALL = base.Permissions.deny_all()
+
+
+class Rule(NamedTuple):
+  """
+  Grants *permissions* to a *principal* at the location *prefix* and all
+  locations below it. The principal is an account name, a group name
+  prefixed with `@` or `*` for everyone (including anonymous users). The
+  *prefix* is a location string, where the empty string matches all
+  locations. The *permissions* are either a #base.Permissions object or a
+  string of the letters `r` (read), `w` (write) and `d` (delete).
+  """
+
+  principal: str
+  prefix: str
+  permissions: Union[str, base.Permissions]
+
+  def get_permissions(self) -> base.Permissions:
+    if isinstance(self.permissions, base.Permissions):
+      return self.permissions
+    invalid = set(self.permissions) - set('rwd')
+    if invalid:
+      raise ValueError('invalid permission letters: {}'.format(''.join(sorted(invalid))))
+    return base.Permissions('r' in self.permissions, 'w' in self.permissions,
+                            'd' in self.permissions)
+
+
+def _union(a: base.Permissions, b: base.Permissions) -> base.Permissions:
+  return base.Permissions(a.can_read or b.can_read, a.can_write or b.can_write,
+                          a.can_delete or b.can_delete)
+
+
+class _Node(object):
+  """
+  A node in the prefix trie of a #RuleAccessControl. *permissions* are the
+  permissions granted at this node's location (not including those granted
+  at its parents), or #None if there are none.
+  """
+
+  __slots__ = ('children', 'permissions')
+
+  def __init__(self):
+    self.children = {}
+    self.permissions = None
+
+
+class RuleAccessControl(base.AccessControl):
+  """
+  An access control based on a list of #Rule#s. Permissions are additive,
+  an account has all the permissions that are granted to it, its groups or
+  everyone at any prefix of a location. Without a matching rule, all
+  access is denied.
+
+  *groups* maps group names to the names of their member accounts.
+
+  The rules are compiled into a trie of location parts for every account
+  that is seen (up to *cache_size* accounts), containing only the rules
+  that apply to the account. Looking up the permissions of a location thus
+  only depends on its depth, not on the number of rules. For a batch of
+  locations, the trie is walked only once for every distinct parent. Call
+  #invalidate() after changing the #rules or #groups.
+
+  Example:
+
+  ```python
+  accesscontrol = RuleAccessControl([
+    Rule('*', '', 'r'),
+    Rule('@ci', 'com.example', 'rw'),
+    Rule('admin', '', 'rwd'),
+  ], groups={'ci': ['jenkins', 'travis']})
+  ```
+  """
+
+  def __init__(self, rules: Iterable[Rule], groups: Dict[str, Iterable[str]] = None,
+               cache_size=1024):
+    self.rules = [x if isinstance(x, Rule) else Rule(*x) for x in rules]
+    for rule in self.rules:
+      rule.get_permissions()  # validate
+    self.groups = {k: frozenset(v) for k, v in (groups or {}).items()}
+    self._tries = TTLCache(cache_size)
+
+  def invalidate(self):
+    self._tries.clear()
+
+  def get_principals(self, account: str) -> Set[str]:
+    """
+    Returns the principals that *account* is matched against.
+    """
+
+    principals = {'*'}
+    if account:
+      principals.add(account)
+      principals.update('@' + k for k, v in self.groups.items() if account in v)
+    return principals
+
+  def get_trie(self, account: str) -> _Node:
+    """
+    Returns the trie of the rules that apply to *account*.
+    """
+
+    account = account or None
+    root = self._tries.get(account)
+    if root is not None:
+      return root
+    root = _Node()
+    principals = self.get_principals(account)
+    for rule in self.rules:
+      if rule.principal not in principals:
+        continue
+      node = root
+      for part in Location(rule.prefix):
+        node = node.children.setdefault(part, _Node())
+      perms = rule.get_permissions()
+      node.permissions = perms if node.permissions is None else _union(node.permissions, perms)
+    self._tries.put(account, root)
+    return root
+
+  def _walk(self, node: Optional[_Node], perms: base.Permissions, parts: Iterable[str]):
+    """
+    Walks down the trie from *node* along *parts*, accumulating the
+    permissions. Returns the last node reached (or #None if the trie ended)
+    and the permissions.
+    """
+
+    for part in parts:
+      if node is None or perms == _ALLOW_ALL:
+        return None, perms
+      node = node.children.get(part)
+      if node is not None and node.permissions is not None:
+        perms = _union(perms, node.permissions)
+    return node, perms
+
+  def get_permissions(self, location, account=None):
+    root = self.get_trie(account)
+    perms = root.permissions or _DENY_ALL
+    return self._walk(root, perms, location)[1]
+
+  def get_permissions_many(self, locations, account=None):
+    root = self.get_trie(account)
+    root_perms = root.permissions or _DENY_ALL
+    parents = {}
+    result = []
+    for location in locations:
+      if len(location) == 0:
+        result.append(root_perms)
+        continue
+      parent = tuple(location[:-1])
+      try:
+        node, perms = parents[parent]
+      except KeyError:
+        node, perms = parents[parent] = self._walk(root, root_perms, parent)
+      result.append(self._walk(node, perms, (location[-1],))[1])
+    return result
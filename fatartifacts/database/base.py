@@ -141,6 +141,11 @@ class ObjectInfo(LocationInfo):
   # the `web_urls_are_public` option).
   uri: str
 
+  # A digest of the object's file in the format `<algorithm>:<hexdigest>`
+  # (eg. `sha256:9f86d0...`), or #None if it is not known (eg. for objects
+  # that were uploaded before digests were recorded).
+  digest: Optional[str] = None
+
   def has_web_uri(self):
     """
     Returns #True if #uri is an http:// or https:// URL.
@@ -154,6 +159,10 @@ class Filter(NamedObject):
   This object can be passed to query functions of the #Database interface to
   filter the result-list. Note that the database is not required to implement
   handling all or any parameters of the #Filter.
+
+  The #startswith, #endswith and #contains members are matched against the
+  last part of the locations in the result-list (ie. the name of the child
+  location).
   """
 
   startswith: str = None
@@ -230,7 +239,8 @@ class Database(metaclass=abc.ABCMeta):
     raise NotImplementedError
 
   @abc.abstractmethod
-  def list_location(self, location:Location, filter:Filter=None) -> Iterable[LocationInfo]:
+  def list_location(self, location:Location, filter:Filter=None,
+                    limit:int=None, after:str=None) -> Iterable[LocationInfo]:
     """
     Queries information about the *location*. If the *filter* parameter is
     specified, not all elements available in that level are returned, but only
@@ -239,6 +249,12 @@ class Database(metaclass=abc.ABCMeta):
     Note that some database implementations may not support all filter options
     and may return more results than matching the filter.
 
+    The results are ordered by the name of the child locations. If *after*
+    is specified, only children with a name that sorts after it are returned.
+    Together with *limit*, which restricts the maximum number of results,
+    this allows paginating through large levels by passing the name of the
+    last child of the previous page.
+
     If the *location* is an object-location or even longer than the supported
     #num_levels(), an #InvalidLocationQuery error will be raised. If the
     *location* pointed to does not exist, a #LocationDoesNotExist error is
@@ -252,7 +268,8 @@ class Database(metaclass=abc.ABCMeta):
     raise NotImplementedError
 
   @abc.abstractmethod
-  def list_objects(self, location:Location, filter:Filter=None) -> Iterable[ObjectInfo]:
+  def list_objects(self, location:Location, filter:Filter=None,
+                   limit:int=None, after:str=None) -> Iterable[ObjectInfo]:
     """
     Queries information about objects at the specified *location*. The
     #Location must have a length equal to or 1 less than #Database.num_levels(),
@@ -263,6 +280,9 @@ class Database(metaclass=abc.ABCMeta):
     #ObjectInfo at maximum (zero if the object does not exist or does not
     match the filter).
 
+    The *filter*, *limit* and *after* parameters behave the same as for
+    #list_location().
+
     Raises:
       LocationDoesNotExist:
       InvalidLocationQuery:
@@ -325,6 +345,11 @@ class Database(metaclass=abc.ABCMeta):
     Note that the root location can not be deleted, but doing so will delete
     all of its sub-locations.
 
+    Returns the #ObjectInfo#s of the objects that were deleted, so that their
+    files can be deleted from the storage. Implementations only need to fill
+    in the fields that identify the file (#ObjectInfo.location, `filename`,
+    `mime` and `uri`), the `metadata` and dates may be #None.
+
     Raises:
       InvalidLocationQuery:
       LocationDoesNotExist:
@@ -333,3 +358,26 @@ class Database(metaclass=abc.ABCMeta):
     """
 
     raise NotImplementedError
+
+  def get_object_uris(self, uris: Collection[str]) -> Set[str]:
+    """
+    Returns the subset of *uris* that are referenced by objects in the
+    database. This is used by the garbage collector (see #fatartifacts.gc)
+    to find files in the storage that are no longer referenced. Databases
+    that do not support it raise a #NotImplementedError.
+    """
+
+    raise NotImplementedError('{} does not support looking up object URIs'
+                              .format(type(self).__name__))
+
+  def list_object_uris(self, exclude_prefix: str) -> Iterable[str]:
+    """
+    Yields the URIs of all objects that do not start with *exclude_prefix*.
+    The garbage collector uses it to find objects whose URI deviates from
+    the URIs that the storage currently generates (see
+    #fatartifacts.storage.base.Storage.get_uri_prefix()). Databases that do
+    not support it raise a #NotImplementedError.
+    """
+
+    raise NotImplementedError('{} does not support looking up object URIs'
+                              .format(type(self).__name__))
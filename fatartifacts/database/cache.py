@@ -0,0 +1,179 @@
+"""
+A read-through cache for the location and object lookups of a database.
+"""
+
+from fatartifacts.database import base
+from fatartifacts.database.invalidation import InvalidationBus
+from fatartifacts.utils.cache import TTLCache
+from typing import *
+import contextlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class _Missing(object):
+  """
+  A cached negative result, ie. a lookup that raised #base.LocationDoesNotExist.
+  """
+
+  __slots__ = ('location',)
+
+  def __init__(self, location):
+    self.location = location
+
+
+class CachingDatabase(base.Database):
+  """
+  A #base.Database layer that caches the results of #get_location() and
+  #get_object() of the wrapped *database*, so that repeated lookups of the
+  same location (eg. clients polling whether a build exists) do not query
+  the database. Lookups of locations that do not exist are cached as well,
+  but only for *negative_ttl* seconds.
+
+  At most *maxsize* results are cached for up to *ttl* seconds. Entries are
+  invalidated when a location or object is created, updated or deleted
+  through this layer, once when the change is made and again when the
+  outermost #query_context() is exited (ie. after the change has been
+  committed). Changes made by other processes are only seen after the
+  entries expired, thus the *ttl* bounds how long a stale result may be
+  returned, unless all processes share an #InvalidationBus *bus*, on which
+  the committed changes are published.
+
+  The cache hits and misses are counted in the #cache's `hits` and `misses`
+  members. The returned #base.LocationInfo and #base.ObjectInfo objects are
+  shared between requests and must not be modified.
+  """
+
+  def __init__(self, database: base.Database, maxsize=4096, ttl=60, negative_ttl=5,
+               bus: InvalidationBus = None):
+    self.database = database
+    self.bus = bus
+    self.cache = TTLCache(maxsize, ttl)
+    self.negative_ttl = negative_ttl
+    # Incremented on every invalidation. A result is only stored if no
+    # invalidation happened while it was read from the database, otherwise
+    # it could be older than the change that caused the invalidation.
+    self._generation = 0
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    if bus is not None:
+      bus.subscribe(self.invalidate)
+
+  def invalidate(self, location: base.Location = None, recursive=False):
+    """
+    Removes the cached results for *location* and its parents, or all
+    results if *location* is #None. If *recursive* is #True, the results for
+    the locations below *location* are removed as well.
+    """
+
+    with self._lock:
+      self._generation += 1
+      if location is None or (recursive and len(location) == 0):
+        self.cache.clear()
+        return
+      for i in range(len(location) + 1):
+        self.cache.pop(str(base.Location(location[:i])))
+      if recursive:
+        prefix = str(location) + ':'
+        self.cache.pop_if(lambda key: key.startswith(prefix))
+
+  def _invalidate_on_exit(self, location, recursive=False):
+    self.invalidate(location, recursive)
+    pending = getattr(self._local, 'pending', None)
+    if pending is not None:
+      pending.append((location, recursive))
+    else:
+      self._publish(location, recursive)
+
+  def _publish(self, location, recursive):
+    # The change is committed at this point, failing the request would
+    # only hide that.
+    if self.bus is not None:
+      try:
+        self.bus.publish(location, recursive)
+      except Exception:
+        logger.exception('Publishing the invalidation of %s failed.', location)
+
+  def _lookup(self, method, location):
+    key = str(location)
+    entry = self.cache.get(key)
+    if entry is None:
+      generation = self._generation
+      try:
+        entry = method(location)
+      except base.LocationDoesNotExist as exc:
+        entry = _Missing(exc.location)
+      # Results read after a change in the current transaction may never
+      # be committed.
+      if not getattr(self._local, 'pending', None):
+        ttl = self.negative_ttl if isinstance(entry, _Missing) else NotImplemented
+        with self._lock:
+          if generation == self._generation:
+            self.cache.put(key, entry, ttl)
+    if isinstance(entry, _Missing):
+      raise base.LocationDoesNotExist(entry.location)
+    return entry
+
+  @contextlib.contextmanager
+  def _query_context(self):
+    local = self._local
+    outermost = getattr(local, 'pending', None) is None
+    if outermost:
+      local.pending = []
+    try:
+      with self.database.query_context():
+        yield
+    finally:
+      if outermost:
+        pending, local.pending = local.pending, None
+        for location, recursive in pending:
+          self.invalidate(location, recursive)
+          self._publish(location, recursive)
+
+  def num_levels(self):
+    return self.database.num_levels()
+
+  def query_context(self):
+    return self._query_context()
+
+  def get_location(self, location):
+    if len(location) >= self.num_levels():
+      raise base.InvalidLocationQuery(location)
+    return self._lookup(self.database.get_location, location)
+
+  def get_object(self, location):
+    if len(location) != self.num_levels():
+      raise base.InvalidLocationQuery(location)
+    return self._lookup(self.database.get_object, location)
+
+  def list_location(self, location, filter=None, limit=None, after=None):
+    return self.database.list_location(location, filter, limit, after)
+
+  def list_objects(self, location, filter=None, limit=None, after=None):
+    return self.database.list_objects(location, filter, limit, after)
+
+  def get_object_uris(self, uris):
+    return self.database.get_object_uris(uris)
+
+  def list_object_uris(self, exclude_prefix):
+    return self.database.list_object_uris(exclude_prefix)
+
+  def create_location(self, info, update_if_exists=False):
+    try:
+      return self.database.create_location(info, update_if_exists)
+    finally:
+      self._invalidate_on_exit(info.location)
+
+  def create_object(self, info, update_if_exists=False):
+    try:
+      return self.database.create_object(info, update_if_exists)
+    finally:
+      self._invalidate_on_exit(info.location)
+
+  def delete_location(self, location, recursive):
+    try:
+      return self.database.delete_location(location, recursive)
+    finally:
+      self._invalidate_on_exit(location, recursive=True)
@@ -0,0 +1,68 @@
+"""
+A database layer that records the duration of every call in a
+#fatartifacts.metrics.Registry.
+"""
+
+from fatartifacts import metrics
+from fatartifacts.database import base
+
+
+class InstrumentedDatabase(base.Database):
+  """
+  A #base.Database layer that times the calls to the wrapped *database* by
+  method in the `fatartifacts_database_call_duration_seconds` histogram of
+  the *registry*, and counts the exceptions they raise (including expected
+  ones like #base.LocationDoesNotExist) in
+  `fatartifacts_database_call_errors_total`. The listing methods are timed
+  until their results have been consumed.
+
+  Wrap the outermost database layer to measure the latency seen by the
+  REST-Api, or the #fatartifacts.database.cache.CachingDatabase's backend to
+  measure the queries that miss the cache.
+  """
+
+  def __init__(self, database: base.Database, registry: metrics.Registry):
+    self.database = database
+    self.metrics = metrics.CallMetrics(registry, 'fatartifacts_database', 'database')
+
+  def num_levels(self):
+    return self.database.num_levels()
+
+  def query_context(self):
+    return self.database.query_context()
+
+  @metrics.timed
+  def get_location(self, location):
+    return self.database.get_location(location)
+
+  @metrics.timed
+  def get_object(self, location):
+    return self.database.get_object(location)
+
+  @metrics.timed_iter
+  def list_location(self, location, filter=None, limit=None, after=None):
+    return self.database.list_location(location, filter, limit, after)
+
+  @metrics.timed_iter
+  def list_objects(self, location, filter=None, limit=None, after=None):
+    return self.database.list_objects(location, filter, limit, after)
+
+  @metrics.timed
+  def get_object_uris(self, uris):
+    return self.database.get_object_uris(uris)
+
+  @metrics.timed
+  def list_object_uris(self, exclude_prefix):
+    return self.database.list_object_uris(exclude_prefix)
+
+  @metrics.timed
+  def create_location(self, info, update_if_exists=False):
+    return self.database.create_location(info, update_if_exists)
+
+  @metrics.timed
+  def create_object(self, info, update_if_exists=False):
+    return self.database.create_object(info, update_if_exists)
+
+  @metrics.timed
+  def delete_location(self, location, recursive):
+    return self.database.delete_location(location, recursive)
@@ -0,0 +1,155 @@
+"""
+Distributes the invalidation of cached locations between server processes.
+"""
+
+from fatartifacts.database.base import Location
+from typing import *
+import abc
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+Subscriber = Callable[[Optional[Location], bool], Any]
+
+
+class InvalidationBus(metaclass=abc.ABCMeta):
+  """
+  A bus on which a process announces that it changed a location, so that
+  the other processes can drop what they cached about it. Subscribers are
+  called with the location (or #None if everything must be invalidated)
+  and whether the locations below it are affected as well, from a thread
+  of the bus.
+  """
+
+  def __init__(self):
+    self._subscribers = []
+
+  def subscribe(self, callback: Subscriber):
+    self._subscribers.append(callback)
+
+  def unsubscribe(self, callback: Subscriber):
+    self._subscribers.remove(callback)
+
+  def _deliver(self, location: Optional[Location], recursive: bool):
+    for callback in list(self._subscribers):
+      try:
+        callback(location, recursive)
+      except Exception:
+        logger.exception('Invalidation subscriber %r failed.', callback)
+
+  @abc.abstractmethod
+  def publish(self, location: Optional[Location], recursive=False):
+    """
+    Announces a change of *location* to the other processes. This should
+    only be called after the change has been committed. The subscribers in
+    the current process are not called.
+    """
+
+    raise NotImplementedError
+
+  def close(self):
+    pass
+
+
+class SqliteInvalidationBus(InvalidationBus):
+  """
+  An #InvalidationBus that appends the invalidations to a table in the
+  SQLite database at *path*, which is polled for the invalidations of other
+  processes every *poll_interval* seconds. Invalidations are kept for
+  *retention* seconds; a process that did not poll for longer than that
+  invalidates everything.
+
+  All processes must be able to access the database file, thus this bus is
+  meant for the workers on a single host.
+  """
+
+  def __init__(self, path, poll_interval=0.25, retention=600):
+    super().__init__()
+    self.path = path
+    self.poll_interval = poll_interval
+    self.retention = retention
+    self._last_prune = 0
+    self._local = threading.local()
+    db = self._connect()
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('''
+      CREATE TABLE IF NOT EXISTS invalidations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        origin TEXT NOT NULL,
+        location TEXT,
+        recursive INTEGER NOT NULL,
+        time REAL NOT NULL)''')
+    self._last_id = db.execute('SELECT COALESCE(MAX(id), 0) FROM invalidations').fetchone()[0]
+    self._closed = threading.Event()
+    self._start()
+    # Threads do not survive a fork (eg. gunicorn's preload_app).
+    if hasattr(os, 'register_at_fork'):
+      os.register_at_fork(after_in_child=self._start)
+
+  def _connect(self) -> sqlite3.Connection:
+    # Connections are kept open per thread, opening one and checkpointing
+    # the WAL when it is closed costs more than the statement itself.
+    db = getattr(self._local, 'db', None)
+    if db is None or self._local.pid != os.getpid():
+      db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+      # Invalidations are worthless after a crash, they do not need to be
+      # synced to disk on every commit.
+      db.execute('PRAGMA synchronous = NORMAL')
+      self._local.db, self._local.pid = db, os.getpid()
+    return db
+
+  def _start(self):
+    # Every process has its own origin, a forked process must not ignore
+    # the invalidations of its parent.
+    self._origin = uuid.uuid4().hex
+    if self._closed.is_set():
+      return
+    thread = threading.Thread(target=self._run, name='SqliteInvalidationBus', daemon=True)
+    thread.start()
+
+  def _run(self):
+    while not self._closed.wait(self.poll_interval):
+      try:
+        self.poll()
+      except sqlite3.Error:
+        logger.exception('Polling invalidations from %s failed.', self.path)
+
+  def poll(self):
+    """
+    Delivers the invalidations that were published by other processes since
+    the last poll. This is called periodically by a background thread.
+    """
+
+    now = time.time()
+    db = self._connect()
+    rows = db.execute(
+      'SELECT id, origin, location, recursive FROM invalidations '
+      'WHERE id > ? ORDER BY id', (self._last_id,)).fetchall()
+    if now - self._last_prune > self.retention / 10:
+      db.execute('DELETE FROM invalidations WHERE time < ?', (now - self.retention,))
+      self._last_prune = now
+    if not rows:
+      return
+    # Ids are only skipped if the invalidations were pruned before this
+    # process could see them.
+    missed = rows[0][0] > self._last_id + 1
+    self._last_id = rows[-1][0]
+    if missed:
+      self._deliver(None, True)
+      return
+    for _, origin, location, recursive in rows:
+      if origin != self._origin:
+        self._deliver(None if location is None else Location(location), bool(recursive))
+
+  def publish(self, location, recursive=False):
+    self._connect().execute(
+      'INSERT INTO invalidations (origin, location, recursive, time) VALUES (?, ?, ?, ?)',
+      (self._origin, None if location is None else str(location), int(recursive), time.time()))
+
+  def close(self):
+    self._closed.set()
@@ -13,6 +13,10 @@ def declare_entities(db):
 
   class Location(db.Entity):
     name = orm.Optional(str)
+    # The full location string (see #base.Location.__str__()). This is a
+    # materialized path that allows us to resolve a location in a single
+    # query instead of walking the hierarchy level by level.
+    path = orm.Optional(str, unique=True)
     parent = orm.Optional('Location', reverse='children')
     children = orm.Set('Location', cascade_delete=True)
     metadata = orm.Required(orm.Json)
@@ -20,24 +24,23 @@ def declare_entities(db):
     date_updated = orm.Required(datetime)
     object = orm.Optional('Object', cascade_delete=True)
     orm.composite_index(name, parent)
+    # For the keyset pagination of children (parent = ? AND name > ?).
+    orm.composite_index(parent, name)
 
     @staticmethod
     def get_root() -> 'Location':
-      root = Location.get(name='', parent=None)
+      root = Location.get(path='')
       if not root:
         now = datetime.utcnow()
-        root = Location(name='', parent=None, metadata={}, date_created=now,
-                   date_updated=now)
+        root = Location(name='', path='', parent=None, metadata={},
+                   date_created=now, date_updated=now)
       return root
 
     @classmethod
     def get_by_db_location(cls, loc:base.Location) -> Optional['Location']:
-      current = cls.get_root()
-      for i in range(len(loc)):
-        current = cls.get(name=loc[i], parent=current)
-        if not current:
-          return None
-      return current
+      if len(loc) == 0:
+        return cls.get_root()
+      return cls.get(path=str(loc))
 
     @classmethod
     def from_db_location(cls, loc:base.Location, metadata:Dict) -> 'Location':
@@ -45,19 +48,12 @@ def declare_entities(db):
       parent = cls.get_by_db_location(loc.parent)
       if not parent:
         raise base.LocationDoesNotExist(loc.parent)
-      entity = cls(name=loc[-1], parent=parent, metadata=metadata,
-                   date_created=now, date_updated=now)
+      entity = cls(name=loc[-1], path=str(loc), parent=parent,
+                   metadata=metadata, date_created=now, date_updated=now)
       return entity
 
     def as_db_location(self) -> base.Location:
-      parts = []
-      while self:
-        if not self.name:
-          assert self == Location.get_root()
-          break
-        parts.append(self.name)
-        self = self.parent
-      return base.Location(reversed(parts))
+      return base.Location(self.path)
 
     def as_db_location_info(self) -> base.LocationInfo:
       return base.LocationInfo(
@@ -74,6 +70,8 @@ def declare_entities(db):
     def validate(self):
       if not self.name and self.parent:
         raise ValueError('non-root level can not have a zero-length name')
+      if not self.path and self.parent:
+        raise ValueError('non-root level can not have a zero-length path')
 
     def before_insert(self):
       self.validate()
@@ -86,14 +84,18 @@ def declare_entities(db):
     location = orm.PrimaryKey(Location)
     filename = orm.Required(str)
     mime = orm.Required(str)
-    uri = orm.Required(str)
+    # Indexed for the garbage collector's lookups (see #get_object_uris()).
+    uri = orm.Required(str, index=True)
+    digest = orm.Optional(str, nullable=True)
 
     @classmethod
     def from_db_location(cls, loc:base.Location, metadata:Dict,
-                         filename: str, mime: str, uri: str) -> 'Object':
+                         filename: str, mime: str, uri: str,
+                         digest: str = None) -> 'Object':
       location = Location.from_db_location(loc, metadata)
       now = datetime.utcnow()
-      entity = cls(location=location, filename=filename, mime=mime, uri=uri)
+      entity = cls(location=location, filename=filename, mime=mime, uri=uri,
+                   digest=digest)
       return entity
 
     def as_db_object_info(self) -> base.ObjectInfo:
@@ -104,7 +106,85 @@ def declare_entities(db):
         self.location.date_updated,
         self.filename,
         self.mime,
-        self.uri)
+        self.uri,
+        self.digest)
+
+
+def migrate(db):
+  """
+  Brings the tables of an existing database up to date with the entities
+  declared in #declare_entities(). Pony only creates missing tables, thus
+  columns that were added later are created and backfilled here. This must
+  be called after the mapping was generated with `check_tables=False`.
+  """
+
+  Location = db.Location
+  quote = db.provider.quote_name
+  table = quote(Location._table_)
+  id_col = quote(Location._pk_columns_[0])
+  name_col = quote(Location.name.column)
+  path_col = quote(Location.path.column)
+  parent_col = quote(Location.parent.column)
+
+  def column_exists(table, column):
+    try:
+      with orm.db_session():
+        # Qualify the column, SQLite treats an unknown "name" as a string.
+        db.execute('SELECT {0}.{1} FROM {0} WHERE 1 = 0'.format(table, column))
+      return True
+    except orm.DatabaseError:
+      return False
+
+  # Location.path (materialized path).
+  if not column_exists(table, path_col):
+    with orm.db_session():
+      db.execute('ALTER TABLE {} ADD COLUMN {} TEXT'.format(table, path_col))
+      db.execute('CREATE UNIQUE INDEX {} ON {} ({})'.format(
+        quote('unq_' + Location._table_.lower() + '__path'), table, path_col))
+      db.execute('UPDATE {} SET {} = \'\' WHERE {} IS NULL'.format(
+        table, path_col, parent_col))
+      # Backfill one level per iteration, starting at the children of the
+      # root location.
+      while True:
+        cursor = db.execute('''
+          UPDATE {table} SET {path} = (
+            SELECT CASE WHEN p.{path} = '' THEN {table}.{name}
+                        ELSE p.{path} || ':' || {table}.{name} END
+            FROM {table} p WHERE p.{id} = {table}.{parent})
+          WHERE {path} IS NULL AND {parent} IN (
+            SELECT {id} FROM {table} WHERE {path} IS NOT NULL)
+          '''.format(table=table, path=path_col, name=name_col, id=id_col,
+                     parent=parent_col))
+        if cursor.rowcount <= 0:
+          break
+
+  # Index on (parent, name), without it paginated listings need to sort all
+  # children of a location for every page. There is no portable way to check
+  # whether an index exists, thus creating it simply fails if it does.
+  try:
+    with orm.db_session():
+      db.execute('CREATE INDEX {} ON {} ({}, {})'.format(
+        quote('idx_' + Location._table_.lower() + '__parent_name'), table,
+        parent_col, name_col))
+  except orm.DatabaseError:
+    pass
+
+  # Index on Object.uri, for the lookups of the garbage collector.
+  Object = db.Object
+  try:
+    with orm.db_session():
+      db.execute('CREATE INDEX {} ON {} ({})'.format(
+        quote('idx_' + Object._table_.lower() + '__uri'), quote(Object._table_),
+        quote(Object.uri.column)))
+  except orm.DatabaseError:
+    pass
+
+  # Object.digest, unknown for the objects that already exist.
+  object_table = quote(Object._table_)
+  if not column_exists(object_table, quote(Object.digest.column)):
+    with orm.db_session():
+      db.execute('ALTER TABLE {} ADD COLUMN {} TEXT'.format(
+        object_table, quote(Object.digest.column)))
 
 
 class PonyDatabase(base.Database):
@@ -117,7 +197,9 @@ class PonyDatabase(base.Database):
   def connect(self, *args, **kwargs):
     create_tables = kwargs.pop('create_tables', True)
     self._db.bind(*args, **kwargs)
-    self._db.generate_mapping(create_tables=create_tables)
+    self._db.generate_mapping(create_tables=create_tables, check_tables=False)
+    migrate(self._db)
+    self._db.check_tables()
 
     with orm.db_session():
       self._db.Location.get_root()  # ensure that the root exists.
@@ -144,26 +226,91 @@ class PonyDatabase(base.Database):
       raise base.LocationDoesNotExist(location)
     return entity.object.as_db_object_info()
 
-  def list_location(self, location, filter=None):
-    # XXX Implement filter.
+  def _filter_query(self, query, filter, limit, after, objects_only):
+    """
+    Applies the #base.Filter and pagination parameters to a *query* that
+    selects from the #Location entity with the variable name `x`. If
+    *objects_only* is #True, the locations in the query are object-level
+    locations.
+    """
+
+    # Note: We use string expressions here since Pony evaluates the names
+    # in them from the local scope of this function.
+    Object = self._db.Object
+    if filter and filter.startswith:
+      startswith = filter.startswith
+      query = query.where('x.name.startswith(startswith)')
+    if filter and filter.endswith:
+      endswith = filter.endswith
+      query = query.where('x.name.endswith(endswith)')
+    if filter and filter.contains:
+      contains = filter.contains
+      query = query.where('contains in x.name')
+    if filter and filter.has_object:
+      tag = filter.has_object
+      if objects_only:
+        query = query.where('x.name == tag')
+      else:
+        query = query.where('orm.exists(o for o in Object if o.location.name == tag '
+                            'and o.location.path.startswith(x.path + ":"))')
+    if after is not None:
+      query = query.where('x.name > after')
+    query = query.sort_by('x.name')
+    if limit is not None:
+      query = query.limit(limit)
+    return query
+
+  def list_location(self, location, filter=None, limit=None, after=None):
     if len(location) >= self._num_levels:
       raise base.InvalidLocationQuery(location)
     entity = self._db.Location.get_by_db_location(location)
     if not entity:
       raise base.LocationDoesNotExist(location)
-    return (x.as_db_location_info() for x in entity.children)
-
-  def list_objects(self, location, filter=None):
-    # XXX Implement filter.
+    # Select plain columns instead of entities to avoid the overhead of
+    # Pony's identity map and lazy loading for large levels.
+    query = orm.select(
+      (x.path, x.metadata, x.date_created, x.date_updated)
+      for x in self._db.Location if x.parent == entity)
+    is_object_level = len(location) + 1 == self._num_levels
+    query = self._filter_query(query, filter, limit, after, is_object_level)
+    return (base.LocationInfo(base.Location(path), *row) for path, *row in query)
+
+  def list_objects(self, location, filter=None, limit=None, after=None):
     if len(location) not in (self._num_levels, self._num_levels - 1):
       raise base.InvalidLocationQuery(location)
     entity = self._db.Location.get_by_db_location(location)
     if not entity:
       raise base.LocationDoesNotExist(location)
+    # Load the locations together with their objects in a single query,
+    # otherwise every child costs two additional queries.
     if len(location) == self._num_levels:
-      yield entity.object.as_db_object_info()
+      query = orm.select(
+        (x.path, x.metadata, x.date_created, x.date_updated,
+         o.filename, o.mime, o.uri, o.digest)
+        for x in self._db.Location for o in self._db.Object
+        if x == entity and o.location == x)
     else:
-      yield from (x.object.as_db_object_info() for x in entity.children if x.object)
+      query = orm.select(
+        (x.path, x.metadata, x.date_created, x.date_updated,
+         o.filename, o.mime, o.uri, o.digest)
+        for x in self._db.Location for o in self._db.Object
+        if x.parent == entity and o.location == x)
+    query = self._filter_query(query, filter, limit, after, True)
+    for path, *row in query:
+      yield base.ObjectInfo(base.Location(path), *row)
+
+  def get_object_uris(self, uris, batch_size=500):
+    # Batched to stay below the maximum number of query parameters.
+    uris = list(uris)
+    result = set()
+    for i in range(0, len(uris), batch_size):
+      batch = uris[i:i + batch_size]
+      result.update(orm.select(o.uri for o in self._db.Object if o.uri in batch))
+    return result
+
+  def list_object_uris(self, exclude_prefix):
+    return orm.select(o.uri for o in self._db.Object
+                      if not o.uri.startswith(exclude_prefix))[:]
 
   def create_location(self, info, update_if_exists=False):
     if len(info.location) > (self._num_levels - 1):
@@ -191,13 +338,18 @@ class PonyDatabase(base.Database):
     if entity:
       if info.metadata is not None:
         entity.metadata = info.metadata
+      # Always mark the location as updated, the object's file has been
+      # replaced even if the record itself might not change.
+      entity.date_updated = datetime.utcnow()
       if entity.object:
         entity.object.filename = info.filename
         entity.object.mime = info.mime
         entity.object.uri = info.uri
+        entity.object.digest = info.digest
       else:
         entity.object = self._db.Object(location=entity,
-            filename=info.filename, uri=info.uri, mime=info.mime)
+            filename=info.filename, uri=info.uri, mime=info.mime,
+            digest=info.digest)
       return False  # updated
     else:
       entity = self._db.Object.from_db_location(
@@ -205,7 +357,8 @@ class PonyDatabase(base.Database):
         metadata=info.metadata or {},
         filename=info.filename,
         mime=info.mime,
-        uri=info.uri)
+        uri=info.uri,
+        digest=info.digest)
       assert entity.location.as_db_location() == info.location, (entity.as_db_location(), info.location)
       return True  # newly created location
 
@@ -217,16 +370,26 @@ class PonyDatabase(base.Database):
     if not entity:
       raise base.LocationDoesNotExist(location)
 
-    if entity.children and not recursive:
+    if not recursive and not entity.children.is_empty():
       raise base.LocationHasChildren(location)
 
-    objects = [x.as_db_object_info() for x in entity.collect_objects()]
+    # Select and delete the whole subtree by its materialized path with a
+    # few set-based statements, instead of loading every entity in it.
+    Object = self._db.Object
+    path, prefix = entity.path, entity.path + ':'
     if len(location) == 0:
       # The root location can not be deleted, but it's children can be.
-      entity.children.select().delete()
+      in_subtree = '{0}.parent is not None'
     else:
-      if not entity:
-        raise base.LocationDoesNotExist(location)
-      entity.delete()
-
+      in_subtree = '{0}.path == path or {0}.path.startswith(prefix)'
+    # Decoding the metadata and dates would take most of the time.
+    query = orm.select(
+      (x.path, o.filename, o.mime, o.uri)
+      for x in self._db.Location for o in Object if o.location == x)
+    objects = [base.ObjectInfo(base.Location(path), None, filename=filename,
+                               mime=mime, uri=uri)
+               for path, filename, mime, uri in query.where(in_subtree.format('x'))]
+
+    orm.select(o for o in Object).where(in_subtree.format('o.location')).delete(bulk=True)
+    orm.select(x for x in self._db.Location).where(in_subtree.format('x')).delete(bulk=True)
     return objects
@@ -0,0 +1,291 @@
+"""
+Garbage collector for files in the storage that are not referenced by any
+object in the database (eg. because deleting them failed) and for the
+temporary files of aborted uploads.
+
+Run it from the command-line (eg. from a cron job), where it loads the
+`database` and `storage` from the server configuration:
+
+    $ fatartifacts-gc --dry-run
+    $ fatartifacts-gc --min-age 86400 --rate 20
+
+or start it in the background of a server process with
+#GarbageCollector.start().
+"""
+
+from fatartifacts.database.base import Database
+from fatartifacts.storage.base import FileDoesNotExist, Storage, StoredFile
+from fatartifacts.utils.types import NamedObject
+from typing import *
+import argparse
+import importlib.util
+import itertools
+import logging
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class GcStats(NamedObject):
+  """
+  The results of a #GarbageCollector run.
+  """
+
+  # The number of files listed from the storage.
+  scanned: int = 0
+
+  # The number of files that are referenced by an object.
+  referenced: int = 0
+
+  # The number of files that were younger than the minimum age (or the
+  # maximum age of chunked uploads).
+  skipped: int = 0
+
+  # The number of unreferenced files, stale temporary files and abandoned
+  # chunked uploads.
+  orphans: int = 0
+  temporaries: int = 0
+  uploads: int = 0
+
+  # The number of files that were deleted (or would have been deleted in a
+  # dry run), and the number of files that could not be deleted.
+  deleted: int = 0
+  failed: int = 0
+
+  # The total size of the deleted files.
+  bytes_reclaimed: int = 0
+
+  # The duration of the run in seconds.
+  duration: float = 0.0
+
+
+class GarbageCollector(object):
+  """
+  Lists the files of the *storage* (see #Storage.list_files()) and looks up
+  which of them are referenced by objects in the *database* in batches of
+  *batch_size* files (see #Database.get_object_uris()), thus neither the
+  listing nor the database table is ever loaded at once.
+
+  Files that are not referenced and temporary files are deleted, at most
+  *rate* files per second (unlimited if #None) to limit the load on the
+  storage. Files that were modified less than *min_age* seconds ago are
+  never deleted, as their upload may not have been comitted to the
+  database yet. Chunked uploads (see #StoredFile.upload) can be resumed
+  after a dropped connection, thus they are only deleted if they were not
+  written to for *upload_max_age* seconds.
+
+  Files are matched with the URIs of the objects by their exact spelling,
+  and objects whose URI the storage does not generate anymore (eg. because
+  its directory was configured differently) by the spelling returned by
+  #Storage.normalize_uri(). If the storage can not normalize such a URI, no
+  unreferenced file is deleted, as it may be the one the object refers to.
+  """
+
+  def __init__(self, database: Database, storage: Storage, min_age=3600,
+               rate: float = 50, batch_size=500, dry_run=False,
+               upload_max_age=7 * 24 * 3600):
+    self.database = database
+    self.storage = storage
+    self.min_age = min_age
+    self.upload_max_age = upload_max_age
+    self.rate = rate
+    self.batch_size = batch_size
+    self.dry_run = dry_run
+    # The results of the last run started with #start().
+    self.last_stats = None
+    self._stop = threading.Event()
+    self._next_delete = 0
+
+  def run(self) -> GcStats:
+    """
+    Collects the garbage once and returns the statistics.
+    """
+
+    stats = GcStats()
+    start = time.time()
+    deadline = start - self.min_age
+    upload_deadline = start - max(self.upload_max_age, self.min_age)
+    deviating = self._get_deviating_uris()
+    files = iter(self.storage.list_files())
+    while not self._stop.is_set():
+      batch = list(itertools.islice(files, self.batch_size))
+      if not batch:
+        break
+      stats.scanned += len(batch)
+      candidates = [x for x in batch
+                    if x.mtime <= (upload_deadline if x.upload else deadline)]
+      stats.skipped += len(batch) - len(candidates)
+      uris = [x.uri for x in candidates if not x.temporary]
+      with self.database.query_context():
+        referenced = self.database.get_object_uris(uris) if uris else set()
+      for file in candidates:
+        if file.upload:
+          stats.uploads += 1
+        elif file.temporary:
+          stats.temporaries += 1
+        elif file.uri in referenced or (deviating and
+            self.storage.normalize_uri(file.uri) in deviating):
+          stats.referenced += 1
+          continue
+        else:
+          stats.orphans += 1
+          if deviating is None:
+            continue
+        self._delete(file, stats)
+    stats.duration = time.time() - start
+    logger.info('Garbage collection %s', stats)
+    return stats
+
+  def _get_deviating_uris(self) -> Optional[Set[str]]:
+    """
+    Returns the normalized URIs of the objects whose URI does not start
+    with the storage's #Storage.get_uri_prefix(), or #None if one of them
+    can not be normalized.
+    """
+
+    prefix = self.storage.get_uri_prefix()
+    if prefix is None:
+      return set()
+    with self.database.query_context():
+      uris = list(self.database.list_object_uris(prefix))
+    result = set()
+    for uri in uris:
+      normalized = self.storage.normalize_uri(uri)
+      if normalized is None:
+        logger.warning('The storage does not know the file of URI %r, unreferenced '
+                       'files are not deleted.', uri)
+        return None
+      result.add(normalized)
+    if result:
+      logger.warning('%d objects have a URI that does not start with %r.',
+                     len(uris), prefix)
+    return result
+
+  def _delete(self, file: StoredFile, stats: GcStats):
+    if self.rate:
+      now = time.monotonic()
+      delay = self._next_delete - now
+      self._next_delete = max(self._next_delete, now) + 1.0 / self.rate
+      if delay > 0 and self._stop.wait(delay):
+        return
+    if self.dry_run:
+      logger.info('Would delete %s', file.name)
+      deleted = True
+    else:
+      try:
+        deleted = self.storage.delete_stored_file(file)
+      except FileDoesNotExist:
+        deleted = False
+      except Exception:
+        logger.exception('Deleting %s failed.', file.name)
+        stats.failed += 1
+        return
+    if deleted:
+      stats.deleted += 1
+      stats.bytes_reclaimed += file.size
+
+  def start(self, interval: float) -> threading.Thread:
+    """
+    Starts a daemon thread that runs the garbage collector every *interval*
+    seconds, until #stop() is called. The results of the last run are
+    available as #last_stats. Only one process of a deployment should run
+    the garbage collector.
+    """
+
+    def worker():
+      while not self._stop.is_set():
+        try:
+          self.last_stats = self.run()
+        except Exception:
+          logger.exception('Garbage collection failed.')
+        self._stop.wait(interval)
+
+    self._stop.clear()
+    thread = threading.Thread(target=worker, name='GarbageCollector', daemon=True)
+    thread.start()
+    return thread
+
+  def stop(self):
+    self._stop.set()
+
+
+parser = argparse.ArgumentParser(
+  prog = 'fatartifacts-gc',
+  description = '''
+    Deletes files from the FatArtifacts storage that are not referenced by
+    any object, and temporary files of aborted uploads.
+  '''
+)
+parser.add_argument('-c', '--config', help='''
+  The server configuration file. Defaults to the fatartifacts_server_config
+  module.
+  '''
+)
+parser.add_argument('--dry-run', action='store_true', help='''
+  Only print the files that would be deleted.
+  '''
+)
+parser.add_argument('--min-age', type=float, default=3600, help='''
+  Never delete files that were modified less than this many seconds ago
+  (default: 3600).
+  '''
+)
+parser.add_argument('--upload-max-age', type=float, default=7 * 24 * 3600, help='''
+  Delete chunked uploads that were not written to for this many seconds
+  (default: 604800, one week).
+  '''
+)
+parser.add_argument('--rate', type=float, default=50, help='''
+  The maximum number of files deleted per second, 0 for no limit
+  (default: 50).
+  '''
+)
+parser.add_argument('--batch-size', type=int, default=500, help='''
+  The number of files that are looked up in the database at once
+  (default: 500).
+  '''
+)
+parser.add_argument('--interval', type=float, help='''
+  Run the garbage collector every this many seconds instead of once.
+  '''
+)
+
+
+def load_config(filename=None):
+  if not filename:
+    import fatartifacts_server_config
+    return fatartifacts_server_config
+  spec = importlib.util.spec_from_file_location('fatartifacts_server_config', filename)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+def main(argv=None):
+  args = parser.parse_args(argv)
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+  config = load_config(args.config)
+  gc = GarbageCollector(config.database, config.storage, min_age=args.min_age,
+                        rate=args.rate or None, batch_size=args.batch_size,
+                        dry_run=args.dry_run, upload_max_age=args.upload_max_age)
+  while True:
+    try:
+      stats = gc.run()
+    except NotImplementedError as exc:
+      print('error:', exc)
+      return 1
+    for key, value in stats.asdict().items():
+      print('{:16} {}'.format(key, value))
+    if args.interval is None:
+      return 0
+    time.sleep(args.interval)
+
+
+def main_and_exit(argv=None):
+  sys.exit(main(argv))
+
+
+if __name__ == '__main__':
+  main_and_exit()
@@ -0,0 +1,458 @@
+"""
+A small in-process metrics registry. Counters, gauges and histograms are
+kept in memory and exported in the Prometheus text format by the `/metrics`
+route of the REST-Api, so no external service is needed to collect them.
+
+    from fatartifacts.metrics import Registry
+    metrics = Registry()
+    requests = metrics.counter('myapp_requests_total', 'Handled requests.', ['route'])
+    requests.labels('info').inc()
+    print(metrics.expose())
+
+The #fatartifacts.database.instrumented.InstrumentedDatabase and
+#fatartifacts.storage.instrumented.InstrumentedStorage layers time the
+calls to the database and storage with the #timed() decorators.
+"""
+
+from typing import *
+import bisect
+import collections
+import functools
+import math
+import threading
+import time
+
+# The default buckets of histograms, in seconds. They range from the
+# duration of a cached lookup to the duration of a large upload.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def format_value(value) -> str:
+  if isinstance(value, int):
+    return str(value)
+  if math.isinf(value):
+    return '+Inf' if value > 0 else '-Inf'
+  if math.isnan(value):
+    return 'NaN'
+  return repr(float(value))
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+  if not names:
+    return ''
+  escape = lambda x: str(x).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+  return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in zip(names, values)) + '}'
+
+
+class Metric(object):
+  """
+  Base class for metrics. A metric with *labels* has a child for every
+  combination of label values, which is returned by #labels(). A metric
+  without labels is used directly.
+  """
+
+  type = None
+
+  def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+    self.name = name
+    self.help = help
+    self.label_names = tuple(labels)
+    self._children = {}
+    self._lock = threading.Lock()
+
+  def labels(self, *values):
+    """
+    Returns the child for the label *values*, which must be specified in
+    the order of the metric's label names.
+    """
+
+    child = self._children.get(values)
+    if child is None:
+      if len(values) != len(self.label_names):
+        raise ValueError('{} expects labels {}, got {!r}'.format(
+          self.name, self.label_names, values))
+      with self._lock:
+        child = self._children.get(values)
+        if child is None:
+          child = self._children[values] = self._new_child()
+    return child
+
+  def _new_child(self):
+    raise NotImplementedError
+
+  def _samples(self, child) -> Iterable[Tuple[str, Tuple[str, ...], Tuple, Any]]:
+    """
+    Yields the samples of a *child* as tuples of the sample name suffix,
+    additional label names and values, and the value.
+    """
+
+    yield '', (), (), child.value
+
+  def expose(self) -> Iterable[str]:
+    """
+    Yields the lines of the metric in the Prometheus text format.
+    """
+
+    yield '# HELP {} {}'.format(self.name, self.help.replace('\\', '\\\\').replace('\n', '\\n'))
+    yield '# TYPE {} {}'.format(self.name, self.type)
+    with self._lock:
+      children = list(self._children.items())
+    for values, child in children:
+      for suffix, names, extra, value in self._samples(child):
+        labels = format_labels(self.label_names + names, values + extra)
+        yield '{}{}{} {}'.format(self.name, suffix, labels, format_value(value))
+
+
+class _Value(object):
+
+  __slots__ = ('value', '_lock')
+
+  def __init__(self):
+    self.value = 0
+    self._lock = threading.Lock()
+
+  def inc(self, amount=1):
+    with self._lock:
+      self.value += amount
+
+  def dec(self, amount=1):
+    with self._lock:
+      self.value -= amount
+
+  def set(self, value):
+    self.value = value
+
+
+class Counter(Metric):
+  """
+  A value that only increases, eg. the number of handled requests.
+  """
+
+  type = 'counter'
+
+  def _new_child(self):
+    return _Value()
+
+  def inc(self, amount=1):
+    self.labels().inc(amount)
+
+
+class Gauge(Metric):
+  """
+  A value that can increase and decrease, eg. the number of requests that
+  are currently handled.
+  """
+
+  type = 'gauge'
+
+  def _new_child(self):
+    return _Value()
+
+  def inc(self, amount=1):
+    self.labels().inc(amount)
+
+  def dec(self, amount=1):
+    self.labels().dec(amount)
+
+  def set(self, value):
+    self.labels().set(value)
+
+
+class _HistogramValue(object):
+
+  __slots__ = ('buckets', 'counts', 'sum', '_lock')
+
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+    self._lock = threading.Lock()
+
+  def observe(self, value):
+    index = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      self.counts[index] += 1
+      self.sum += value
+
+
+class Histogram(Metric):
+  """
+  Counts observations (eg. request durations) in cumulative *buckets*, and
+  their sum and count.
+  """
+
+  type = 'histogram'
+
+  def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    super().__init__(name, help, labels)
+    self.buckets = tuple(sorted(buckets))
+    if 'le' in self.label_names:
+      raise ValueError('"le" is reserved for the buckets of histograms')
+
+  def _new_child(self):
+    return _HistogramValue(self.buckets)
+
+  def observe(self, value):
+    self.labels().observe(value)
+
+  def _samples(self, child):
+    with child._lock:
+      counts, total = list(child.counts), child.sum
+    cumulative = 0
+    for bound, count in zip(self.buckets + (float('inf'),), counts):
+      cumulative += count
+      yield '_bucket', ('le',), (format_value(float(bound)),), cumulative
+    yield '_sum', (), (), total
+    yield '_count', (), (), cumulative
+
+
+class CallbackMetric(Metric):
+  """
+  A metric whose values are read from other objects when it is exposed,
+  eg. the hit counter of a cache. *func* returns the value, or a
+  dictionary that maps the tuples of label values to values if the metric
+  has *labels*.
+  """
+
+  def __init__(self, name, help, type, func, labels=()):
+    super().__init__(name, help, labels)
+    self.type = type
+    self.func = func
+
+  def expose(self):
+    result = self.func()
+    if not self.label_names:
+      result = {(): result}
+    yield '# HELP {} {}'.format(self.name, self.help.replace('\\', '\\\\').replace('\n', '\\n'))
+    yield '# TYPE {} {}'.format(self.name, self.type)
+    for values, value in result.items():
+      if value is not None:
+        labels = format_labels(self.label_names, values)
+        yield '{}{} {}'.format(self.name, labels, format_value(value))
+
+
+class Registry(object):
+  """
+  A collection of metrics. The `counter()`, `gauge()` and `histogram()`
+  methods return the existing metric if one with the same name has already
+  been created, thus layers that are instantiated more than once share
+  their metrics.
+  """
+
+  def __init__(self):
+    self._metrics = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def _get_or_create(self, cls, name, *args, **kwargs):
+    with self._lock:
+      metric = self._metrics.get(name)
+      if metric is None:
+        metric = self._metrics[name] = cls(name, *args, **kwargs)
+      elif type(metric) is not cls:
+        raise ValueError('metric {!r} is a {}'.format(name, type(metric).__name__))
+      return metric
+
+  def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+    return self._get_or_create(Counter, name, help, labels)
+
+  def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+    return self._get_or_create(Gauge, name, help, labels)
+
+  def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return self._get_or_create(Histogram, name, help, labels, buckets)
+
+  def callback(self, name: str, help: str, type: str, func: Callable,
+               labels: Sequence[str] = ()) -> CallbackMetric:
+    """
+    Registers a #CallbackMetric, replacing an existing one with the same
+    name.
+    """
+
+    metric = CallbackMetric(name, help, type, func, labels)
+    with self._lock:
+      self._metrics[name] = metric
+    return metric
+
+  def expose(self) -> str:
+    """
+    Returns all metrics in the Prometheus text format (version 0.0.4).
+    """
+
+    with self._lock:
+      metrics = list(self._metrics.values())
+    lines = []
+    for metric in metrics:
+      lines.extend(metric.expose())
+    lines.append('')
+    return '\n'.join(lines)
+
+
+# The content type of #Registry.expose().
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class CallMetrics(object):
+  """
+  The metrics of an instrumented layer: a histogram of the duration of
+  calls by method, and a counter of the exceptions raised by method and
+  exception type. The metric names start with *prefix* (eg.
+  `fatartifacts_storage`).
+  """
+
+  def __init__(self, registry: Registry, prefix: str, subject: str):
+    self.duration = registry.histogram(
+      prefix + '_call_duration_seconds',
+      'Duration of calls to the {} methods.'.format(subject), ['method'])
+    self.errors = registry.counter(
+      prefix + '_call_errors_total',
+      'Exceptions raised by the {} methods.'.format(subject), ['method', 'error'])
+
+
+def timed(func):
+  """
+  Decorator for the methods of an instrumented layer. The layer must have a
+  #CallMetrics `metrics` member, in which the calls are observed under the
+  name of the method.
+  """
+
+  name = func.__name__
+
+  @functools.wraps(func)
+  def wrapper(self, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+      return func(self, *args, **kwargs)
+    except Exception as exc:
+      self.metrics.errors.labels(name, type(exc).__name__).inc()
+      raise
+    finally:
+      self.metrics.duration.labels(name).observe(time.perf_counter() - start)
+  return wrapper
+
+
+def timed_iter(func):
+  """
+  Like #timed(), but for methods that return an iterator (eg. the lazy
+  query results of #Database.list_objects()). The time spent in the
+  iterator is included, and the call is observed once the iterator is
+  exhausted or closed. Exceptions raised by the call itself are raised
+  immediately, like without the decorator.
+  """
+
+  name = func.__name__
+
+  @functools.wraps(func)
+  def wrapper(self, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+      iterator = iter(func(self, *args, **kwargs))
+    except Exception as exc:
+      self.metrics.errors.labels(name, type(exc).__name__).inc()
+      self.metrics.duration.labels(name).observe(time.perf_counter() - start)
+      raise
+    return _timed_iterator(self.metrics, name, iterator, time.perf_counter() - start)
+  return wrapper
+
+
+def _timed_iterator(metrics, name, iterator, elapsed):
+  try:
+    while True:
+      start = time.perf_counter()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      finally:
+        elapsed += time.perf_counter() - start
+      yield item
+  except Exception as exc:
+    metrics.errors.labels(name, type(exc).__name__).inc()
+    raise
+  finally:
+    close = getattr(iterator, 'close', None)
+    if close is not None:
+      close()
+    metrics.duration.labels(name).observe(elapsed)
+
+
+class HttpMetrics(object):
+  """
+  The metrics of the REST-Api routes, see #get_http_metrics().
+  """
+
+  def __init__(self, registry: Registry):
+    self.duration = registry.histogram(
+      'fatartifacts_http_request_duration_seconds',
+      'Duration of requests, until the response was sent.',
+      ['route', 'method', 'status'])
+    self.received = registry.counter(
+      'fatartifacts_http_received_bytes_total',
+      'Bytes received in request bodies.', ['route'])
+    self.sent = registry.counter(
+      'fatartifacts_http_sent_bytes_total',
+      'Bytes sent in response bodies.', ['route'])
+    self.in_flight = registry.gauge(
+      'fatartifacts_http_requests_in_flight',
+      'Requests that are currently being handled.')
+
+  def finish(self, route: str, method: str, status: int, seconds: float,
+             received: int, sent: int):
+    """
+    Records a request that was started with `in_flight.inc()`.
+    """
+
+    self.in_flight.dec()
+    self.duration.labels(route, method, str(status)).observe(seconds)
+    if received:
+      self.received.labels(route).inc(received)
+    if sent:
+      self.sent.labels(route).inc(sent)
+
+
+@functools.lru_cache(maxsize=None)
+def get_http_metrics(registry: Registry) -> HttpMetrics:
+  """
+  Returns the #HttpMetrics in the *registry*, creating them only once.
+  """
+
+  return HttpMetrics(registry)
+
+
+def register_cache_metrics(registry: Registry, database, name='database'):
+  """
+  Exposes the hits, misses and size of the cache of a
+  #fatartifacts.database.cache.CachingDatabase, labeled with *name*.
+  """
+
+  cache = database.cache
+  for metric, help, type, func in [
+      ('hits_total', 'Cache hits.', 'counter', lambda: cache.hits),
+      ('misses_total', 'Cache misses.', 'counter', lambda: cache.misses),
+      ('entries', 'Cached entries.', 'gauge', lambda: len(cache))]:
+    registry.callback('fatartifacts_cache_' + metric, help, type,
+                      lambda func=func: {(name,): func()}, ['cache'])
+
+
+def register_gc_metrics(registry: Registry, collector):
+  """
+  Exposes the #fatartifacts.gc.GcStats of the last run of a
+  #fatartifacts.gc.GarbageCollector that runs in the background.
+  """
+
+  def get(field):
+    stats = collector.last_stats
+    return getattr(stats, field) if stats is not None else None
+  for field, help in [
+      ('scanned', 'Files listed from the storage'),
+      ('orphans', 'Unreferenced files found'),
+      ('temporaries', 'Stale temporary files found'),
+      ('uploads', 'Abandoned chunked uploads found'),
+      ('deleted', 'Files deleted'),
+      ('failed', 'Files that could not be deleted'),
+      ('bytes_reclaimed', 'Size of the deleted files'),
+      ('duration', 'Duration in seconds')]:
+    registry.callback('fatartifacts_gc_last_run_' + field,
+                      help + ' by the last garbage collection run.', 'gauge',
+                      functools.partial(get, field))
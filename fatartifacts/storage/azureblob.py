@@ -7,7 +7,15 @@ from fatartifacts.utils.io import ThreadedRWIO
 from nr.concurrency import Job
 import azure.common
 import azure.storage.blob
+import azure.storage.blob.models
+import base64
+import collections
+import concurrent.futures
+import datetime
+import json
 import string
+import time
+import urllib.parse
 import uuid
 import threading
 import werkzeug.utils
@@ -24,6 +32,9 @@ class AzureWriteStream(base.WriteStream):
     content_length: The maximum content length.
   """
 
+  # #ThreadedRWIO.write() copies buffers.
+  accepts_buffer = True
+
   def __init__(self, job, fp, content_length):
     self._job = job
     self._fp = fp
@@ -66,35 +77,390 @@ class AzureWriteStream(base.WriteStream):
     return self._fp.write(data)
 
 
+class AzureBlockWriteStream(base.WriteStream):
+  """
+  A #base.WriteStream that splits the data into blocks of *block_size* bytes
+  and uploads them concurrently with `put_block()` using up to *concurrency*
+  connections. Closing the stream commits the block list to the blob, thus
+  the blob does not change until the upload is complete. Aborting the
+  stream leaves the uncommitted blocks to Azure's garbage collection.
+
+  The number of blocks that are buffered or in flight is bounded, so the
+  memory used by the stream is at most `(concurrency + 1) * block_size`.
+
+  The block IDs consist of the 32 character *id_prefix* (a random UUID by
+  default) and the index of the block.
+  """
+
+  accepts_buffer = True
+
+  def __init__(self, service, container, blob_name, content_length,
+               block_size, concurrency, id_prefix=None):
+    self._service = service
+    self._container = container
+    self._blob_name = blob_name
+    self._content_length = content_length
+    self._block_size = block_size
+    self._executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+    self._semaphore = threading.BoundedSemaphore(concurrency)
+    self._id_prefix = id_prefix or uuid.uuid4().hex
+    self._buffer = bytearray()
+    self._block_ids = []
+    self._futures = []
+    self._error = None
+    self._bytes_written = 0
+    self._aborted = False
+    self._closed = False
+
+  def _put_block(self, block_id, data):
+    try:
+      if self._error is None:
+        self._service.put_block(self._container, self._blob_name, data, block_id)
+    except BaseException as exc:
+      self._error = self._error or exc
+    finally:
+      self._semaphore.release()
+
+  def _submit(self, data):
+    block_id = make_block_id(self._id_prefix, len(self._block_ids))
+    self._block_ids.append(block_id)
+    self._semaphore.acquire()
+    if self._error is not None:
+      self._semaphore.release()
+      raise self._error
+    self._futures.append(self._executor.submit(self._put_block, block_id, data))
+
+  def abort(self):
+    if self._closed and not self._aborted:
+      raise RuntimeError('WriteStream already closed, can no longer abort')
+    self._closed = True
+    self._aborted = True
+    for future in self._futures:
+      future.cancel()
+    self._executor.shutdown(wait=True)
+
+  def close(self):
+    if self._closed:
+      return
+    self._closed = True
+    try:
+      if self._buffer:
+        self._submit(bytes(self._buffer))
+        self._buffer = bytearray()
+      concurrent.futures.wait(self._futures)
+      if self._error is not None:
+        raise self._error
+      self._commit()
+    except:
+      self._aborted = True
+      for future in self._futures:
+        future.cancel()
+      raise
+    finally:
+      self._executor.shutdown(wait=True)
+
+  def _commit(self):
+    block_list = [azure.storage.blob.models.BlobBlock(id=x) for x in self._block_ids]
+    self._service.put_block_list(self._container, self._blob_name, block_list)
+
+  def write(self, data):
+    if self._closed:
+      raise RuntimeError('WriteStream already closed')
+    if self._bytes_written + len(data) > self._content_length:
+      raise base.WriteOverflow()
+    self._bytes_written += len(data)
+    self._buffer += data
+    if len(self._buffer) >= self._block_size:
+      # Copy every complete block out of the buffer only once.
+      end = len(self._buffer) - len(self._buffer) % self._block_size
+      with memoryview(self._buffer) as view:
+        for offset in range(0, end, self._block_size):
+          self._submit(view[offset:offset + self._block_size].tobytes())
+      del self._buffer[:end]
+    return len(data)
+
+
+def make_block_id(prefix, index):
+  # Azure requires all block IDs of a blob to have the same length.
+  block_id = '{}-{:08d}'.format(prefix, index)
+  return base64.b64encode(block_id.encode('ascii')).decode('ascii')
+
+
+class AzureChunkWriteStream(AzureBlockWriteStream):
+  """
+  Stages a chunk of an #AzureChunkedUpload as uncommitted blocks of the
+  target blob. The blocks are only committed with the whole upload.
+  """
+
+  def __init__(self, upload, index):
+    storage = upload.storage
+    super().__init__(storage.service, storage.container, upload.blob_name,
+      upload.chunk_length(index), storage.upload_block_size,
+      storage.upload_connections, upload.block_id_prefix(index))
+    self._upload = upload
+
+  def close(self):
+    # An incomplete chunk must not overwrite the blocks of a previous
+    # attempt that may have been complete.
+    if not self._closed and self._bytes_written != self._content_length:
+      self.abort()
+      raise base.IncompleteUpload('received {} of {} bytes of the chunk'
+                                  .format(self._bytes_written, self._content_length))
+    super().close()
+
+  def _commit(self):
+    self._upload.touch()
+
+
+class AzureChunkedUpload(base.ChunkedUpload):
+  """
+  A #base.ChunkedUpload that stages the chunks as uncommitted blocks of the
+  target blob, split into blocks of the storage's `upload_block_size`.
+  Comitting the upload commits the block list of all chunks, thus the data
+  is never copied. The upload's state is kept in a small blob in `tmp/`,
+  and a chunk is received if all of its blocks exist with the expected
+  size.
+
+  Note that comitting another upload to the same blob discards the staged
+  blocks, the chunks then need to be written again. Uncommitted blocks of
+  aborted uploads are removed by Azure after a week.
+  """
+
+  def __init__(self, storage, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.storage = storage
+    self.blob_name = storage.blob_name(self.location, self.filename)
+
+  @staticmethod
+  def state_blob_name(upload_id):
+    return 'tmp/upload-' + upload_id + '.json'
+
+  def block_id_prefix(self, index):
+    # Block IDs must have the same length as those of #AzureBlockWriteStream.
+    return '{}{:08d}'.format(self.id[:24], index)
+
+  def _block_lengths(self, index):
+    length, block_size = self.chunk_length(index), self.storage.upload_block_size
+    return [min(block_size, length - i) for i in range(0, length, block_size)]
+
+  def touch(self):
+    # Updates the state blob's modification time, so that the garbage
+    # collector does not remove uploads that are still in progress.
+    self.storage.service.set_blob_metadata(self.storage.container,
+      self.state_blob_name(self.id), {'touched': str(int(time.time()))})
+
+  def open_chunk(self, index):
+    return AzureChunkWriteStream(self, index)
+
+  def get_chunks(self):
+    service, container = self.storage.service, self.storage.container
+    try:
+      blocks = service.get_block_list(container, self.blob_name,
+        block_list_type=azure.storage.blob.models.BlockListType.Uncommitted).uncommitted_blocks
+    except azure.common.AzureMissingResourceHttpError:
+      blocks = []
+    sizes = {}
+    prefix = self.id[:24]
+    for block in blocks:
+      try:
+        block_id = base64.b64decode(block.id).decode('ascii')
+      except (ValueError, UnicodeDecodeError):
+        continue
+      if block_id.startswith(prefix) and len(block_id) == 41:
+        sizes[block_id[24:32], block_id[33:]] = block.size
+    received = set()
+    for index in range(self.num_chunks):
+      lengths = self._block_lengths(index)
+      if all(sizes.get(('{:08d}'.format(index), '{:08d}'.format(i))) == length
+             for i, length in enumerate(lengths)):
+        received.add(index)
+    return received
+
+  def commit(self, algorithms=()):
+    missing = self.get_missing_chunks()
+    if missing:
+      raise base.IncompleteUpload('{} of {} chunks are missing'
+                                  .format(len(missing), self.num_chunks))
+    block_list = [
+      azure.storage.blob.models.BlobBlock(id=make_block_id(self.block_id_prefix(index), i))
+      for index in range(self.num_chunks)
+      for i in range(len(self._block_lengths(index)))]
+    self.storage.service.put_block_list(self.storage.container, self.blob_name, block_list)
+    self.abort()
+    if not algorithms:
+      return {}
+    fp, size = self.storage.open_read_file(self.location, self.filename, self.uri)
+    try:
+      return base.hash_file(fp, algorithms)
+    finally:
+      fp.close()
+
+  def abort(self):
+    try:
+      self.storage.service.delete_blob(self.storage.container, self.state_blob_name(self.id))
+    except azure.common.AzureMissingResourceHttpError:
+      pass
+
+
+class AzureReadStream(object):
+  """
+  A readonly file-like object that downloads *length* bytes of a blob
+  starting at *offset*. The data is fetched in ranges of *range_size* bytes
+  with up to *concurrency* concurrent requests. At most *prefetch* ranges
+  are downloaded ahead of the reader, which bounds the memory used by the
+  stream to `prefetch * range_size` bytes. The ranges are returned in order.
+  """
+
+  def __init__(self, service, container, blob_name, offset, length,
+               range_size, concurrency, prefetch):
+    self._service = service
+    self._container = container
+    self._blob_name = blob_name
+    self._next_offset = offset
+    self._end = offset + length
+    self._range_size = range_size
+    self._prefetch = max(prefetch, 1)
+    self._executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+    self._futures = collections.deque()
+    self._current = memoryview(b'')
+    self._closed = False
+    self._fill()
+
+  def _fetch(self, start, end):
+    blob = self._service.get_blob_to_bytes(
+      self._container, self._blob_name, start_range=start, end_range=end - 1)
+    if len(blob.content) != end - start:
+      raise IOError('expected {} bytes in range {}-{} of blob {!r}, got {}'
+        .format(end - start, start, end - 1, self._blob_name, len(blob.content)))
+    return blob.content
+
+  def _fill(self):
+    while len(self._futures) < self._prefetch and self._next_offset < self._end:
+      start = self._next_offset
+      end = min(start + self._range_size, self._end)
+      self._futures.append(self._executor.submit(self._fetch, start, end))
+      self._next_offset = end
+
+  def read(self, num_bytes=None):
+    if self._closed:
+      raise ValueError('read from closed stream')
+    if num_bytes is None or num_bytes < 0:
+      return b''.join(iter(lambda: self.read(self._range_size), b''))
+    if not self._current:
+      if not self._futures:
+        return b''
+      self._current = memoryview(self._futures.popleft().result())
+      self._fill()
+    data = self._current[:num_bytes]
+    self._current = self._current[num_bytes:]
+    return data.tobytes()
+
+  def seekable(self):
+    return False
+
+  def readable(self):
+    return True
+
+  def writable(self):
+    return False
+
+  @property
+  def closed(self):
+    return self._closed
+
+  def close(self):
+    if not self._closed:
+      self._closed = True
+      for future in self._futures:
+        future.cancel()
+      self._futures.clear()
+      self._executor.shutdown(wait=False)
+
+
 class AzureBlobStorage(base.Storage):
   """
   An implementation of the #base.Storage interface that communicates with
   an Azure Blob Storage service.
 
+  If the *service* supports block blobs, uploads are split into blocks of
+  *upload_block_size* bytes that are uploaded concurrently with up to
+  *upload_connections* connections and committed directly to the target
+  blob (see #AzureBlockWriteStream). Otherwise, or if *upload_block_size*
+  is #None, the upload is streamed into a temporary blob with a single
+  request and copied to the target blob when it is complete.
+
+  Downloads are performed with concurrent range requests of
+  *download_range_size* bytes using up to *download_connections*
+  connections, downloading at most *download_prefetch* ranges ahead of the
+  reader (see #AzureReadStream).
+
+  #delete_files() deletes the blobs with up to *delete_connections*
+  concurrent requests.
+
+  Chunked uploads are supported with a block blob service (see
+  #AzureChunkedUpload).
+
   Args:
-    blob_s
+    container: The name of the blob container.
+    service: The blob service object.
+    upload_block_size: The block size for block blob uploads.
+    upload_connections: The maximum number of concurrent block uploads
+      per file.
+    download_range_size: The size of the ranges requested for downloads.
+    download_connections: The maximum number of concurrent range requests
+      per download.
+    download_prefetch: The maximum number of ranges buffered per download.
+    delete_connections: The maximum number of concurrent requests when
+      deleting many blobs.
   """
 
   supported_chars = frozenset(string.ascii_letters + string.digits + '.-_/@')
 
+  # The maximum amount of data buffered in memory for uploads that are
+  # streamed with a single request.
+  upload_buffer_size = 4 * 1024 * 1024
+
+  # The maximum number of blocks in a blob.
+  max_blocks = 50000
+
+  # Keyword arguments of the `with_*_service()` class methods that are
+  # passed to the constructor instead of the service.
+  options = ('upload_block_size', 'upload_connections', 'download_range_size',
+             'download_connections', 'download_prefetch', 'delete_connections')
+
   @classmethod
   def with_block_blob_service(cls, container, *args, **kwargs):
+    options = {k: kwargs.pop(k) for k in cls.options if k in kwargs}
     service = azure.storage.blob.BlockBlobService(*args, **kwargs)
-    return cls(container, service)
+    return cls(container, service, **options)
 
   @classmethod
   def with_page_blob_service(cls, container, *args, **kwargs):
+    options = {k: kwargs.pop(k) for k in cls.options if k in kwargs}
     service = azure.storage.blob.PageBlobService(*args, **kwargs)
-    return cls(container, service)
+    return cls(container, service, **options)
 
   @classmethod
   def with_append_blob_service(cls, container, *args, **kwargs):
+    options = {k: kwargs.pop(k) for k in cls.options if k in kwargs}
     service = azure.storage.blob.AppendBlobService(*args, **kwargs)
-    return cls(container, service)
+    return cls(container, service, **options)
 
-  def __init__(self, container, service):
+  def __init__(self, container, service, upload_block_size=8*1024*1024,
+               upload_connections=4, download_range_size=4*1024*1024,
+               download_connections=4, download_prefetch=8, delete_connections=16):
+    if upload_connections < 1:
+      raise ValueError('upload_connections must be at least 1')
+    if download_connections < 1:
+      raise ValueError('download_connections must be at least 1')
     self.service = service
     self.container = container
+    self.upload_block_size = upload_block_size
+    self.upload_connections = upload_connections
+    self.download_range_size = download_range_size
+    self.download_connections = download_connections
+    self.download_prefetch = max(download_prefetch, download_connections)
+    self.delete_connections = delete_connections
 
   def blob_name(self, location, filename):
     # Since / is the directory separator on Azure but we support / in the
@@ -122,17 +488,29 @@ class AzureBlobStorage(base.Storage):
     if not self.supports_location(location):
       raise base.UnsupportedLocation(location)
 
+    if self.upload_block_size and hasattr(self.service, 'put_block_list'):
+      blob_name = self.blob_name(location, filename)
+      blob_url = self.service.make_blob_url(self.container, blob_name)
+      stream = AzureBlockWriteStream(self.service, self.container, blob_name,
+        content_length, self.upload_block_size, self.upload_connections)
+      return stream, blob_url
+
     # We write to a temporary blob and only copy to the actual blob
     # when the AzureWriteStream is closed successfully.
     temp_name = self.temporary_blob_name()
     blob_name = self.blob_name(location, filename)
     temp_url = self.service.make_blob_url(self.container, temp_name)
     blob_url = self.service.make_blob_url(self.container, blob_name)
-    fp = ThreadedRWIO()
+    fp = ThreadedRWIO(max_buffer=self.upload_buffer_size)
     awstream = None
 
     def worker():
-      self.service.create_blob_from_stream(self.container, temp_name, stream=fp)
+      try:
+        self.service.create_blob_from_stream(self.container, temp_name, stream=fp)
+      except BaseException as exc:
+        # Unblock the writer, it would otherwise wait for us to read forever.
+        fp.set_exception(exc)
+        raise
       awstream.wait_until_closed()
       if not awstream.aborted:
         self.service.copy_blob(self.container, blob_name, temp_url)
@@ -142,7 +520,55 @@ class AzureBlobStorage(base.Storage):
     awstream = AzureWriteStream(job, fp, content_length)
     return awstream, blob_url
 
+  def create_chunked_upload(self, location, filename, size, chunk_size, data):
+    if not self.upload_block_size or not hasattr(self.service, 'put_block_list'):
+      return super().create_chunked_upload(location, filename, size, chunk_size, data)
+    if not self.supports_location(location):
+      raise base.UnsupportedLocation(location)
+    upload_id = uuid.uuid4().hex
+    blob_url = self.service.make_blob_url(self.container, self.blob_name(location, filename))
+    upload = AzureChunkedUpload(self, upload_id, location, filename, blob_url,
+                                size, chunk_size, data)
+    # All chunks but the last one have the same number of blocks.
+    num_blocks = 0
+    if size:
+      last = upload.num_chunks - 1
+      num_blocks = last * len(upload._block_lengths(0)) + len(upload._block_lengths(last))
+    if num_blocks > self.max_blocks:
+      raise ValueError('the upload would need {} blocks, at most {} are supported'
+                       .format(num_blocks, self.max_blocks))
+    state = {'location': str(location), 'filename': filename, 'size': size,
+             'chunkSize': chunk_size, 'data': data}
+    self.service.create_blob_from_bytes(self.container,
+      upload.state_blob_name(upload_id), json.dumps(state).encode('utf8'))
+    return upload
+
+  def open_chunked_upload(self, upload_id):
+    if not hasattr(self.service, 'put_block_list'):
+      return super().open_chunked_upload(upload_id)
+    try:
+      blob = self.service.get_blob_to_bytes(
+        self.container, AzureChunkedUpload.state_blob_name(upload_id))
+    except azure.common.AzureMissingResourceHttpError:
+      raise base.UploadDoesNotExist(upload_id)
+    state = json.loads(blob.content.decode('utf8'))
+    location = base.Location(state['location'])
+    blob_url = self.service.make_blob_url(
+      self.container, self.blob_name(location, state['filename']))
+    return AzureChunkedUpload(self, upload_id, location, state['filename'],
+      blob_url, state['size'], state['chunkSize'], state['data'])
+
   def open_read_file(self, location, filename, uri):
+    size = self.get_file_size(location, filename, uri)
+    return self.open_read_range(location, filename, uri, 0, size), size
+
+  def open_read_range(self, location, filename, uri, offset, length):
+    blob_name = self.blob_name(location, filename)
+    return AzureReadStream(self.service, self.container, blob_name, offset,
+      length, self.download_range_size, self.download_connections,
+      self.download_prefetch)
+
+  def get_file_size(self, location, filename, uri):
     blob_name = self.blob_name(location, filename)
     try:
       props = self.service.get_blob_properties(
@@ -151,15 +577,7 @@ class AzureBlobStorage(base.Storage):
       raise base.FileDoesNotExist(location)
     except azure.common.AzureMissingResourceHttpError as e:
       raise base.PermissionError(e)
-    fp = ThreadedRWIO()
-    def worker():
-      try:
-        return self.service.get_blob_to_stream(
-            self.container, blob_name, stream=fp, max_connections=1)
-      finally:
-        fp.close()
-    job = Job(worker).start()
-    return fp, props.content_length
+    return props.content_length
 
   def delete_file(self, location, filename, uri):
     blob_name = self.blob_name(location, filename)
@@ -167,3 +585,40 @@ class AzureBlobStorage(base.Storage):
       self.service.delete_blob(self.container, blob_name)
     except azure.common.AzureMissingResourceHttpError:
       raise base.FileDoesNotExist(location)
+
+  def delete_files(self, files):
+    return base.delete_files_concurrently(self.delete_file, files, self.delete_connections)
+
+  def list_files(self):
+    for prefix in ('data/', 'tmp/'):
+      for blob in self.service.list_blobs(self.container, prefix=prefix):
+        temporary = prefix == 'tmp/'
+        uri = None if temporary else self.service.make_blob_url(self.container, blob.name)
+        props = blob.properties
+        upload = blob.name.startswith('tmp/upload-')
+        yield base.StoredFile(blob.name, uri, props.content_length,
+                              props.last_modified.timestamp(), temporary, upload)
+
+  def get_uri_prefix(self):
+    return self.service.make_blob_url(self.container, 'data/')
+
+  def normalize_uri(self, uri):
+    # Blobs are read by their name, the URI is only recorded. Thus any URL
+    # of a blob in the container (eg. with a custom domain) refers to it.
+    path = urllib.parse.unquote(urllib.parse.urlparse(uri).path)
+    prefix = '/' + self.container + '/'
+    if not path.startswith(prefix):
+      return None
+    return path[len(prefix):]
+
+  def delete_stored_file(self, file):
+    last_modified = datetime.datetime.fromtimestamp(file.mtime, datetime.timezone.utc)
+    try:
+      self.service.delete_blob(self.container, file.name, if_unmodified_since=last_modified)
+    except azure.common.AzureMissingResourceHttpError:
+      raise base.FileDoesNotExist(file.name)
+    except azure.common.AzureHttpError as exc:
+      if exc.status_code == 412:  # Precondition Failed, modified since listed
+        return False
+      raise
+    return True
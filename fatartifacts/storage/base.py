@@ -3,9 +3,13 @@ Artifact-storage abstraction layer.
 """
 
 from fatartifacts.database.base import Location
+from fatartifacts.utils.io import LimitedReader
+from fatartifacts.utils.types import NamedObject
 from typing import *
 from typing import BinaryIO
 import abc
+import concurrent.futures
+import hashlib
 
 
 class WriteOverflow(Exception):
@@ -30,6 +34,26 @@ class FileDoesNotExist(Exception):
     return str(self.location)
 
 
+class UploadDoesNotExist(Exception):
+  """
+  Raised by #Storage.open_chunked_upload() if there is no #ChunkedUpload
+  with the specified ID (eg. because it has been comitted or aborted).
+  """
+
+  def __init__(self, upload_id):
+    self.upload_id = upload_id
+
+  def __str__(self):
+    return str(self.upload_id)
+
+
+class IncompleteUpload(Exception):
+  """
+  Raised by #ChunkedUpload.commit() if chunks are missing, and when the
+  #WriteStream of a chunk is closed before the whole chunk was written.
+  """
+
+
 class UnsupportedLocation(Exception):
   """
   Raised when a database #Location is not supported by the #Storage interface.
@@ -59,6 +83,16 @@ class WriteStream(metaclass=abc.ABCMeta):
   or #close() otherwise.
   """
 
+  # #True if #write() does not keep a reference to the data after it
+  # returned, thus the caller may pass a #memoryview of a buffer that it
+  # reuses for the next write (see #fatartifacts.utils.io.copy_stream()).
+  accepts_buffer = False
+
+  # The #hashlib objects by algorithm name that the stream updates with all
+  # data written to it (eg. to address the file by its digest). Read-only,
+  # a #HashingWriteStream reuses them instead of hashing the data again.
+  hashers = {}
+
   def __enter__(self):
     pass
 
@@ -95,6 +129,184 @@ class WriteStream(metaclass=abc.ABCMeta):
     raise NotImplementedError
 
 
+class HashingWriteStream(WriteStream):
+  """
+  Wraps a #WriteStream and computes the digests of the data that is written
+  to it with the hashlib *algorithms* (eg. `'sha256'`), thus the data does
+  not need to be read back from the storage to verify it. Digests that the
+  wrapped stream computes anyway (see #WriteStream.hashers) are reused.
+  """
+
+  def __init__(self, stream: WriteStream, algorithms: Iterable[str]):
+    self.stream = stream
+    self.hashers = {}
+    self._own_hashers = []
+    for algorithm in algorithms:
+      hasher = stream.hashers.get(algorithm)
+      if hasher is None:
+        hasher = hashlib.new(algorithm)
+        self._own_hashers.append(hasher)
+      self.hashers[algorithm] = hasher
+
+  @property
+  def accepts_buffer(self):
+    return self.stream.accepts_buffer
+
+  def abort(self):
+    self.stream.abort()
+
+  def close(self):
+    self.stream.close()
+
+  def write(self, data):
+    written = self.stream.write(data)
+    for hasher in self._own_hashers:
+      hasher.update(data)
+    return written
+
+  def get_digest(self, algorithm: str) -> str:
+    """
+    Returns the digest of the data written so far in the format
+    `<algorithm>:<hexdigest>`.
+    """
+
+    return algorithm + ':' + self.hashers[algorithm].hexdigest()
+
+
+def hash_file(fp: BinaryIO, algorithms: Iterable[str]) -> Dict[str, str]:
+  """
+  Reads the file-like object *fp* to its end and returns its digests with
+  the hashlib *algorithms* like #ChunkedUpload.commit().
+  """
+
+  hashers = {x: hashlib.new(x) for x in algorithms}
+  if hashers:
+    for data in iter(lambda: fp.read(1024 * 1024), b''):
+      for hasher in hashers.values():
+        hasher.update(data)
+  return {k: k + ':' + v.hexdigest() for k, v in hashers.items()}
+
+
+class ChunkedUpload(metaclass=abc.ABCMeta):
+  """
+  A resumable upload of a file of *size* bytes in numbered chunks of
+  *chunk_size* bytes (only the last chunk may be shorter). Chunks can be
+  written in any order, concurrently and from different processes, and a
+  chunk whose transfer failed can simply be written again. The file is only
+  created at *uri* when the upload is comitted.
+
+  Uploads are created with #Storage.create_chunked_upload() and resumed by
+  their #id with #Storage.open_chunked_upload(). The storage keeps the
+  upload's state, including the JSON object *data* that the creator of the
+  upload can store with it.
+  """
+
+  def __init__(self, id: str, location: Location, filename: str, uri: str,
+               size: int, chunk_size: int, data: dict):
+    self.id = id
+    self.location = location
+    self.filename = filename
+    self.uri = uri
+    self.size = size
+    self.chunk_size = chunk_size
+    self.data = data
+
+  @property
+  def num_chunks(self) -> int:
+    return -(-self.size // self.chunk_size)
+
+  def chunk_length(self, index: int) -> int:
+    """
+    Returns the number of bytes of the chunk with the specified *index*.
+    Raises an #IndexError if the upload has no such chunk.
+    """
+
+    if index < 0 or index >= self.num_chunks:
+      raise IndexError('chunk index out of range')
+    return min(self.chunk_size, self.size - index * self.chunk_size)
+
+  def get_missing_chunks(self) -> List[int]:
+    """
+    Returns the sorted indices of the chunks that have not been received.
+    """
+
+    received = self.get_chunks()
+    return [x for x in range(self.num_chunks) if x not in received]
+
+  @abc.abstractmethod
+  def open_chunk(self, index: int) -> WriteStream:
+    """
+    Opens the chunk with the specified *index* for writing. Exactly
+    #chunk_length() bytes must be written to the stream, otherwise closing
+    it raises an #IncompleteUpload error. The chunk is only received when
+    the stream is closed.
+
+    Raises:
+      IndexError: If the upload has no such chunk.
+    """
+
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def get_chunks(self) -> Set[int]:
+    """
+    Returns the indices of the chunks that have been received.
+    """
+
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def commit(self, algorithms: Iterable[str] = ()) -> Dict[str, str]:
+    """
+    Assembles the chunks into the file at #uri and removes the upload.
+    Returns the digests of the file with the hashlib *algorithms* in the
+    format `<algorithm>:<hexdigest>`, by algorithm. As the chunks arrive in
+    any order, computing them requires reading the file once more (see
+    #hash_file()).
+
+    Raises:
+      IncompleteUpload: If chunks are missing.
+    """
+
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def abort(self):
+    """
+    Removes the upload and the chunks that have been received.
+    """
+
+    raise NotImplementedError
+
+
+class StoredFile(NamedObject):
+  """
+  Represents a file in a #Storage as returned by #Storage.list_files().
+  """
+
+  # The storage's name for the file (eg. a path or a blob name).
+  name: str
+
+  # The URI of the file as returned by #Storage.open_write_file(), or #None
+  # for temporary files.
+  uri: Optional[str]
+
+  # The size of the file in bytes.
+  size: int
+
+  # The time the file was last modified as a UNIX timestamp.
+  mtime: float
+
+  # #True if the file is the temporary file of an upload that has not been
+  # comitted (yet).
+  temporary: bool = False
+
+  # #True if the file holds the state or data of a #ChunkedUpload. Such
+  # uploads can be resumed, thus they are kept longer than other temporary
+  # files. Implies #temporary.
+  upload: bool = False
+
+
 class Storage(metaclass=abc.ABCMeta):
   """
   The storage interface allows to place a file for a specific database
@@ -148,6 +360,85 @@ class Storage(metaclass=abc.ABCMeta):
 
     raise NotImplementedError
 
+  def open_read_range(self,
+      location:Location, filename:str, uri:str, offset:int, length:int)\
+      -> BinaryIO:
+    """
+    Open a file at the specified *location* for reading *length* bytes
+    starting at *offset*. The caller must ensure that the range is inside
+    the file. The default implementation opens the file with
+    #open_read_file() and skips the data before *offset*. Implementations
+    should override this method if they can seek efficiently.
+
+    Raises:
+      FileDoesNotExist: If the file does not exist.
+    Returns:
+      A readonly file-like object that yields the data in the range.
+    """
+
+    fp, size = self.open_read_file(location, filename, uri)
+    try:
+      while offset > 0:
+        data = fp.read(min(offset, 64 * 1024))
+        if not data:
+          break
+        offset -= len(data)
+    except:
+      fp.close()
+      raise
+    return LimitedReader(fp, length)
+
+  def create_chunked_upload(self, location:Location, filename:str, size:int,
+                            chunk_size:int, data:dict) -> ChunkedUpload:
+    """
+    Creates a #ChunkedUpload for a file of *size* bytes at the specified
+    *location*. Storages that do not support chunked uploads raise a
+    #NotImplementedError.
+
+    Raises:
+      UnsupportedLocation: If the #Location is not supported by the storage.
+      ValueError: If the storage can not stage that many chunks.
+    """
+
+    raise NotImplementedError('{} does not support chunked uploads'
+                              .format(type(self).__name__))
+
+  def open_chunked_upload(self, upload_id:str) -> ChunkedUpload:
+    """
+    Opens a #ChunkedUpload created with #create_chunked_upload(), possibly
+    by another process.
+
+    Raises:
+      UploadDoesNotExist: If there is no upload with the specified ID.
+    """
+
+    raise NotImplementedError('{} does not support chunked uploads'
+                              .format(type(self).__name__))
+
+  def get_file_size(self, location:Location, filename:str, uri:str) -> int:
+    """
+    Returns the size of the file at the specified *location*. The default
+    implementation opens the file with #open_read_file().
+
+    Raises:
+      FileDoesNotExist: If the file does not exist.
+    """
+
+    fp, size = self.open_read_file(location, filename, uri)
+    fp.close()
+    return size
+
+  def get_local_path(self, location:Location, filename:str, uri:str) -> Optional[str]:
+    """
+    Returns the path of the file on the local filesystem if the storage keeps
+    files there, otherwise #None. This allows the web server to hand off file
+    downloads to the operating system or a frontend server, so the file never
+    needs to pass through the Python interpreter. The default implementation
+    returns #None.
+    """
+
+    return None
+
   @abc.abstractmethod
   def delete_file(self, location:Location, filename:str, uri:str):
     """
@@ -158,3 +449,89 @@ class Storage(metaclass=abc.ABCMeta):
     """
 
     raise NotImplementedError
+
+  def list_files(self) -> Iterable[StoredFile]:
+    """
+    Lists all files in the storage, including the temporary files of
+    uploads, in no particular order. This is used by the garbage collector
+    (see #fatartifacts.gc) to find files that are not referenced by any
+    object. Storages that do not support listing raise a
+    #NotImplementedError.
+    """
+
+    raise NotImplementedError('{} does not support listing files'
+                              .format(type(self).__name__))
+
+  def get_uri_prefix(self) -> Optional[str]:
+    """
+    Returns the prefix of all URIs that #open_write_file() returns with the
+    current configuration of the storage, or #None if the storage does not
+    know it. The garbage collector uses it to find objects whose URI was
+    stored with a different spelling (eg. before the storage directory was
+    moved), see #normalize_uri().
+    """
+
+    return None
+
+  def normalize_uri(self, uri: str) -> Optional[str]:
+    """
+    Returns a spelling of the *uri* that is the same for all URIs that refer
+    to the same file (eg. the real path of a file), or #None if the storage
+    can not tell which file the *uri* refers to. The default implementation
+    returns the *uri* unchanged.
+    """
+
+    return uri
+
+  def delete_stored_file(self, file: StoredFile) -> bool:
+    """
+    Deletes a *file* returned by #list_files(), unless it has been modified
+    since it was listed. Returns #True if the file was deleted.
+
+    Raises:
+      FileDoesNotExist: If the file does not exist.
+    """
+
+    raise NotImplementedError('{} does not support listing files'
+                              .format(type(self).__name__))
+
+  def delete_files(self, files: Sequence[Tuple[Location, str, str]])\
+      -> List[Optional[Exception]]:
+    """
+    Deletes many files, specified as tuples of *location*, *filename* and
+    *uri* like the arguments of #delete_file(). Returns a list with an entry
+    for every file, which is #None if the file was deleted or the exception
+    that was raised when deleting it (eg. #FileDoesNotExist). The default
+    implementation calls #delete_file() for one file after another.
+    """
+
+    return [_call(self.delete_file, args) for args in files]
+
+
+def _call(func, args) -> Optional[Exception]:
+  try:
+    func(*args)
+  except Exception as exc:
+    return exc
+  return None
+
+
+def delete_files_concurrently(delete_file, files, max_workers) -> List[Optional[Exception]]:
+  """
+  An implementation of #Storage.delete_files() that calls *delete_file*
+  for the *files* from a pool of *max_workers* threads. Storages where
+  deleting a file waits for I/O (eg. a network request) can use it.
+  """
+
+  def delete_all(files):
+    return [_call(delete_file, args) for args in files]
+
+  files = list(files)
+  if max_workers <= 1 or len(files) <= 1:
+    return delete_all(files)
+  # Every worker gets a contiguous slice, a future per file would cost
+  # more than deleting a local file.
+  size = -(-len(files) // max_workers)
+  slices = [files[i:i + size] for i in range(0, len(files), size)]
+  with concurrent.futures.ThreadPoolExecutor(len(slices)) as executor:
+    return [x for result in executor.map(delete_all, slices) for x in result]
@@ -0,0 +1,346 @@
+"""
+Content-addressed storage layer that deduplicates identical files.
+"""
+
+from fatartifacts.database.base import Location
+from fatartifacts.storage import base
+import contextlib
+import hashlib
+import sqlite3
+import uuid
+
+
+class CasWriteStream(base.WriteStream):
+  """
+  Writes to a #base.WriteStream of the backend storage while computing the
+  digest of the data. When the stream is closed and a blob with the same
+  digest already exists, the backend stream is aborted and the existing blob
+  is referenced instead.
+  """
+
+  def __init__(self, storage, uri, stream, blob_location, blob_uri):
+    self._storage = storage
+    self._uri = uri
+    self._stream = stream
+    self._blob_location = blob_location
+    self._blob_uri = blob_uri
+    self.hashers = {storage.algorithm: hashlib.new(storage.algorithm)}
+    self._size = 0
+    self._aborted = False
+    self._closed = False
+
+  @property
+  def accepts_buffer(self):
+    return self._stream.accepts_buffer
+
+  def abort(self):
+    if self._closed and not self._aborted:
+      raise RuntimeError('WriteStream already closed, can no longer abort')
+    self._closed = True
+    self._aborted = True
+    self._stream.abort()
+
+  def close(self):
+    if self._closed:
+      return
+    self._closed = True
+    try:
+      algorithm = self._storage.algorithm
+      digest = algorithm + ':' + self.hashers[algorithm].hexdigest()
+      self._storage._commit(self._uri, digest, self._size, self._stream,
+                            self._blob_location, self._blob_uri)
+    except:
+      self._aborted = True
+      raise
+
+  def write(self, data):
+    if self._closed:
+      raise RuntimeError('WriteStream already closed')
+    written = self._stream.write(data)
+    self.hashers[self._storage.algorithm].update(data)
+    self._size += len(data)
+    return written
+
+
+class CasChunkedUpload(base.ChunkedUpload):
+  """
+  Wraps the #base.ChunkedUpload of the backend storage that stages the
+  blob. The chunks arrive in any order, thus the digest can only be
+  computed when the upload is comitted, by reading the blob back from the
+  backend. Then the blob is deduplicated like with a #CasWriteStream.
+  """
+
+  def __init__(self, storage, upload, location, filename, data):
+    super().__init__(upload.id, location, filename, storage.make_uri(location, filename),
+                     upload.size, upload.chunk_size, data)
+    self._storage = storage
+    self._upload = upload
+
+  def open_chunk(self, index):
+    return self._upload.open_chunk(index)
+
+  def get_chunks(self):
+    return self._upload.get_chunks()
+
+  def commit(self, algorithms=()):
+    upload, storage = self._upload, self._storage
+    upload.commit()
+    fp, size = storage.backend.open_read_file(upload.location, upload.filename, upload.uri)
+    try:
+      digests = base.hash_file(fp, set(algorithms) | {storage.algorithm})
+    finally:
+      fp.close()
+    storage._commit(self.uri, digests[storage.algorithm], size,
+                    _StagedBlob(storage, upload), upload.location, upload.uri)
+    return {x: digests[x] for x in algorithms}
+
+  def abort(self):
+    self._upload.abort()
+
+
+class _StagedBlob(object):
+  """
+  Takes the place of the backend's #base.WriteStream in
+  #ContentAddressedStorage._commit() for a blob that has already been
+  comitted by a #CasChunkedUpload. Aborting it deletes the blob.
+  """
+
+  def __init__(self, storage, upload):
+    self._storage = storage
+    self._upload = upload
+
+  def abort(self):
+    self._storage._delete_blob((str(self._upload.location), self._upload.uri))
+
+  def close(self):
+    pass
+
+
+class ContentAddressedStorage(base.Storage):
+  """
+  A #base.Storage layer that stores every distinct file content only once
+  in the *backend* storage. The content is hashed while it is uploaded, and
+  if a blob with the same digest already exists, the upload is discarded
+  and the object references the existing blob. Blobs are reference counted
+  and are only deleted from the backend when the last object referencing
+  them is deleted.
+
+  Blobs are stored in the backend at the location `cas:<uuid>` (as the
+  digest is unknown when the upload starts). The mapping of object URIs to
+  digests and of digests to blobs is kept in an SQLite database at
+  *index_path*, which must be shared by all processes that use the storage.
+
+  The URIs returned by this storage have the form `cas://<location>`. They
+do not contain the filename as an object has exactly one file, thus an
+update of the object with a different filename replaces the reference of
+the previous file instead of adding another one.
+  """
+
+  blob_filename = 'blob'
+
+  def __init__(self, backend, index_path, algorithm='sha256'):
+    if algorithm not in hashlib.algorithms_available:
+      raise ValueError('unknown hash algorithm: {}'.format(algorithm))
+    self.backend = backend
+    self.index_path = index_path
+    self.algorithm = algorithm
+    with self._transaction() as db:
+      db.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+          digest TEXT PRIMARY KEY,
+          location TEXT NOT NULL,
+          uri TEXT NOT NULL,
+          size INTEGER NOT NULL,
+          refs INTEGER NOT NULL)''')
+      db.execute('''
+        CREATE TABLE IF NOT EXISTS files (
+          uri TEXT PRIMARY KEY,
+          digest TEXT NOT NULL REFERENCES blobs (digest))''')
+
+  @contextlib.contextmanager
+  def _transaction(self):
+    db = sqlite3.connect(self.index_path, timeout=60, isolation_level=None)
+    try:
+      db.execute('BEGIN IMMEDIATE')
+      try:
+        yield db
+      except:
+        db.execute('ROLLBACK')
+        raise
+      else:
+        db.execute('COMMIT')
+    finally:
+      db.close()
+
+  def _unref(self, db, digest):
+    """
+    Decrements the reference count of the blob with the specified *digest*.
+    Returns the blob's (location, uri) if it is no longer referenced and
+    needs to be deleted from the backend, otherwise #None.
+    """
+
+    db.execute('UPDATE blobs SET refs = refs - 1 WHERE digest = ?', (digest,))
+    row = db.execute('SELECT location, uri FROM blobs WHERE digest = ? AND refs <= 0',
+                     (digest,)).fetchone()
+    if row:
+      db.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+    return row
+
+  def _delete_blob(self, row):
+    location, uri = row
+    try:
+      self.backend.delete_file(Location(location), self.blob_filename, uri)
+    except base.FileDoesNotExist:
+      pass
+
+  def _link(self, db, uri, digest):
+    """
+    Associates the object *uri* with the blob with the specified *digest*,
+    which must exist, and takes a reference to it. Returns the blob that the
+    object referenced before like #_unref().
+    """
+
+    row = db.execute('SELECT digest FROM files WHERE uri = ?', (uri,)).fetchone()
+    old_digest = row[0] if row else None
+    if old_digest == digest:
+      return None
+    db.execute('UPDATE blobs SET refs = refs + 1 WHERE digest = ?', (digest,))
+    db.execute('INSERT OR REPLACE INTO files (uri, digest) VALUES (?, ?)', (uri, digest))
+    return self._unref(db, old_digest) if old_digest is not None else None
+
+  def _commit(self, uri, digest, size, stream, blob_location, blob_uri):
+    """
+    Called by #CasWriteStream.close() to commit the blob with the specified
+    *digest* and to associate it with the object *uri*.
+
+    The backend *stream* is closed outside of a transaction, as comitting it
+    can take long (eg. an fsync or comitting the blocks of a blob) and would
+    block all other writers of the index. If another upload comitted a blob
+    with the same digest in the meantime, the new blob is deleted again.
+    """
+
+    with self._transaction() as db:
+      exists = db.execute('SELECT 1 FROM blobs WHERE digest = ?', (digest,)).fetchone()
+      if exists:
+        orphans = [self._link(db, uri, digest)]
+    if exists:
+      stream.abort()
+    else:
+      stream.close()
+      with self._transaction() as db:
+        if db.execute('SELECT 1 FROM blobs WHERE digest = ?', (digest,)).fetchone():
+          orphans = [(str(blob_location), blob_uri)]
+        else:
+          orphans = []
+          db.execute('INSERT INTO blobs (digest, location, uri, size, refs) '
+                     'VALUES (?, ?, ?, ?, 0)', (digest, str(blob_location), blob_uri, size))
+        orphans.append(self._link(db, uri, digest))
+    for orphan in filter(None, orphans):
+      self._delete_blob(orphan)
+
+  def _get_blob(self, location, uri):
+    db = sqlite3.connect(self.index_path, timeout=60)
+    try:
+      row = db.execute('''
+        SELECT blobs.location, blobs.uri, blobs.size FROM files
+        JOIN blobs ON blobs.digest = files.digest WHERE files.uri = ?''',
+        (uri,)).fetchone()
+    finally:
+      db.close()
+    if not row:
+      raise base.FileDoesNotExist(location)
+    return Location(row[0]), row[1], row[2]
+
+  def get_digest(self, location:Location, filename:str, uri:str) -> str:
+    """
+    Returns the digest of the file in the format `<algorithm>:<hexdigest>`.
+    """
+
+    db = sqlite3.connect(self.index_path, timeout=60)
+    try:
+      row = db.execute('SELECT digest FROM files WHERE uri = ?', (uri,)).fetchone()
+    finally:
+      db.close()
+    if not row:
+      raise base.FileDoesNotExist(location)
+    return row[0]
+
+  def supports_location(self, location):
+    return self.backend.supports_location(location)
+
+  def make_uri(self, location, filename):
+    return 'cas://{}'.format(location)
+
+  def open_write_file(self, location, filename, content_length):
+    if not self.supports_location(location):
+      raise base.UnsupportedLocation(location)
+    uri = self.make_uri(location, filename)
+    blob_location = Location(['cas', str(uuid.uuid4())])
+    stream, blob_uri = self.backend.open_write_file(
+      blob_location, self.blob_filename, content_length)
+    return CasWriteStream(self, uri, stream, blob_location, blob_uri), uri
+
+  def create_chunked_upload(self, location, filename, size, chunk_size, data):
+    if not self.supports_location(location):
+      raise base.UnsupportedLocation(location)
+    blob_location = Location(['cas', str(uuid.uuid4())])
+    state = {'cas': {'location': str(location), 'filename': filename}, 'data': data}
+    upload = self.backend.create_chunked_upload(
+      blob_location, self.blob_filename, size, chunk_size, state)
+    return CasChunkedUpload(self, upload, location, filename, data)
+
+  def open_chunked_upload(self, upload_id):
+    upload = self.backend.open_chunked_upload(upload_id)
+    if 'cas' not in upload.data:
+      raise base.UploadDoesNotExist(upload_id)
+    state = upload.data['cas']
+    return CasChunkedUpload(self, upload, Location(state['location']),
+                            state['filename'], upload.data['data'])
+
+  def open_read_file(self, location, filename, uri):
+    blob_location, blob_uri, size = self._get_blob(location, uri)
+    return self.backend.open_read_file(blob_location, self.blob_filename, blob_uri)
+
+  def open_read_range(self, location, filename, uri, offset, length):
+    blob_location, blob_uri, size = self._get_blob(location, uri)
+    return self.backend.open_read_range(
+      blob_location, self.blob_filename, blob_uri, offset, length)
+
+  def get_file_size(self, location, filename, uri):
+    return self._get_blob(location, uri)[2]
+
+  def get_local_path(self, location, filename, uri):
+    blob_location, blob_uri, size = self._get_blob(location, uri)
+    return self.backend.get_local_path(blob_location, self.blob_filename, blob_uri)
+
+  def delete_file(self, location, filename, uri):
+    with self._transaction() as db:
+      row = db.execute('SELECT digest FROM files WHERE uri = ?', (uri,)).fetchone()
+      if not row:
+        raise base.FileDoesNotExist(location)
+      db.execute('DELETE FROM files WHERE uri = ?', (uri,))
+      orphan = self._unref(db, row[0])
+    if orphan:
+      self._delete_blob(orphan)
+
+  def delete_files(self, files):
+    # Unreference all files in a single transaction, then delete the blobs
+    # that are no longer referenced with the backend's #delete_files().
+    errors = []
+    orphans = []
+    with self._transaction() as db:
+      for location, filename, uri in files:
+        row = db.execute('SELECT digest FROM files WHERE uri = ?', (uri,)).fetchone()
+        if not row:
+          errors.append(base.FileDoesNotExist(location))
+          continue
+        db.execute('DELETE FROM files WHERE uri = ?', (uri,))
+        orphan = self._unref(db, row[0])
+        if orphan:
+          orphans.append((len(errors), orphan))
+        errors.append(None)
+    blobs = [(Location(location), self.blob_filename, uri) for _, (location, uri) in orphans]
+    for (index, _), exc in zip(orphans, self.backend.delete_files(blobs)):
+      if not isinstance(exc, base.FileDoesNotExist):
+        errors[index] = exc
+    return errors
@@ -3,10 +3,14 @@ Local file-system storage implementation.
 """
 
 from fatartifacts.storage import base
+from fatartifacts.utils.io import LimitedReader
+import json
 import os
+import re
 import shutil
 import string
 import tempfile
+import uuid
 import werkzeug.utils
 
 
@@ -15,14 +19,32 @@ class FsWriteStream(base.WriteStream):
   Wrapper for a file on the filesystem. Writes to a temporary file first. Only
   when the WriteStream is closed without exception will the temporary file be
   renamed to the target filename.
+
+  The temporary file is created in the same directory as the target file,
+  thus it lives on the same device and can be atomically swapped with the
+  target using #os.replace().
+
+  The *fsync* parameter controls the durability of the file when it is
+  comitted. It can be `'none'`, `'file'` (flush the file's data to the disk
+  before it is renamed) or `'file+dir'` (also flush the directory after the
+  rename).
   """
 
-  def __init__(self, filename, content_length, create_dir=True):
+  fsync_policies = ('none', 'file', 'file+dir')
+  temp_prefix = '.upload-'
+  temp_suffix = '.part'
+  accepts_buffer = True
+
+  def __init__(self, filename, content_length, create_dir=True, fsync='none'):
+    if fsync not in self.fsync_policies:
+      raise ValueError('invalid fsync policy: {!r}'.format(fsync))
     self._filename = filename
-    # XXX ensure temporary file is created on the same device as the output
-    #     filename so we can use #os.rename() instead of #shutil.move().
-    self._tempfile = tempfile.NamedTemporaryFile(delete=False)
-    self._create_dir = create_dir
+    self._fsync = fsync
+    if create_dir:
+      os.makedirs(os.path.dirname(filename), exist_ok=True)
+    self._tempfile = tempfile.NamedTemporaryFile(
+      dir=os.path.dirname(filename), prefix=self.temp_prefix,
+      suffix=self.temp_suffix, delete=False)
     self._aborted = False
     self._closed = False
     self._content_length = content_length
@@ -43,21 +65,22 @@ class FsWriteStream(base.WriteStream):
     if self._closed:
       return
     self._closed = True
-    self._tempfile.close()
     try:
-      if self._create_dir:
-        os.makedirs(os.path.dirname(self._filename), exist_ok=True)
-      try:
-        os.remove(self._filename)
-      except FileNotFoundError:
-        pass
-      # XXX Ensure atomic file swap?
-      shutil.move(self._tempfile.name, self._filename)
-    finally:
+      if self._fsync != 'none':
+        self._tempfile.flush()
+        os.fsync(self._tempfile.fileno())
+      self._tempfile.close()
+      os.replace(self._tempfile.name, self._filename)
+      if self._fsync == 'file+dir':
+        fsync_dir(os.path.dirname(self._filename))
+    except:
+      self._aborted = True
+      self._tempfile.close()
       try:
         os.remove(self._tempfile.name)
       except FileNotFoundError:
         pass
+      raise
 
   def write(self, data):
     if self._bytes_written + len(data) > self._content_length:
@@ -69,15 +92,212 @@ class FsWriteStream(base.WriteStream):
     return written
 
 
+def fsync_dir(directory):
+  """
+  Flushes the directory entries of *directory* to the disk. This is a no-op
+  on platforms that can not open directories (eg. Windows).
+  """
+
+  try:
+    fd = os.open(directory, os.O_RDONLY)
+  except (OSError, AttributeError):
+    return
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+class FsChunkWriteStream(base.WriteStream):
+  """
+  Writes a chunk of a #FsChunkedUpload at its offset in the upload's data
+  file. The chunk is marked as received when the stream is closed after all
+  of its data was written.
+  """
+
+  accepts_buffer = True
+
+  def __init__(self, upload, index):
+    self._upload = upload
+    self._length = upload.chunk_length(index)
+    self._marker = upload.marker_path(index)
+    # The chunk is not received while it is written again.
+    try:
+      os.remove(self._marker)
+    except FileNotFoundError:
+      pass
+    try:
+      self._fd = os.open(upload.data_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    except FileNotFoundError:
+      raise base.UploadDoesNotExist(upload.id)
+    os.lseek(self._fd, index * upload.chunk_size, os.SEEK_SET)
+    self._bytes_written = 0
+    self._aborted = False
+    self._closed = False
+
+  def abort(self):
+    if self._closed and not self._aborted:
+      raise RuntimeError('WriteStream already closed, can no longer abort')
+    if not self._closed:
+      os.close(self._fd)
+    self._closed = True
+    self._aborted = True
+
+  def close(self):
+    if self._closed:
+      return
+    self._closed = True
+    try:
+      if self._bytes_written != self._length:
+        raise base.IncompleteUpload('received {} of {} bytes of the chunk'
+                                    .format(self._bytes_written, self._length))
+      if self._upload.fsync != 'none':
+        os.fsync(self._fd)
+    except:
+      self._aborted = True
+      raise
+    finally:
+      os.close(self._fd)
+    open(self._marker, 'wb').close()
+    if self._upload.fsync == 'file+dir':
+      fsync_dir(os.path.dirname(self._marker))
+
+  def write(self, data):
+    if self._closed:
+      raise RuntimeError('WriteStream already closed')
+    if self._bytes_written + len(data) > self._length:
+      raise base.WriteOverflow()
+    view = memoryview(data)
+    while view:
+      written = os.write(self._fd, view)
+      self._bytes_written += written
+      view = view[written:]
+    return len(data)
+
+
+class FsChunkedUpload(base.ChunkedUpload):
+  """
+  A #base.ChunkedUpload that is staged in its own *directory*. The chunks
+  are written directly to their offsets in a data file that has the size of
+  the whole file, thus comitting the upload only renames the data file to
+  the target file. Received chunks are marked with empty files.
+  """
+
+  state_filename = 'upload.json'
+  data_filename = 'data.part'
+  marker_prefix = 'chunk-'
+
+  def __init__(self, directory, fsync, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.directory = directory
+    self.fsync = fsync
+
+  @property
+  def data_path(self):
+    return os.path.join(self.directory, self.data_filename)
+
+  def marker_path(self, index):
+    return os.path.join(self.directory, self.marker_prefix + str(index))
+
+  @classmethod
+  def load(cls, directory, fsync, upload_id):
+    try:
+      with open(os.path.join(directory, cls.state_filename)) as fp:
+        state = json.load(fp)
+    except FileNotFoundError:
+      raise base.UploadDoesNotExist(upload_id)
+    return cls(directory, fsync, upload_id, base.Location(state['location']),
+               state['filename'], state['uri'], state['size'],
+               state['chunkSize'], state['data'])
+
+  def save(self):
+    # The state is written last and atomically, a directory without it is
+    # not a valid upload.
+    os.makedirs(self.directory)
+    with open(self.data_path, 'wb') as fp:
+      fp.truncate(self.size)
+    state = {'location': str(self.location), 'filename': self.filename,
+             'uri': self.uri, 'size': self.size, 'chunkSize': self.chunk_size,
+             'data': self.data}
+    path = os.path.join(self.directory, self.state_filename)
+    with open(path + '.tmp', 'w') as fp:
+      json.dump(state, fp)
+    os.replace(path + '.tmp', path)
+
+  def open_chunk(self, index):
+    return FsChunkWriteStream(self, index)
+
+  def get_chunks(self):
+    prefix = self.marker_prefix
+    try:
+      return {int(x[len(prefix):]) for x in os.listdir(self.directory) if x.startswith(prefix)}
+    except FileNotFoundError:
+      raise base.UploadDoesNotExist(self.id)
+
+  def commit(self, algorithms=()):
+    missing = self.get_missing_chunks()
+    if missing:
+      raise base.IncompleteUpload('{} of {} chunks are missing'
+                                  .format(len(missing), self.num_chunks))
+    # Hashed before it is renamed, thus a failed read does not replace the
+    # target file.
+    try:
+      with open(self.data_path, 'rb') as fp:
+        digests = base.hash_file(fp, algorithms)
+    except FileNotFoundError:
+      raise base.UploadDoesNotExist(self.id)
+    path = self.uri[7:]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+      os.replace(self.data_path, path)
+    except FileNotFoundError:
+      raise base.UploadDoesNotExist(self.id)
+    if self.fsync == 'file+dir':
+      fsync_dir(os.path.dirname(path))
+    shutil.rmtree(self.directory, ignore_errors=True)
+    return digests
+
+  def abort(self):
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def get_upload_mtime(directory):
+  """
+  Returns the time a #FsChunkedUpload in *directory* was last written to.
+  """
+
+  mtime = os.stat(directory).st_mtime
+  try:
+    return max(mtime, os.stat(os.path.join(directory, FsChunkedUpload.data_filename)).st_mtime)
+  except FileNotFoundError:
+    return mtime
+
+
 class FsStorage(base.Storage):
   """
-  Stores files in a directory on the filesystem.
+  Stores files in a directory on the filesystem. Uploads are staged next to
+  their target file and comitted with an atomic rename. The *fsync* policy
+  is passed to #FsWriteStream. #delete_files() removes the files with up to
+  *delete_workers* threads.
+
+  Chunked uploads are staged in subdirectories of #uploads_dir (see
+  #FsChunkedUpload).
   """
 
   supported_chars = frozenset(string.ascii_letters + string.digits + '.-_/@')
 
-  def __init__(self, directory):
+  # Matches the directory and file names created by #mkpath().
+  _name_regex = re.compile(r'\d+-.')
+  _upload_id_regex = re.compile(r'[0-9a-f]{32}$')
+
+  uploads_dir = '.uploads'
+
+  def __init__(self, directory, fsync='none', delete_workers=8):
+    if fsync not in FsWriteStream.fsync_policies:
+      raise ValueError('invalid fsync policy: {!r}'.format(fsync))
     self.directory = directory
+    self.fsync = fsync
+    self.delete_workers = delete_workers
 
   def mkpath(self, location, filename):
     # We want to support / in location parts, so we need a way to avoid
@@ -108,7 +328,7 @@ class FsStorage(base.Storage):
 
   def open_write_file(self, location, filename, content_length):
     path = self.mkpath(location, filename)
-    return FsWriteStream(path, content_length), 'file://' + path
+    return FsWriteStream(path, content_length, fsync=self.fsync), 'file://' + path
 
   def open_read_file(self, location, filename, uri):
     path = self.getpath(location, filename, uri)
@@ -118,9 +338,115 @@ class FsStorage(base.Storage):
     except FileNotFoundError:
       raise base.FileDoesNotExist(location)
 
+  def open_read_range(self, location, filename, uri, offset, length):
+    path = self.getpath(location, filename, uri)
+    try:
+      fp = open(path, 'rb')
+    except FileNotFoundError:
+      raise base.FileDoesNotExist(location)
+    fp.seek(offset)
+    return LimitedReader(fp, length)
+
+  def get_file_size(self, location, filename, uri):
+    path = self.getpath(location, filename, uri)
+    try:
+      return os.stat(path).st_size
+    except FileNotFoundError:
+      raise base.FileDoesNotExist(location)
+
+  def get_local_path(self, location, filename, uri):
+    return self.getpath(location, filename, uri)
+
+  def create_chunked_upload(self, location, filename, size, chunk_size, data):
+    if not self.supports_location(location):
+      raise base.UnsupportedLocation(location)
+    upload_id = uuid.uuid4().hex
+    directory = os.path.join(self.directory, self.uploads_dir, upload_id)
+    uri = 'file://' + self.mkpath(location, filename)
+    upload = FsChunkedUpload(directory, self.fsync, upload_id, location,
+                             filename, uri, size, chunk_size, data)
+    upload.save()
+    return upload
+
+  def open_chunked_upload(self, upload_id):
+    if not self._upload_id_regex.match(upload_id):
+      raise base.UploadDoesNotExist(upload_id)
+    directory = os.path.join(self.directory, self.uploads_dir, upload_id)
+    return FsChunkedUpload.load(directory, self.fsync, upload_id)
+
   def delete_file(self, location, filename, uri):
     path = self.getpath(location, filename, uri)
     try:
       os.remove(path)
     except FileNotFoundError:
       raise base.FileDoesNotExist(location)
+
+  def delete_files(self, files):
+    return base.delete_files_concurrently(self.delete_file, files, self.delete_workers)
+
+  def list_files(self):
+    # Only files that are named like #mkpath() or #FsWriteStream names
+    # them, other files (eg. an SQLite database) may share the directory.
+    temp_prefix, temp_suffix = FsWriteStream.temp_prefix, FsWriteStream.temp_suffix
+    stack = [self.directory]
+    while stack:
+      try:
+        entries = list(os.scandir(stack.pop()))
+      except FileNotFoundError:
+        continue
+      for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+          if self._name_regex.match(entry.name):
+            stack.append(entry.path)
+          continue
+        temporary = entry.name.startswith(temp_prefix) and entry.name.endswith(temp_suffix)
+        if not temporary and not self._name_regex.match(entry.name):
+          continue
+        try:
+          stat = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+          continue
+        uri = None if temporary else 'file://' + entry.path
+        yield base.StoredFile(entry.path, uri, stat.st_size, stat.st_mtime, temporary)
+
+    # Chunked uploads are listed as one temporary file per upload directory.
+    try:
+      entries = list(os.scandir(os.path.join(self.directory, self.uploads_dir)))
+    except FileNotFoundError:
+      entries = []
+    for entry in entries:
+      if not entry.is_dir(follow_symlinks=False):
+        continue
+      try:
+        mtime = get_upload_mtime(entry.path)
+      except FileNotFoundError:
+        continue
+      try:
+        size = os.stat(os.path.join(entry.path, FsChunkedUpload.data_filename)).st_size
+      except FileNotFoundError:
+        size = 0
+      yield base.StoredFile(entry.path, None, size, mtime, True, upload=True)
+
+  def get_uri_prefix(self):
+    return 'file://' + os.path.join(self.directory, '')
+
+  def normalize_uri(self, uri):
+    # #getpath() serves URIs that deviate from #mkpath() as long as they
+    # are file:// URIs, eg. with a relative or symlinked directory.
+    if not uri.startswith('file://'):
+      return None
+    return 'file://' + os.path.realpath(uri[7:])
+
+  def delete_stored_file(self, file):
+    try:
+      if os.path.isdir(file.name):
+        if get_upload_mtime(file.name) != file.mtime:
+          return False
+        shutil.rmtree(file.name)
+        return True
+      if os.stat(file.name).st_mtime != file.mtime:
+        return False
+      os.remove(file.name)
+    except FileNotFoundError:
+      raise base.FileDoesNotExist(file.name)
+    return True
@@ -0,0 +1,105 @@
+"""
+A storage layer that records the duration of every call in a
+#fatartifacts.metrics.Registry.
+"""
+
+from fatartifacts import metrics
+from fatartifacts.storage import base
+
+
+class InstrumentedWriteStream(base.WriteStream):
+  """
+  Wraps the #base.WriteStream of an #InstrumentedStorage to time #close(),
+  which commits the file (eg. renames and flushes it, or commits the block
+  list of a blob).
+  """
+
+  def __init__(self, stream: base.WriteStream, metrics: metrics.CallMetrics):
+    self.stream = stream
+    self.metrics = metrics
+
+  @property
+  def accepts_buffer(self):
+    return self.stream.accepts_buffer
+
+  @property
+  def hashers(self):
+    return self.stream.hashers
+
+  def abort(self):
+    self.stream.abort()
+
+  @metrics.timed
+  def close(self):
+    self.stream.close()
+
+  def write(self, data):
+    return self.stream.write(data)
+
+
+class InstrumentedStorage(base.Storage):
+  """
+  A #base.Storage layer that times the calls to the wrapped *storage* by
+  method in the `fatartifacts_storage_call_duration_seconds` histogram of
+  the *registry*, and counts the exceptions they raise in
+  `fatartifacts_storage_call_errors_total`. Comitting a file by closing its
+  #base.WriteStream is recorded as `close`, and #list_files() is timed
+  until the listing has been consumed.
+  """
+
+  def __init__(self, storage: base.Storage, registry: metrics.Registry):
+    self.storage = storage
+    self.metrics = metrics.CallMetrics(registry, 'fatartifacts_storage', 'storage')
+
+  def supports_location(self, location):
+    return self.storage.supports_location(location)
+
+  @metrics.timed
+  def open_write_file(self, location, filename, content_length):
+    stream, uri = self.storage.open_write_file(location, filename, content_length)
+    return InstrumentedWriteStream(stream, self.metrics), uri
+
+  @metrics.timed
+  def open_read_file(self, location, filename, uri):
+    return self.storage.open_read_file(location, filename, uri)
+
+  @metrics.timed
+  def open_read_range(self, location, filename, uri, offset, length):
+    return self.storage.open_read_range(location, filename, uri, offset, length)
+
+  @metrics.timed
+  def create_chunked_upload(self, location, filename, size, chunk_size, data):
+    return self.storage.create_chunked_upload(location, filename, size, chunk_size, data)
+
+  @metrics.timed
+  def open_chunked_upload(self, upload_id):
+    return self.storage.open_chunked_upload(upload_id)
+
+  @metrics.timed
+  def get_file_size(self, location, filename, uri):
+    return self.storage.get_file_size(location, filename, uri)
+
+  def get_local_path(self, location, filename, uri):
+    return self.storage.get_local_path(location, filename, uri)
+
+  @metrics.timed
+  def delete_file(self, location, filename, uri):
+    return self.storage.delete_file(location, filename, uri)
+
+  @metrics.timed_iter
+  def list_files(self):
+    return self.storage.list_files()
+
+  def get_uri_prefix(self):
+    return self.storage.get_uri_prefix()
+
+  def normalize_uri(self, uri):
+    return self.storage.normalize_uri(uri)
+
+  @metrics.timed
+  def delete_stored_file(self, file):
+    return self.storage.delete_stored_file(file)
+
+  @metrics.timed
+  def delete_files(self, files):
+    return self.storage.delete_files(files)
@@ -0,0 +1,76 @@
+"""
+Adapters that expose the blocking file-like objects and streams of the
+storage layer to asyncio code. Every blocking call is run in an executor, so
+the event loop is only blocked for as long as it takes to submit the call.
+"""
+
+import asyncio
+
+
+class AsyncReader(object):
+  """
+  Wraps a readonly file-like object *fp* (eg. as returned by
+  #Storage.open_read_file()).
+  """
+
+  def __init__(self, fp, executor=None, loop=None):
+    self._fp = fp
+    self._executor = executor
+    self._loop = loop or asyncio.get_event_loop()
+
+  async def read(self, num_bytes=-1):
+    return await self._loop.run_in_executor(self._executor, self._fp.read, num_bytes)
+
+  async def close(self):
+    await self._loop.run_in_executor(self._executor, self._fp.close)
+
+  async def iter_chunks(self, chunk_size=64*1024):
+    while True:
+      data = await self.read(chunk_size)
+      if not data:
+        break
+      yield data
+
+  def __aiter__(self):
+    return self.iter_chunks()
+
+
+class AsyncWriteStream(object):
+  """
+  Wraps a #fatartifacts.storage.base.WriteStream.
+  """
+
+  def __init__(self, stream, executor=None, loop=None):
+    self.stream = stream
+    self._executor = executor
+    self._loop = loop or asyncio.get_event_loop()
+
+  async def write(self, data):
+    return await self._loop.run_in_executor(self._executor, self.stream.write, data)
+
+  async def close(self):
+    await self._loop.run_in_executor(self._executor, self.stream.close)
+
+  async def abort(self):
+    await self._loop.run_in_executor(self._executor, self.stream.abort)
+
+
+async def iterate_in_executor(iterable, executor=None, loop=None):
+  """
+  Iterates over a blocking *iterable* (eg. a generator that reads from a
+  file), fetching every item in the *executor*.
+  """
+
+  loop = loop or asyncio.get_event_loop()
+  iterator = iter(iterable)
+  sentinel = object()
+  try:
+    while True:
+      item = await loop.run_in_executor(executor, next, iterator, sentinel)
+      if item is sentinel:
+        break
+      yield item
+  finally:
+    close = getattr(iterator, 'close', None)
+    if close is not None:
+      await loop.run_in_executor(executor, close)
@@ -0,0 +1,91 @@
+"""
+A small thread-safe cache with a bounded size and an expiration time.
+"""
+
+from typing import *
+import collections
+import threading
+import time
+
+
+class TTLCache(object):
+  """
+  A mapping that holds at most *maxsize* entries, evicting the least
+  recently used entry when it is full. Entries expire *ttl* seconds after
+  they have been stored (never if *ttl* is #None).
+
+  The number of cache hits and misses of #get() are counted in the #hits
+  and #misses members.
+  """
+
+  def __init__(self, maxsize: int = 1024, ttl: float = None, clock=time.monotonic):
+    if maxsize <= 0:
+      raise ValueError('maxsize must be positive')
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.clock = clock
+    self.hits = 0
+    self.misses = 0
+    self._data = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._data)
+
+  def __contains__(self, key):
+    return self.get(key, NotImplemented, count=False) is not NotImplemented
+
+  def get(self, key, default=None, count=True):
+    """
+    Returns the value stored for *key*, or *default* if there is no such
+    entry or if it expired.
+    """
+
+    with self._lock:
+      entry = self._data.get(key)
+      if entry is not None and entry[1] is not None and entry[1] <= self.clock():
+        del self._data[key]
+        entry = None
+      if entry is None:
+        if count:
+          self.misses += 1
+        return default
+      self._data.move_to_end(key)
+      if count:
+        self.hits += 1
+      return entry[0]
+
+  def put(self, key, value, ttl: float = NotImplemented):
+    """
+    Stores *value* for *key*. The *ttl* defaults to the #ttl of the cache.
+    """
+
+    if ttl is NotImplemented:
+      ttl = self.ttl
+    expires = None if ttl is None else self.clock() + ttl
+    with self._lock:
+      self._data[key] = (value, expires)
+      self._data.move_to_end(key)
+      while len(self._data) > self.maxsize:
+        self._data.popitem(last=False)
+
+  def pop(self, key, default=None):
+    with self._lock:
+      entry = self._data.pop(key, None)
+    return default if entry is None else entry[0]
+
+  def pop_if(self, predicate: Callable[[Any], bool]) -> int:
+    """
+    Removes all entries whose key matches the *predicate*. Returns the
+    number of entries that were removed.
+    """
+
+    with self._lock:
+      keys = [k for k in self._data if predicate(k)]
+      for key in keys:
+        del self._data[key]
+    return len(keys)
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
@@ -8,50 +8,134 @@ class ThreadedRWIO(object):
   A file-like object that can be written from one thread and read from
   another. Allows piping data using #write() to another thread that uses
   #read() on the same file.
+
+  If *max_buffer* is specified, #write() blocks while that many bytes (or
+  characters) are buffered and not yet read, thus the memory used by the
+  pipe stays constant no matter how much data is passed through it.
+
+  In binary mode, the data is buffered as #memoryview objects, and reading
+  with #readinto() copies it only once, directly into the caller's buffer.
+
+  If either side fails, it can call #set_exception() which causes pending
+  and future calls to #read() and #write() on the other side to raise that
+  exception instead of blocking or silently ending the stream.
   """
 
-  def __init__(self, type=bytes):
+  def __init__(self, type=bytes, max_buffer=None):
     assert type in (bytes, str)
     self._type = type
+    self._max_buffer = max_buffer
     self._deque = collections.deque()
+    self._buffered = 0
     self._lock = threading.Lock()
     self._cond = threading.Condition(self._lock)
     self._write_closed = False
+    self._exception = None
     self._read_pos = 0
     self._write_pos = 0
 
+  def _wait_for_data(self):
+    # Must be called with the lock acquired. Returns False on EOF.
+    while not self._deque:
+      if self._exception is not None:
+        raise self._exception
+      if self._write_closed:
+        return False
+      self._cond.wait()
+    if self._exception is not None:
+      raise self._exception
+    return True
+
+  def _consumed(self, num_bytes):
+    # Must be called with the lock acquired.
+    self._buffered -= num_bytes
+    self._read_pos += num_bytes
+    self._cond.notify_all()
+
   def read(self, num_bytes=None):
     result = []
     bytes_read = 0
     with self._cond:
-      while num_bytes is None or bytes_read < num_bytes:
-        if not self._deque and self._write_closed:
+      while num_bytes is None or num_bytes < 0 or bytes_read < num_bytes:
+        if not self._wait_for_data():
           break
-        elif not self._deque:
-          self._cond.wait()  # wait for more data
-        else:
-          data = self._deque.popleft()
-          if num_bytes and len(data) > num_bytes - bytes_read:
-            delta = num_bytes - bytes_read
-            data, remainder = data[:delta], data[delta:]
-            self._deque.appendleft(remainder)
-          result.append(data)
-          bytes_read += len(data)
-    data = self._type().join(result)
-    self._read_pos += len(data)
-    return data
+        data = self._deque.popleft()
+        if num_bytes is not None and num_bytes >= 0 and len(data) > num_bytes - bytes_read:
+          delta = num_bytes - bytes_read
+          data, remainder = data[:delta], data[delta:]
+          self._deque.appendleft(remainder)
+        result.append(data)
+        bytes_read += len(data)
+        self._consumed(len(data))
+    if self._type is str:
+      return ''.join(result)
+    if len(result) == 1 and isinstance(result[0].obj, bytes) and \
+        len(result[0]) == len(result[0].obj):
+      return result[0].obj  # A complete chunk, no need to copy.
+    return b''.join(result)
+
+  def readinto(self, buffer):
+    """
+    Reads data directly into the writable *buffer* (eg. a #bytearray or
+    #memoryview). Blocks until at least one byte is available or the stream
+    was closed. Returns the number of bytes read (0 at the end of the
+    stream). Only available in binary mode.
+    """
+
+    if self._type is not bytes:
+      raise TypeError('readinto() requires binary mode')
+    buffer = memoryview(buffer).cast('B')
+    bytes_read = 0
+    with self._cond:
+      if not self._wait_for_data():
+        return 0
+      while self._deque and bytes_read < len(buffer):
+        data = self._deque.popleft()
+        count = min(len(data), len(buffer) - bytes_read)
+        buffer[bytes_read:bytes_read + count] = data[:count]
+        if count < len(data):
+          self._deque.appendleft(data[count:])
+        bytes_read += count
+        self._consumed(count)
+    return bytes_read
 
   def write(self, data):
+    if self._type is bytes and isinstance(data, (bytearray, memoryview)):
+      # The caller may reuse the buffer, so we need a copy.
+      data = bytes(data)
     if not isinstance(data, self._type):
       raise TypeError('expected {}, got {}'.format(self._type.__name__, type(data).__name__))
+    if not data:
+      return 0
+    if self._type is bytes:
+      data = memoryview(data)
     with self._cond:
-      if self._write_closed:
-        raise RuntimeError('writing is closed')
+      while True:
+        if self._exception is not None:
+          raise self._exception
+        if self._write_closed:
+          raise RuntimeError('writing is closed')
+        if self._max_buffer is None or self._buffered < self._max_buffer:
+          break
+        self._cond.wait()  # wait for the reader to catch up
       self._deque.append(data)
-      self._cond.notify()
-    self._write_pos += len(data)
+      self._buffered += len(data)
+      self._write_pos += len(data)
+      self._cond.notify_all()
     return len(data)
 
+  def set_exception(self, exc):
+    """
+    Sets an exception that will be raised by pending and future #read() and
+    #write() calls. Use this to propagate an error from one side of the
+    pipe to the other.
+    """
+
+    with self._cond:
+      if self._exception is None:
+        self._exception = exc
+      self._cond.notify_all()
+
   def seekable(self):
     return False
 
@@ -64,10 +148,82 @@ class ThreadedRWIO(object):
   def tell(self):
     return self._read_pos
 
+  @property
   def closed(self):
-    return False
+    return self._write_closed
 
   def close(self):
     with self._cond:
       self._write_closed = True
       self._cond.notify_all()
+
+
+class LimitedReader(object):
+  """
+  A readonly file-like object that reads at most *length* bytes from the
+  file-like object *fp*. Closing the #LimitedReader closes *fp*.
+  """
+
+  def __init__(self, fp, length):
+    self._fp = fp
+    self._remaining = length
+
+  def read(self, num_bytes=None):
+    if num_bytes is None or num_bytes < 0 or num_bytes > self._remaining:
+      num_bytes = self._remaining
+    if num_bytes == 0:
+      return b''
+    data = self._fp.read(num_bytes)
+    self._remaining -= len(data)
+    return data
+
+  def seekable(self):
+    return False
+
+  def readable(self):
+    return True
+
+  def writable(self):
+    return False
+
+  def close(self):
+    self._fp.close()
+
+
+def copy_stream(src, dst, length=None, buffer_size=1024 * 1024) -> int:
+  """
+  Copies *length* bytes (or everything until the end of the stream if it is
+  #None) from the file-like object *src* to *dst*, which is usually a
+  #fatartifacts.storage.base.WriteStream. Returns the number of bytes that
+  were copied, which is less than *length* if *src* ended early.
+
+  If *src* supports `readinto()`, all data is read into one preallocated
+  buffer of *buffer_size* bytes. If the `accepts_buffer` attribute of *dst*
+  is #True, it receives memoryviews of that buffer, otherwise a copy of
+  every chunk. Without `readinto()`, the chunks returned by `read()` are
+  passed to *dst* as they are.
+  """
+
+  remaining = float('inf') if length is None else length
+  copied = 0
+  readinto = getattr(src, 'readinto', None)
+  if readinto is None:
+    while remaining > 0:
+      data = src.read(min(remaining, buffer_size))
+      if not data:
+        break
+      dst.write(data)
+      copied += len(data)
+      remaining -= len(data)
+    return copied
+
+  view = memoryview(bytearray(min(remaining, buffer_size)))
+  accepts_buffer = getattr(dst, 'accepts_buffer', False)
+  while remaining > 0:
+    count = readinto(view if remaining >= len(view) else view[:remaining])
+    if not count:
+      break
+    dst.write(view[:count] if accepts_buffer else view[:count].tobytes())
+    copied += count
+    remaining -= count
+  return copied
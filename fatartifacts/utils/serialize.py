@@ -0,0 +1,159 @@
+"""
+JSON serialization with the fastest available backend. The backends produce
+the same output: compact separators, UTF-8 without escaping non-ASCII
+characters and ISO 8601 datetimes. All backends reject the non-standard
+constants `NaN`, `Infinity` and `-Infinity` when decoding, as they would
+otherwise be stored and encoded differently by every backend.
+
+The backend is selected when the module is imported, in the order of
+#BACKENDS, and can be changed with #set_backend().
+"""
+
+from typing import *
+import abc
+import datetime
+import json
+
+
+class Serializer(metaclass=abc.ABCMeta):
+
+  name: str = None
+
+  @abc.abstractmethod
+  def dumps(self, obj: Any) -> bytes:
+    """
+    Serializes *obj* to UTF-8 encoded JSON. #datetime.datetime and
+    #datetime.date objects are serialized as ISO 8601 strings.
+    """
+
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def loads(self, data: Union[bytes, str]) -> Any:
+    """
+    Deserializes the JSON document *data*. Raises a #ValueError if *data*
+    is not valid JSON or contains `NaN` or `(-)Infinity`.
+    """
+
+    raise NotImplementedError
+
+
+def _default(obj):
+  if isinstance(obj, (datetime.datetime, datetime.date)):
+    return obj.isoformat()
+  raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+def _reject_constant(name):
+  raise ValueError('invalid JSON constant: {}'.format(name))
+
+
+def _may_contain_constants(data):
+  if isinstance(data, bytes):
+    return b'NaN' in data or b'Infinity' in data
+  return 'NaN' in data or 'Infinity' in data
+
+
+class StdlibSerializer(Serializer):
+
+  name = 'json'
+
+  def __init__(self):
+    self._encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'),
+                                     default=_default)
+
+  def dumps(self, obj):
+    return self._encoder.encode(obj).encode('utf8')
+
+  def loads(self, data):
+    return json.loads(data, parse_constant=_reject_constant)
+
+
+class OrjsonSerializer(Serializer):
+  """
+  Uses the [orjson] library for encoding, falling back to the #json module
+  for objects that orjson can not encode (eg. integers beyond 64 bits).
+
+  Documents are decoded with the #json module, as orjson silently decodes
+  integers beyond 64 bits as floats, and ruling them out before decoding
+  with orjson costs more time than orjson saves.
+
+  [orjson]: https://github.com/ijl/orjson
+  """
+
+  name = 'orjson'
+
+  def __init__(self):
+    import orjson
+    self._orjson = orjson
+    self._fallback = StdlibSerializer()
+
+  def dumps(self, obj):
+    try:
+      return self._orjson.dumps(obj, default=_default)
+    except TypeError:
+      return self._fallback.dumps(obj)
+
+  def loads(self, data):
+    return self._fallback.loads(data)
+
+
+class UjsonSerializer(Serializer):
+  """
+  Uses the [ujson] library (version 5 or newer).
+
+  [ujson]: https://github.com/ultrajson/ultrajson
+  """
+
+  name = 'ujson'
+
+  def __init__(self):
+    import ujson
+    self._ujson = ujson
+
+  def dumps(self, obj):
+    return self._ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False,
+                             default=_default).encode('utf8')
+
+  def loads(self, data):
+    # ujson accepts the non-standard constants, documents that may contain
+    # them are decoded with the #json module, which rejects them.
+    if _may_contain_constants(data):
+      return StdlibSerializer().loads(data)
+    return self._ujson.loads(data)
+
+
+BACKENDS = [OrjsonSerializer, UjsonSerializer, StdlibSerializer]
+
+
+def get_serializer(name: str = None) -> Serializer:
+  """
+  Returns a #Serializer for the backend with the specified *name*, or for
+  the first backend in #BACKENDS that is available.
+  """
+
+  for cls in BACKENDS:
+    if name is not None and cls.name != name:
+      continue
+    try:
+      return cls()
+    except ImportError:
+      if name is not None:
+        raise
+  raise ValueError('unknown serializer backend: {!r}'.format(name))
+
+
+def set_backend(name: str):
+  global serializer
+  serializer = get_serializer(name)
+
+
+def dumps(obj: Any) -> bytes:
+  return serializer.dumps(obj)
+
+
+def loads(data: Union[bytes, str]) -> Any:
+  return serializer.loads(data)
+
+
+serializer = get_serializer()
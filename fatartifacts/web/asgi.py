@@ -0,0 +1,663 @@
+"""
+An asyncio implementation of the REST-Api as an ASGI application. It serves
+the same routes as the #rest Blueprint, but uploads and downloads are
+streamed on the event loop, so a slow client only costs a coroutine instead
+of a worker thread. The blocking #Authorizer, #Database and #Storage calls
+are run in a thread pool.
+
+Run it with any ASGI server, eg.
+
+    $ uvicorn fatartifacts.web.asgi_server:app
+"""
+
+from . import rest
+from .auth import AuthorizationError
+from fatartifacts import metrics
+from fatartifacts.database import base as database
+from fatartifacts.storage import base as storage
+from fatartifacts.utils import serialize
+from fatartifacts.utils.aio import AsyncReader, AsyncWriteStream, iterate_in_executor
+from typing import *
+from werkzeug.exceptions import HTTPException, abort
+import asyncio
+import concurrent.futures
+import functools
+import io
+import logging
+import time
+import urllib.parse
+import uuid
+import werkzeug.http
+import werkzeug.wrappers
+
+logger = logging.getLogger(__name__)
+
+
+class ClientDisconnected(Exception):
+  pass
+
+
+def make_environ(scope) -> dict:
+  """
+  Creates a WSGI environment from an ASGI HTTP *scope*, without a request
+  body. It is used to construct a #werkzeug.wrappers.Request, so that the
+  #Authorizer and the helpers of the #rest module can be used as is.
+  """
+
+  server = scope.get('server') or ('localhost', 80)
+  client = scope.get('client') or ('', 0)
+  environ = {
+    'REQUEST_METHOD': scope['method'],
+    'SCRIPT_NAME': scope.get('root_path', ''),
+    'PATH_INFO': scope['path'],
+    'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+    'SERVER_NAME': server[0],
+    'SERVER_PORT': str(server[1]),
+    'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+    'REMOTE_ADDR': client[0],
+    'wsgi.url_scheme': scope.get('scheme', 'http'),
+    'wsgi.input': io.BytesIO(),
+  }
+  for name, value in scope['headers']:
+    name = name.decode('latin1').upper().replace('-', '_')
+    if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+      name = 'HTTP_' + name
+    value = value.decode('latin1')
+    if name in environ:
+      value = environ[name] + ',' + value
+    environ[name] = value
+  return environ
+
+
+class RequestBody:
+  """
+  Reads the request body from the ASGI *receive* callable.
+  """
+
+  def __init__(self, receive):
+    self._receive = receive
+    self._buffer = memoryview(b'')
+    self._more_body = True
+
+  async def _fill(self) -> bool:
+    while not self._buffer and self._more_body:
+      message = await self._receive()
+      if message['type'] == 'http.disconnect':
+        raise ClientDisconnected()
+      self._buffer = memoryview(message.get('body', b''))
+      self._more_body = message.get('more_body', False)
+    return bool(self._buffer)
+
+  async def read(self, num_bytes: int) -> bytes:
+    """
+    Reads up to *num_bytes* from the body. Returns an empty bytes object
+    when the body is exhausted.
+    """
+
+    await self._fill()
+    data, self._buffer = self._buffer[:num_bytes], self._buffer[num_bytes:]
+    return data.tobytes()
+
+  async def readinto(self, buffer: memoryview) -> int:
+    """
+    Reads from the body into the writable *buffer* until it is full or the
+    body is exhausted. Returns the number of bytes read.
+    """
+
+    count = 0
+    while count < len(buffer) and await self._fill():
+      n = min(len(self._buffer), len(buffer) - count)
+      buffer[count:count + n] = self._buffer[:n]
+      self._buffer = self._buffer[n:]
+      count += n
+    return count
+
+  async def read_all(self, num_bytes: int = None) -> bytes:
+    """
+    Reads *num_bytes* from the body, or the rest of the body if *num_bytes*
+    is #None. Less data is returned if the body is shorter.
+    """
+
+    parts = []
+    while num_bytes is None or num_bytes > 0:
+      data = await self.read(64 * 1024 if num_bytes is None else num_bytes)
+      if not data:
+        break
+      parts.append(data)
+      if num_bytes is not None:
+        num_bytes -= len(data)
+    return b''.join(parts)
+
+
+class App:
+  """
+  The ASGI application. *config* is the same configuration object that is
+  used for the #rest Blueprint, and the routes are served under *prefix*
+  (eg. `/api`). Blocking calls are run in the *executor*, or in a
+  #concurrent.futures.ThreadPoolExecutor with *max_workers* threads.
+  """
+
+  # Cache lifetime for downloaded files, the default used by Flask.
+  cache_max_age = 43200
+
+  def __init__(self, config, prefix='', executor=None, max_workers=32,
+               chunk_size=64*1024):
+    rest.check_config(config)
+    self.config = config
+    self.prefix = prefix.rstrip('/')
+    self.executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers)
+    self.chunk_size = chunk_size
+    rest.app.config = config
+
+  async def receive_file(self, request, body, wstream, writer) -> int:
+    """
+    Copies the request *body* to the *writer* of the #storage.WriteStream
+    *wstream*. The body is collected in a buffer of `upload_buffer_size`
+    bytes, thus the executor is called once per buffer instead of once per
+    ASGI message. Returns the number of bytes received.
+    """
+
+    buffer_size = getattr(self.config, 'upload_buffer_size', rest.Config.upload_buffer_size)
+    view = memoryview(bytearray(buffer_size))
+    start = time.perf_counter()
+    received = 0
+    while True:
+      count = await body.readinto(view)
+      if not count:
+        break
+      await writer.write(view[:count] if wstream.accepts_buffer else view[:count].tobytes())
+      received += count
+    rest.log_throughput(logger, request.path, received, time.perf_counter() - start)
+    return received
+
+  async def run(self, func, *args, **kwargs):
+    """
+    Runs *func* in the executor.
+    """
+
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+      self.executor, functools.partial(func, *args, **kwargs))
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] == 'lifespan':
+      await self.lifespan(receive, send)
+      return
+    if scope['type'] != 'http':
+      return
+
+    request = werkzeug.wrappers.Request(make_environ(scope))
+    http_metrics = rest.get_http_metrics()
+    if http_metrics is not None:
+      receive, send, finish = self.instrument(http_metrics, request, receive, send)
+    body = RequestBody(receive)
+    try:
+      await self.dispatch(scope, request, body, send)
+    except ClientDisconnected:
+      pass
+    finally:
+      if http_metrics is not None:
+        finish()
+
+  def instrument(self, http_metrics, request, receive, send):
+    """
+    Wraps the ASGI *receive* and *send* callables to count the bytes of the
+    request and response bodies. Returns them and a function that records
+    the request in the #metrics.HttpMetrics when it is finished.
+    """
+
+    start = time.perf_counter()
+    received = sent = 0
+    status = 500
+    http_metrics.in_flight.inc()
+
+    async def counting_receive():
+      nonlocal received
+      message = await receive()
+      received += len(message.get('body', b''))
+      return message
+
+    async def counting_send(message):
+      nonlocal sent, status
+      if message['type'] == 'http.response.start':
+        status = message['status']
+      else:
+        sent += len(message.get('body', b''))
+      await send(message)
+
+    def finish():
+      # Like the Flask Blueprint, requests that match no route are not
+      # recorded.
+      route = getattr(request, 'route_name', None)
+      if route is None:
+        http_metrics.in_flight.dec()
+      else:
+        http_metrics.finish(route, request.method, status,
+                            time.perf_counter() - start, received, sent)
+
+    return counting_receive, counting_send, finish
+
+  async def lifespan(self, receive, send):
+    while True:
+      message = await receive()
+      if message['type'] == 'lifespan.startup':
+        await send({'type': 'lifespan.startup.complete'})
+      elif message['type'] == 'lifespan.shutdown':
+        # Wait for the blocking work in the default executor, as waiting
+        # here would stall the event loop and the requests still in flight.
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.executor.shutdown, True)
+        await send({'type': 'lifespan.shutdown.complete'})
+        return
+
+  async def dispatch(self, scope, request, body, send):
+    path = scope['path']
+    if path.startswith(self.prefix + '/'):
+      path = path[len(self.prefix):]
+    else:
+      path = ''
+
+    route = None
+    if path == '/info':
+      route, methods, args = self.info, ('GET',), ()
+    elif path == '/token':
+      route, methods, args = self.token, ('POST',), ()
+    elif path in ('/location', '/location/'):
+      route, methods, args = self.location, ('GET',), ('',)
+    elif path.startswith('/location/'):
+      route, methods, args = self.location, ('GET', 'PUT', 'DELETE'), (path[10:],)
+    elif path.startswith('/jobs/') and len(path) > 6:
+      route, methods, args = self.job, ('GET',), (path[6:],)
+    elif path == '/uploads':
+      route, methods, args = self.uploads, ('POST',), ()
+    elif path.startswith('/uploads/') and len(path) > 9:
+      upload_id, _, index = path[9:].partition('/')
+      if not index:
+        route, methods, args = self.upload, ('GET', 'POST', 'DELETE'), (upload_id,)
+      elif index.isdigit():
+        route, methods, args = self.upload_chunk, ('PUT',), (upload_id, int(index))
+    elif path.startswith('/read/') and len(path) > 6:
+      route, methods, args = self.read, ('GET', 'HEAD'), (path[6:],)
+    elif path == '/metrics':
+      route, methods, args = self.metrics, ('GET',), ()
+    if route is not None:
+      request.route_name = route.__name__
+
+    try:
+      if route is None:
+        abort(404)
+      if request.method not in methods:
+        abort(405)
+      try:
+        request.user_id = await self.run(self.config.auth.do_authorization, request)
+      except AuthorizationError as exc:
+        abort(403, str(exc))
+      result = await route(scope, request, body, send, *args)
+    except HTTPException as e:
+      await self.send_json(send, {'message': str(e)}, e.code)
+      return
+    except ClientDisconnected:
+      raise
+    except Exception as e:
+      logger.exception(e)
+      await self.send_json(send, {
+        'message': 'The server has encountered an internal server error.'
+      }, 500)
+      return
+
+    # JSON routes return their result, streaming routes send it themselves.
+    if result is not None:
+      if isinstance(result, tuple):
+        result, status = result
+      else:
+        status = 200
+      await self.send_json(send, result, status)
+
+  async def send_response(self, send, status, headers=(), body=b''):
+    await send({
+      'type': 'http.response.start',
+      'status': status,
+      'headers': [(k.encode('latin1'), str(v).encode('latin1')) for k, v in headers]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+  async def send_json(self, send, data, status=200):
+    body = serialize.dumps(data)
+    await self.send_response(send, status, [
+      ('Content-Type', 'text/json'), ('Content-Length', len(body))], body)
+
+  async def send_stream(self, send, status, headers, chunks):
+    await send({
+      'type': 'http.response.start',
+      'status': status,
+      'headers': [(k.encode('latin1'), str(v).encode('latin1')) for k, v in headers]
+    })
+    async for data in chunks:
+      await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+  def read_url(self, request, location):
+    return request.script_root + self.prefix + '/read/' + \
+        urllib.parse.quote(str(location), safe=':/')
+
+  async def info(self, scope, request, body, send):
+    perm = self.config.accesscontrol.get_permissions(database.Location(''), request.user_id)
+    if not perm.can_read:
+      abort(403)
+    return {'numLevels': self.config.database.num_levels()}
+
+  async def metrics(self, scope, request, body, send):
+    registry = getattr(self.config, 'metrics', None)
+    if registry is None:
+      abort(404)
+    perm = self.config.accesscontrol.get_permissions(database.Location(''), request.user_id)
+    if not perm.can_read:
+      abort(403)
+    data = (await self.run(registry.expose)).encode('utf8')
+    await self.send_response(send, 200, [
+      ('Content-Type', metrics.CONTENT_TYPE), ('Content-Length', len(data))], data)
+
+  async def token(self, scope, request, body, send):
+    return rest.issue_token(request.user_id, request.args, request.headers)
+
+  async def location(self, scope, request, body, send, path):
+    db = self.config.database
+    ac = self.config.accesscontrol
+    loc = database.Location(path)
+    is_root = len(loc) == 0
+
+    if len(loc) > db.num_levels() or (not is_root and not self.config.storage.supports_location(loc)):
+      return {'status': 'BadRequest', 'at': str(loc),
+              'message': 'The location is not supported by the repository.'}, 400
+
+    perm = ac.get_permissions(loc, request.user_id)
+    if not is_root and not perm.can_read:
+      abort(404 if request.method == 'GET' else 403)
+
+    is_object = len(loc) == db.num_levels()
+
+    if request.method == 'DELETE':
+      if is_root or not perm.can_delete:
+        return {'status': 'PermissionDenied', 'at': str(loc)}, 403
+      recursive_delete = rest.check_bool_header('X-Recursive-Delete', headers=request.headers)
+      def delete():
+        with db.query_context():
+          return db.delete_location(loc, recursive_delete)
+      try:
+        deleted_objects = await self.run(delete)
+      except database.LocationHasChildren as e:
+        return {'status': 'LocationHasChildren', 'at': str(e.location)}, 409
+      except database.LocationDoesNotExist as e:
+        return {'status': 'LocationDoesNotExist', 'at': str(e.location)}, 404
+      if rest.prefers_async(request.headers):
+        job = rest.DeleteJob.start(loc, request.user_id, deleted_objects, logger)
+        return {'status': 'Accepted', 'at': str(loc), 'job': job.to_json()}, 202
+      await self.run(rest.delete_object_files, deleted_objects, logger)
+      return {'status': 'Deleted', 'at': str(loc)}
+
+    if request.method == 'PUT':
+      if is_root or not perm.can_write:
+        return {'status': 'PermissionDenied', 'at': str(loc)}, 403
+      if is_object:
+        return await self.put_object(request, body, loc)
+      content_type = request.headers.get('Content-Type', '')
+      if content_type and content_type != 'application/json':
+        return {'status': 'BadRequest', 'at': str(loc),
+                'message': 'Expected Content-Type: application/json, got {}'.format(content_type)}, 400
+      if content_type:
+        try:
+          metadata = serialize.loads(await body.read_all())
+          if not isinstance(metadata, dict):
+            raise ValueError('expected JSON object')
+        except ValueError as e:
+          return {'status': 'BadRequest', 'at': str(loc),
+                  'message': 'JSON payload could not be parsed ({})'.format(e)}, 400
+      else:
+        metadata = {}
+      update_if_exists = rest.check_bool_header('X-Update-If-Exists', headers=request.headers)
+      info = database.LocationInfo(loc, metadata)
+      def create():
+        with db.query_context():
+          return db.create_location(info, update_if_exists)
+      try:
+        is_new_location = await self.run(create)
+      except database.LocationDoesNotExist as e:
+        return {'status': 'LocationDoesNotExist', 'at': str(e.location)}, 404
+      except database.LocationAlreadyExists as e:
+        return {'status': 'LocationAlreadyExists', 'at': str(e.location)}, 409
+      status = 'Created' if is_new_location else 'Updated'
+      return {'status': status, 'at': str(loc)}
+
+    try:
+      filter, limit, after = rest.parse_listing_args(request.args)
+    except ValueError as exc:
+      abort(400, str(exc))
+    read_url = functools.partial(self.read_url, request)
+    format = rest.get_listing_format(request.accept_mimetypes)
+    def query():
+      if format:
+        return rest.stream_location_as_json(loc, filter, limit, after,
+          user_id=request.user_id, read_url=read_url)
+      with db.query_context():
+        return rest.get_location_as_json(loc, filter, limit, after,
+          user_id=request.user_id, read_url=read_url)
+    try:
+      result = await self.run(query)
+    except database.LocationDoesNotExist as e:
+      return {'status': 'LocationDoesNotExist'}, 404
+    except database.InvalidLocationQuery as e:
+      return {'status': 'BadRequest', 'at': str(e.location),
+              'message': 'The location is not supported by the repository.'}, 400
+    if not format:
+      key, data = result
+      return {'status': 'Result', key: data}
+    mimetype = 'application/x-ndjson' if format == 'ndjson' else 'application/json'
+    await self.send_stream(send, 200, [('Content-Type', mimetype)], iterate_in_executor(
+      rest.encode_location_stream(result, format), self.executor))
+
+  async def job(self, scope, request, body, send, job_id):
+    return rest.get_delete_job(job_id, request.user_id)
+
+  async def uploads(self, scope, request, body, send):
+    payload = await body.read_all()
+    return await self.run(rest.create_upload, request.user_id,
+                          request.headers.get('Content-Type', ''), payload)
+
+  async def upload(self, scope, request, body, send, upload_id):
+    upload = await self.run(rest.find_upload, upload_id, request.user_id)
+    if upload is None:
+      return rest.upload_does_not_exist(upload_id)
+    if request.method == 'POST':
+      return await self.run(rest.commit_upload, upload, request.user_id)
+    if request.method == 'DELETE':
+      await self.run(upload.abort)
+      return {'status': 'Deleted', 'id': upload_id}
+    try:
+      return {'status': 'Result', 'upload': await self.run(rest.upload_to_json, upload)}
+    except storage.UploadDoesNotExist:
+      return rest.upload_does_not_exist(upload_id)
+
+  async def upload_chunk(self, scope, request, body, send, upload_id, index):
+    """
+    Handles the upload of a chunk, see #rest._handle_put_chunk().
+    """
+
+    upload = await self.run(rest.find_upload, upload_id, request.user_id)
+    if upload is None:
+      return rest.upload_does_not_exist(upload_id)
+    try:
+      wstream = await self.run(rest.open_upload_chunk, upload, index, request.headers)
+    except storage.UploadDoesNotExist:
+      return rest.upload_does_not_exist(upload_id)
+
+    writer = AsyncWriteStream(wstream, self.executor)
+    try:
+      await self.receive_file(request, body, wstream, writer)
+      await writer.close()
+    except (storage.WriteOverflow, storage.IncompleteUpload) as exc:
+      await writer.abort()
+      return {'status': 'BadRequest', 'upload': upload_id, 'chunk': index,
+              'message': 'The chunk is incomplete ({})'.format(exc)}, 400
+    except BaseException:
+      await writer.abort()
+      raise
+    return {'status': 'Received', 'upload': upload_id, 'chunk': index}
+
+  async def put_object(self, request, body, loc):
+    """
+    Handles the upload of an object, see #rest._handle_put_object(). The
+    object's location is checked before the file is received, but the object
+    is only created in the database after the upload is complete.
+    """
+
+    db = self.config.database
+    args = rest.parse_put_object_headers(request.headers)
+    metadata = rest.decode_object_metadata(
+      await body.read_all(args.metadata_length), args.metadata_encoding)
+
+    def prepare():
+      with db.query_context():
+        rest.check_object_location(loc, args.update_if_exists)
+      return self.config.storage.open_write_file(loc, args.file_name, args.content_length)
+
+    try:
+      wstream, uri = await self.run(prepare)
+    except database.LocationDoesNotExist as e:
+      return {'status': 'LocationDoesNotExist', 'at': str(e.location)}, 404
+    except database.LocationAlreadyExists as e:
+      return {'status': 'LocationAlreadyExists', 'at': str(e.location)}, 409
+
+    # The data is hashed by the executor, together with writing it.
+    wstream = rest.open_hashing_stream(wstream, args)
+    writer = AsyncWriteStream(wstream, self.executor)
+    try:
+      await self.receive_file(request, body, wstream, writer)
+    except storage.WriteOverflow as exc:
+      await writer.abort()
+      return {'status': 'BadRequest', 'at': str(loc),
+              'message': 'WriteOverflow -- received more data than specified in the request'}, 400
+    except BaseException:
+      await writer.abort()
+      raise
+    mismatch = rest.verify_object_digests(loc, wstream, args)
+    if mismatch:
+      await writer.abort()
+      return mismatch
+
+    info = database.ObjectInfo(loc, metadata=metadata, filename=args.file_name,
+        uri=uri, mime=args.file_content_type, digest=rest.get_object_digest(wstream))
+    def commit():
+      with wstream, db.query_context():
+        return db.create_object(info, args.update_if_exists)
+    try:
+      is_new_object = await self.run(commit)
+    except database.LocationDoesNotExist as e:
+      return {'status': 'LocationDoesNotExist', 'at': str(e.location)}, 404
+    except database.LocationAlreadyExists as e:
+      return {'status': 'LocationAlreadyExists', 'at': str(e.location)}, 409
+
+    status = 'Created' if is_new_object else 'Updated'
+    return {'status': status, 'at': str(loc), 'digest': info.digest}
+
+  async def read(self, scope, request, body, send, path):
+    db = self.config.database
+    st = self.config.storage
+    location = database.Location(path)
+    if len(location) != db.num_levels():
+      abort(404)
+
+    def lookup():
+      with db.query_context():
+        return next(db.list_objects(location), None)
+    obj = await self.run(lookup)
+    if obj is None:
+      abort(404)
+
+    url = rest.get_object_url(obj, default=None)
+    if url is not None:
+      await self.send_response(send, 302, [('Location', url), ('Content-Length', 0)])
+      return
+
+    etag = rest.get_object_etag(obj)
+    headers = {'Accept-Ranges': 'bytes', 'ETag': werkzeug.http.quote_etag(etag)}
+    digest_header = rest.get_digest_header(obj.digest)
+    if digest_header:
+      headers['Digest'] = digest_header
+    if obj.date_updated:
+      headers['Last-Modified'] = werkzeug.http.http_date(obj.date_updated)
+    if not werkzeug.http.is_resource_modified(request.environ, etag,
+        last_modified=obj.date_updated):
+      await self.send_response(send, 304, headers.items())
+      return
+
+    try:
+      size = await self.run(st.get_file_size, location, obj.filename, obj.uri)
+    except storage.FileDoesNotExist:
+      abort(404)
+
+    # The Range header must be ignored if the If-Range condition doesn't match.
+    ranges = None
+    if_range = request.headers.get('If-Range')
+    if if_range is None or if_range.strip() in (headers['ETag'], headers.get('Last-Modified')):
+      ranges = rest.parse_byte_ranges(request.headers.get('Range'), size)
+    if ranges == []:
+      headers['Content-Range'] = 'bytes */{}'.format(size)
+      await self.send_response(send, 416, list(headers.items()) + [('Content-Length', 0)])
+      return
+
+    headers['Content-Type'] = obj.mime
+    headers['Content-Disposition'] = werkzeug.http.dump_options_header(
+      'attachment', {'filename': obj.filename})
+    headers['Cache-Control'] = 'public, max-age={}'.format(self.cache_max_age)
+
+    # The frontend server handles Range requests itself.
+    offload_header = await self.run(rest.get_offload_header, location, obj)
+    if offload_header:
+      headers[offload_header[0]] = offload_header[1]
+      await self.send_response(send, 200, headers.items())
+      return
+
+    if not ranges:
+      status, headers['Content-Length'] = 200, size
+    elif len(ranges) == 1:
+      start, end = ranges[0]
+      status, headers['Content-Length'] = 206, end - start
+      headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end - 1, size)
+    else:
+      boundary = uuid.uuid4().hex
+      parts, length = rest.multipart_byteranges(obj, location, ranges, size, boundary)
+      status, headers['Content-Length'] = 206, length
+      headers['Content-Type'] = 'multipart/byteranges; boundary=' + boundary
+
+    if request.method == 'HEAD':
+      await self.send_response(send, status, headers.items())
+      return
+
+    if len(ranges or ()) > 1:
+      await self.send_stream(send, status, headers.items(),
+        iterate_in_executor(parts, self.executor))
+      return
+
+    # Let the server send files from the local filesystem if it supports
+    # the "pathsend" extension.
+    if not ranges and 'http.response.pathsend' in scope.get('extensions', {}):
+      path = await self.run(st.get_local_path, location, obj.filename, obj.uri)
+      if path:
+        await send({'type': 'http.response.start', 'status': status,
+          'headers': [(k.encode('latin1'), str(v).encode('latin1')) for k, v in headers.items()]})
+        await send({'type': 'http.response.pathsend', 'path': path})
+        return
+
+    try:
+      if not ranges:
+        fp, size = await self.run(st.open_read_file, location, obj.filename, obj.uri)
+      else:
+        fp = await self.run(st.open_read_range, location, obj.filename, obj.uri, start, end - start)
+    except storage.FileDoesNotExist:
+      abort(404)
+
+    reader = AsyncReader(fp, self.executor)
+    try:
+      await self.send_stream(send, status, headers.items(), reader.iter_chunks(self.chunk_size))
+    finally:
+      await reader.close()
@@ -0,0 +1,5 @@
+
+from . import asgi
+import fatartifacts_server_config as cfg
+
+app = asgi.App(cfg, prefix=cfg.rest_prefix)
@@ -2,10 +2,16 @@
 Authentication layer for the FatArtifacts web server.
 """
 
+from fatartifacts.utils.cache import TTLCache
 from typing import *
 import abc
+import base64
+import binascii
 import flask
 import hashlib
+import hmac
+import os
+import time
 
 
 class Authorizer(metaclass=abc.ABCMeta):
@@ -19,17 +25,104 @@ class AuthorizationError(Exception):
   pass
 
 
+class PasswordHash(object):
+  """
+  Represents a password hash in one of the formats supported by the
+  #HardcodedAuthorizer:
+
+  * `<algorithm>:<hexdigest>` -- a plain digest with any algorithm from
+    #hashlib (eg. `sha256`). Fast to compute, thus not recommended.
+  * `pbkdf2_sha256:<iterations>:<salt>:<hexdigest>` -- PBKDF2-HMAC-SHA256.
+  * `scrypt:<n>:<r>:<p>:<salt>:<hexdigest>` -- scrypt.
+
+  The salt is hex encoded. Use #hash_password() to create a hash string.
+  """
+
+  def __init__(self, string):
+    method, _, value = string.partition(':')
+    params = value.split(':')
+    if method not in ('pbkdf2_sha256', 'scrypt') and method not in hashlib.algorithms_available:
+      raise ValueError('unknown hash algorithm: {}'.format(method))
+    try:
+      if method == 'pbkdf2_sha256':
+        iterations, salt, digest = params
+        self.params = (int(iterations), binascii.unhexlify(salt))
+      elif method == 'scrypt':
+        n, r, p, salt, digest = params
+        self.params = (int(n), int(r), int(p), binascii.unhexlify(salt))
+      else:
+        digest, = params
+        self.params = ()
+      self.digest = binascii.unhexlify(digest)
+    except (ValueError, binascii.Error) as exc:
+      raise ValueError('invalid {} password hash'.format(method)) from exc
+    self.method = method
+
+  def compute(self, password: bytes) -> bytes:
+    if self.method == 'pbkdf2_sha256':
+      iterations, salt = self.params
+      return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+    elif self.method == 'scrypt':
+      n, r, p, salt = self.params
+      return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                            maxmem=_scrypt_maxmem(n, r, p), dklen=len(self.digest))
+    else:
+      return hashlib.new(self.method, password).digest()
+
+  def verify(self, password: bytes) -> bool:
+    return hmac.compare_digest(self.compute(password), self.digest)
+
+
+def hash_password(password: str, method='pbkdf2_sha256', encoding='utf8',
+                  iterations=260000, n=2**14, r=8, p=1) -> str:
+  """
+  Creates a password hash string for the #HardcodedAuthorizer with a random
+  salt. *method* can be `pbkdf2_sha256` (with *iterations*) or `scrypt`
+  (with the cost parameters *n*, *r* and *p*).
+  """
+
+  salt = os.urandom(16)
+  password = password.encode(encoding)
+  if method == 'pbkdf2_sha256':
+    params = [iterations, salt]
+    digest = hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+  elif method == 'scrypt':
+    params = [n, r, p, salt]
+    digest = hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                            maxmem=_scrypt_maxmem(n, r, p), dklen=32)
+  else:
+    raise ValueError('unsupported method: {!r}'.format(method))
+  params = [str(x) if isinstance(x, int) else binascii.hexlify(x).decode()
+            for x in params + [digest]]
+  return ':'.join([method] + params)
+
+
+def _scrypt_maxmem(n, r, p):
+  # The memory required by scrypt is about 128 * r * (n + p) bytes, which
+  # may exceed OpenSSL's default limit of 32 MiB.
+  return 256 * r * (n + p + 1)
+
 
 class HardcodedAuthorizer(Authorizer):
+  """
+  Authorizes users with HTTP Basic authentication against a dictionary
+  that maps usernames to password hashes (see #PasswordHash for the
+  supported formats).
 
-  def __init__(self, users, encoding='utf8'):
+  As verifying a slow hash on every request would be too expensive,
+  successfully verified credentials are remembered for *cache_ttl* seconds
+  (up to *cache_size* users). The cache only stores a keyed digest of the
+  credentials, never the password itself. Pass `cache_size=0` to disable
+  the cache.
+  """
+
+  def __init__(self, users, encoding='utf8', cache_size=1024, cache_ttl=300):
     self.users = {}
     self.encoding = encoding
     for user, pw in users.items():
-      method, value = pw.partition(':')[::2]
-      if method not in hashlib.algorithms_available:
-        raise ValueError('unknown hash algorithm: {}'.format(method))
-      self.users[user] = (method, value)
+      self.users[user] = PasswordHash(pw)
+    self.cache = TTLCache(cache_size, cache_ttl) if cache_size else None
+    self._cache_key = os.urandom(32)
 
   def do_authorization(self, request: flask.Request) -> Optional[str]:
     auth = request.authorization
@@ -37,8 +130,104 @@ class HardcodedAuthorizer(Authorizer):
       return None  # global access, no account
     if auth.username not in self.users:
       raise AuthorizationError('Invalid username.')
-    method, value = self.users[auth.username]
-    hashed_pw = hashlib.new(method, auth.password.encode(self.encoding)).hexdigest()
-    if hashed_pw != value:
+    password = (auth.password or '').encode(self.encoding)
+
+    if self.cache is not None:
+      credentials = auth.username.encode(self.encoding) + b'\0' + password
+      digest = hmac.new(self._cache_key, credentials, 'sha256').digest()
+      cached = self.cache.get(auth.username)
+      if cached is not None and hmac.compare_digest(cached, digest):
+        return auth.username
+
+    if not self.users[auth.username].verify(password):
       raise AuthorizationError('Invalid password')
+    if self.cache is not None:
+      self.cache.put(auth.username, digest)
     return auth.username
+
+
+class TokenAuthorizer(Authorizer):
+  """
+  Authorizes requests with stateless bearer tokens (`Authorization: Bearer
+  <token>`) that are issued by the REST-Api's `/token` endpoint. A token
+  contains the user ID and its expiration time and is signed with
+  HMAC-SHA256 using the *secret*, thus verifying it requires neither a
+  lookup nor a password hash. Requests without a bearer token are passed to
+  the *fallback* #Authorizer (eg. a #HardcodedAuthorizer), which is also
+  used to authenticate the user that requests a token.
+
+  Tokens are valid for *ttl* seconds. A client may request a shorter
+  lifetime, but never one longer than *max_ttl*. Changing the *secret*
+  invalidates all tokens that have been issued.
+  """
+
+  def __init__(self, secret, fallback: Authorizer = None, ttl=3600,
+               max_ttl=86400, encoding='utf8'):
+    if isinstance(secret, str):
+      secret = secret.encode(encoding)
+    if not secret:
+      raise ValueError('secret must not be empty')
+    self.secret = secret
+    # Copying a keyed HMAC is cheaper than setting up the key every time.
+    self._hmac = hmac.new(secret, digestmod='sha256')
+    self.fallback = fallback
+    self.ttl = ttl
+    self.max_ttl = max_ttl
+    self.encoding = encoding
+
+  def _sign(self, payload: bytes) -> bytes:
+    signer = self._hmac.copy()
+    signer.update(payload)
+    return signer.digest()
+
+  def issue_token(self, user_id: str, ttl: int = None) -> Tuple[str, int]:
+    """
+    Issues a token for *user_id*. Returns the token and the time at which
+    it expires as a UNIX timestamp.
+    """
+
+    ttl = self.ttl if ttl is None else min(ttl, self.max_ttl)
+    expires = int(time.time()) + ttl
+    payload = '{}:{}'.format(expires, user_id).encode(self.encoding)
+    token = b'.'.join([base64.urlsafe_b64encode(payload),
+                       base64.urlsafe_b64encode(self._sign(payload))])
+    return token.decode('ascii'), expires
+
+  def verify_token(self, token: str) -> str:
+    """
+    Returns the user ID of the *token*. Raises an #AuthorizationError if
+    the token is invalid or expired.
+    """
+
+    try:
+      payload, _, signature = token.encode('ascii').partition(b'.')
+      payload = base64.urlsafe_b64decode(payload)
+      signature = base64.urlsafe_b64decode(signature)
+    except (UnicodeError, binascii.Error):
+      raise AuthorizationError('Invalid token.')
+    if not hmac.compare_digest(self._sign(payload), signature):
+      raise AuthorizationError('Invalid token.')
+    expires, _, user_id = payload.decode(self.encoding).partition(':')
+    if int(expires) < time.time():
+      raise AuthorizationError('Token expired.')
+    return user_id
+
+  @staticmethod
+  def get_bearer_token(headers) -> Optional[str]:
+    """
+    Returns the bearer token from the `Authorization` header in *headers*,
+    or #None if the request has no bearer token.
+    """
+
+    scheme, _, token = headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer':
+      return None
+    return token.strip()
+
+  def do_authorization(self, request: flask.Request) -> Optional[str]:
+    token = self.get_bearer_token(request.headers)
+    if token is not None:
+      return self.verify_token(token)
+    if self.fallback is not None:
+      return self.fallback.do_authorization(request)
+    return None
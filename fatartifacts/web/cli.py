@@ -4,13 +4,17 @@ Command-line interface that uses the REST API.
 
 import argparse
 import base64
+import concurrent.futures
 import getpass
 import mimetypes
 import os
 import urllib.parse
 import requests
+import requests.adapters
 import shlex
 import sys
+import threading
+import time
 
 parser = argparse.ArgumentParser(
   prog = 'fatartifacts-rest-cli',
@@ -21,7 +25,8 @@ parser = argparse.ArgumentParser(
 parser.add_argument('apiurl', help='The FatArtifacts REST API base url.')
 parser.add_argument('object', help='''
   The object ID in the format <group>:<artifact>:<version>:<tag>.
-  '''
+  ''',
+  nargs='?'
 )
 parser.add_argument('file', type=argparse.FileType('rb'), help='''
   The file that is to be uploaded to the repository.
@@ -66,110 +71,367 @@ parser.add_argument('--forward-auth', action='store_true', help='''
   may be necessary for private artifact repositories.
   '''
 )
+parser.add_argument('--update', action='store_true', help='''
+  Replace objects that already exist when uploading.
+  '''
+)
+parser.add_argument('-M', '--manifest', type=argparse.FileType('r'), help='''
+  Transfer all objects listed in the manifest file (- for stdin) instead of
+  a single object. Every line contains an operation (put, get or delete),
+  the object ID and, for put and get, the file name. Empty lines and lines
+  starting with # are ignored.
+  '''
+)
+parser.add_argument('-j', '--jobs', type=int, default=4, help='''
+  The number of concurrent transfers in manifest mode (default: 4).
+  '''
+)
+parser.add_argument('--chunk-size', type=int, default=1024 * 1024, help='''
+  The size of the chunks that are read and written when transferring files
+  (default: 1 MiB).
+  '''
+)
+parser.add_argument('-q', '--quiet', action='store_true', help='''
+  Do not print the progress in manifest mode.
+  '''
+)
+
+
+class CliError(Exception):
+  pass
+
+
+class Transfer(object):
+  """
+  An operation on a single object: `put`, `get` or `delete`.
+  """
+
+  def __init__(self, operation, object_id, filename=None, name=None, mime=None):
+    if operation not in ('put', 'get', 'delete'):
+      raise CliError('invalid operation: {}'.format(operation))
+    if len(object_id.split(':')) != 4:
+      raise CliError('invalid artifact object id: {}'.format(object_id))
+    if operation != 'delete' and not filename:
+      raise CliError('missing file name for {} {}'.format(operation, object_id))
+    if operation == 'put':
+      # Create a default value for the -n, --name option.
+      name = name or os.path.basename(filename)
+      # Try to guess the MIME type.
+      mime = mime or mimetypes.guess_type(name)[0] or mimetypes.guess_type(filename)[0]
+      if not mime:
+        raise CliError('unable to guess MIME type of {}. Specify -m, --mime'.format(filename))
+    self.operation = operation
+    self.object_id = object_id
+    self.filename = filename
+    self.name = name
+    self.mime = mime
+
+
+class UploadBody(object):
+  """
+  The body of an object upload: the JSON metadata followed by the file's
+  content, read in chunks of *chunk_size* bytes. It has a length, thus
+  #requests sends it with a `Content-Length` header instead of chunked.
+  """
+
+  def __init__(self, metadata, fp, size, chunk_size, progress=None):
+    self.metadata = metadata
+    self.fp = fp
+    self.size = size
+    self.chunk_size = chunk_size
+    self.progress = progress
+
+  def __len__(self):
+    return len(self.metadata) + self.size
+
+  def __iter__(self):
+    yield self.metadata
+    while True:
+      data = self.fp.read(self.chunk_size)
+      if not data:
+        break
+      if self.progress:
+        self.progress.add_bytes(len(data))
+      yield data
+
+
+class Progress(object):
+  """
+  Counts the transferred bytes and objects of the manifest mode and prints
+  the progress to *stream*. On a terminal, the status line is updated at
+  most every *interval* seconds.
+  """
+
+  def __init__(self, total, stream=sys.stderr, interval=0.5, quiet=False):
+    self.total = total
+    self.stream = stream
+    self.interval = interval
+    self.quiet = quiet
+    self.tty = stream.isatty()
+    self.start = time.perf_counter()
+    self.done = 0
+    self.failed = 0
+    self.bytes = 0
+    self._last_print = 0
+    self._lock = threading.Lock()
+
+  def rate(self):
+    return self.bytes / max(time.perf_counter() - self.start, 1e-9)
+
+  def status(self):
+    return '[{}/{}] {:.1f} MiB, {:.1f} MiB/s'.format(
+      self.done, self.total, self.bytes / 2**20, self.rate() / 2**20)
+
+  def add_bytes(self, num_bytes):
+    with self._lock:
+      self.bytes += num_bytes
+      now = time.perf_counter()
+      if self.tty and not self.quiet and now - self._last_print >= self.interval:
+        self._last_print = now
+        self.stream.write('\r\033[K' + self.status())
+        self.stream.flush()
+
+  def finish(self, transfer, error=None):
+    with self._lock:
+      self.done += 1
+      if error:
+        self.failed += 1
+      if error or not self.quiet:
+        message = 'error: {}'.format(error) if error else 'ok'
+        prefix = '\r\033[K' if self.tty else ''
+        self.stream.write('{}{} {} {} {}\n'.format(prefix, self.status(),
+          transfer.operation, transfer.object_id, message))
+        self.stream.flush()
+
 
 def build_basicauth(username, password):
   data = ('%s:%s' % (username, password)).encode('ISO-8859-1')
   return (b'Basic ' + base64.standard_b64encode (data)).decode('ascii')
 
 
-def main(argv=None):
-  args = parser.parse_args(argv)
+def make_session(pool_size):
+  """
+  Creates a #requests.Session that keeps up to *pool_size* connections to a
+  host alive, so that consecutive transfers do not set up new connections.
+  """
 
-  # Split the artifact object identifier into parts.
-  parts = args.object.split(':')
-  if len(parts) != 4:
-    print('error: invalid artifact object id:', args.object)
-    return 1
+  session = requests.Session()
+  adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+  return session
 
-  # Ensure the URL has a schema (adds HTTPS).
-  args.apiurl = args.apiurl.rstrip('/') + '/{}/{}/{}/{}'.format(*parts)
-  if not urllib.parse.urlparse(args.apiurl).scheme:
-    args.apiurl = 'https://' + url
 
-  # Ensure only one operation is specified (get, put, delete).
-  if sum(map(bool, (args.output, args.file, args.delete))) != 1:
-    print('error: incompatible arguments, specify one operation only.')
+def object_url(apiurl, object_id):
+  return apiurl + '/location/' + urllib.parse.quote(object_id, safe=':')
+
+
+def get_error(response):
+  try:
+    data = response.json()
+  except ValueError:
+    return '{} {}'.format(response.status_code, response.reason)
+  status = data.get('status') or response.status_code
+  detail = data.get('message') or data.get('at')
+  return '{} ({})'.format(status, detail) if detail else str(status)
+
+
+def put_headers(transfer, metadata, size, update):
+  return {
+    'Content-Type': 'application/vnd.fatartifacts+putobject',
+    'Content-Length': str(len(metadata) + size),
+    'X-Metadata-Length': str(len(metadata)),
+    'X-File-Name': transfer.name,
+    'X-File-ContentType': transfer.mime,
+    'X-Update-If-Exists': '1' if update else '0'
+  }
+
+
+def run_transfer(session, apiurl, transfer, auth_headers, forward_auth=False,
+                 update=False, chunk_size=1024 * 1024, progress=None, output=None):
+  """
+  Performs a #Transfer with the *session*. Raises a #CliError if the
+  request fails. Downloads are written to *output* if specified, otherwise
+  to the transfer's file.
+  """
+
+  url = object_url(apiurl, transfer.object_id)
+
+  if transfer.operation == 'put':
+    metadata = b'{}'
+    with open(transfer.filename, 'rb') as fp:
+      size = os.fstat(fp.fileno()).st_size
+      headers = put_headers(transfer, metadata, size, update)
+      headers.update(auth_headers)
+      body = UploadBody(metadata, fp, size, chunk_size, progress)
+      response = session.put(url, data=body, headers=headers)
+    if response.status_code != 200:
+      raise CliError(get_error(response))
+    return
+
+  if transfer.operation == 'delete':
+    response = session.delete(url, headers=auth_headers)
+    if response.status_code != 200:
+      raise CliError(get_error(response))
+    return
+
+  response = session.get(url, headers=auth_headers)
+  if response.status_code != 200:
+    raise CliError(get_error(response))
+  download_url = urllib.parse.urljoin(url, response.json()['object']['url'])
+  headers = auth_headers if forward_auth else {}
+  with session.get(download_url, headers=headers, stream=True) as response:
+    if response.status_code != 200:
+      raise CliError(get_error(response))
+    close = output is None
+    if close:
+      directory = os.path.dirname(transfer.filename)
+      if directory:
+        os.makedirs(directory, exist_ok=True)
+      output = open(transfer.filename, 'wb')
+    try:
+      for chunk in response.iter_content(chunk_size):
+        output.write(chunk)
+        if progress:
+          progress.add_bytes(len(chunk))
+    finally:
+      if close:
+        output.close()
+
+
+def parse_manifest(fp):
+  """
+  Parses the manifest file *fp* into a list of #Transfer objects.
+  """
+
+  transfers = []
+  for lineno, line in enumerate(fp, 1):
+    line = line.strip()
+    if not line or line.startswith('#'):
+      continue
+    try:
+      transfers.append(Transfer(*shlex.split(line)))
+    except (TypeError, ValueError):
+      raise CliError('{}:{}: invalid line'.format(fp.name, lineno))
+    except CliError as exc:
+      raise CliError('{}:{}: {}'.format(fp.name, lineno, exc))
+  return transfers
+
+
+def run_manifest(args, auth_headers):
+  try:
+    transfers = parse_manifest(args.manifest)
+  except CliError as exc:
+    print('error:', exc)
+    return 1
+  if args.jobs < 1:
+    print('error: -j, --jobs must be at least 1')
     return 1
 
-  if args.file:
-    # Create a default value for the -n, --name option.
-    if not args.name:
-      args.name = os.path.basename(args.file.name)
+  # Every worker thread uses its own session, as sessions are not
+  # guaranteed to be thread-safe.
+  local = threading.local()
+  progress = Progress(len(transfers), quiet=args.quiet)
 
-    # Try to guess the MIME type.
-    args.mime = mimetypes.guess_type(args.name)[0] or mimetypes.guess_type(args.file.name)[0]
-    if not args.mime:
-      print('error: unable to guess MIME type. Specify -m, --mime')
-      return 1
+  def worker(transfer):
+    if not hasattr(local, 'session'):
+      local.session = make_session(1)
+    try:
+      run_transfer(local.session, args.apiurl, transfer, auth_headers,
+                   args.forward_auth, args.update, args.chunk_size, progress)
+    except (CliError, OSError, requests.exceptions.RequestException) as exc:
+      progress.finish(transfer, exc)
+    else:
+      progress.finish(transfer)
+
+  with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+    list(executor.map(worker, transfers))
+
+  print('{} objects, {} failed, {:.1f} MiB in {:.1f}s ({:.1f} MiB/s)'.format(
+    progress.done, progress.failed, progress.bytes / 2**20,
+    time.perf_counter() - progress.start, progress.rate() / 2**20), file=sys.stderr)
+  return 2 if progress.failed else 0
+
+
+def main(argv=None):
+  args = parser.parse_args(argv)
 
-  # Create the request headers.
-  headers = {}
-  if args.output:
-    method = 'GET'
-  elif args.file:
-    method = 'PUT'
-    headers['Content-Name'] = args.name
-    headers['Content-Type'] = args.mime
-  elif args.delete:
-    method = 'DELETE'
+  # Ensure the URL has a schema (adds HTTPS).
+  args.apiurl = args.apiurl.rstrip('/')
+  if not urllib.parse.urlparse(args.apiurl).scheme:
+    args.apiurl = 'https://' + args.apiurl
 
   # Split username and password. Request the password if it was omitted.
-  # Then add the Authorization header.
-  auth_only_headers = {}
+  auth_headers = {}
   if args.auth:
     username, password = args.auth.partition(':')[::2]
     if ':' not in args.auth:
       password = getpass.getpass('Password for {}:'.format(username))
       if not password:
         return 1
-    auth_only_headers['Authorization'] = build_basicauth(username, password)
-    headers.update(auth_only_headers)
+    auth_headers['Authorization'] = build_basicauth(username, password)
+
+  if args.manifest:
+    if args.object or args.file or args.output or args.delete:
+      print('error: incompatible arguments, the manifest lists the operations.')
+      return 1
+    return run_manifest(args, auth_headers)
+
+  if not args.object:
+    print('error: specify an object ID or a -M, --manifest.')
+    return 1
+
+  # Ensure only one operation is specified (get, put, delete).
+  if sum(map(bool, (args.output, args.file, args.delete))) != 1:
+    print('error: incompatible arguments, specify one operation only.')
+    return 1
 
-  # Set the Content-Length header.
-  if args.file:
-    headers['Content-Length'] = str(os.stat(args.file.name).st_size)
+  try:
+    if args.file:
+      args.file.close()
+      transfer = Transfer('put', args.object, args.file.name, args.name, args.mime)
+    elif args.output:
+      transfer = Transfer('get', args.object, args.output)
+    else:
+      transfer = Transfer('delete', args.object)
+  except CliError as exc:
+    print('error:', exc)
+    return 1
 
   # If this is just a test, build a cURL command-line and print it.
   if args.test:
-    command = ['curl', '-X', method, args.apiurl]
+    url = object_url(args.apiurl, transfer.object_id)
+    method = {'put': 'PUT', 'get': 'GET', 'delete': 'DELETE'}[transfer.operation]
+    headers = dict(auth_headers)
+    if transfer.operation == 'put':
+      size = os.stat(transfer.filename).st_size
+      headers.update(put_headers(transfer, b'{}', size, args.update))
+    command = ['curl', '-X', method, url]
     for key, value in headers.items():
       command += ['-H', '{}: {}'.format(key, value)]
-    if args.file:
-      command += ['-d', '@' + args.file.name]
-    print('$', ' '.join(map(shlex.quote, command)))
+    if transfer.operation == 'put':
+      command += ['--data-binary', '@-']
+      print('$ (printf %s {}; cat {}) |'.format(
+        shlex.quote('{}'), shlex.quote(transfer.filename)), ' '.join(map(shlex.quote, command)))
+    else:
+      print('$', ' '.join(map(shlex.quote, command)))
     return 0
 
-  # Issue the request.
-  response = requests.request(method, args.apiurl, data=args.file, headers=headers)
-  data = response.json()
-  if response.status_code != 200:
-    print('error:', data['message'])
+  output = sys.stdout.buffer if args.output == '-' else None
+  try:
+    run_transfer(make_session(1), args.apiurl, transfer, auth_headers,
+                 args.forward_auth, args.update, args.chunk_size, output=output)
+  except (CliError, requests.exceptions.RequestException) as exc:
+    print('error:', exc)
     return 2
-
-  if args.output:
-    data = response.json()
-    download_url = urllib.parse.urljoin(args.apiurl, data['url'])
-    headers = auth_only_headers if args.forward_auth else {}
-    response = requests.get(download_url, headers=headers, stream=True)
-    try:
-      response.raise_for_status()
-    except requests.exceptions.HTTPError as exc:
-      print('error:', exc)
-      return 3
-
-    if args.output == '-':
-      for chunk in response.iter_content(1024):
-        sys.stdout.buffer.write(chunk)
-    else:
-      with open(args.output, 'wb') as fp:
-        for chunk in response.iter_content(1024):
-          fp.write(chunk)
-  else:
-    print(data['message'])
+  if transfer.operation != 'get':
+    print('{} {}'.format({'put': 'Uploaded', 'delete': 'Deleted'}[transfer.operation],
+                         transfer.object_id))
+  return 0
 
 
 def main_and_exit(argv=None):
-  sys.exit(main())
+  sys.exit(main(argv))
 
 
 if __name__ == '__main__':
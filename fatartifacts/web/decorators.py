@@ -1,5 +1,6 @@
 
-from flask import request
+from .auth import AuthorizationError
+from flask import abort, request
 import functools
 
 
@@ -1,15 +1,31 @@
 
-from .auth import AuthorizationError
+from .auth import AuthorizationError, TokenAuthorizer
 from .decorators import check_auth
+from fatartifacts import metrics
 from fatartifacts.database import base as database
 from fatartifacts.storage import base as storage
-from flask import abort, current_app, redirect, request, url_for, send_file, Blueprint, Response
-from werkzeug.exceptions import HTTPException
+from fatartifacts.utils import serialize
+from fatartifacts.utils.cache import TTLCache
+from fatartifacts.utils.io import copy_stream
+from fatartifacts.utils.types import NamedObject
+from flask import abort, current_app, g, redirect, request, stream_with_context, url_for, Blueprint, Response
+from typing import *
+from werkzeug.exceptions import ClientDisconnected, HTTPException
+import base64
+import binascii
+import codecs
 import datetime
 import functools
+import hashlib
 import json
-import shutil
+import os
+import threading
+import time
+import urllib.parse
+import uuid
 import werkzeug.local
+import werkzeug.http
+import werkzeug.wsgi
 
 app = Blueprint(__name__, __name__)
 app.config = None
@@ -27,29 +43,93 @@ class Config:
   storage: 'fatartifacts.auth.storage.Storage' = None
   web_urls_are_public: bool = True
 
+  # Hand off downloads of files that the storage keeps on the local
+  # filesystem to the frontend server. Can be #None, `'x-sendfile'`
+  # (Apache, lighttpd) or `'x-accel-redirect'` (nginx).
+  download_offload: str = None
+
+  # For `'x-accel-redirect'`, the directory that is served by the internal
+  # frontend server location #download_offload_prefix.
+  download_offload_root: str = None
+  download_offload_prefix: str = None
+
+  # The chunk size of chunked uploads (see `POST /uploads`) if the client
+  # does not specify one, the maximum chunk size a client can request and
+  # the maximum number of chunks of an upload.
+  upload_chunk_size: int = 8 * 1024 * 1024
+  upload_max_chunk_size: int = 256 * 1024 * 1024
+  upload_max_chunks: int = 10000
+
+  # The size of the buffer that uploaded files are received in. Larger
+  # buffers cost less per byte, smaller buffers fit better into the CPU
+  # caches while the data is hashed and written.
+  upload_buffer_size: int = 256 * 1024
+
+  # A #fatartifacts.metrics.Registry to record the request metrics in and to
+  # expose on the `/metrics` route, or #None to disable both.
+  metrics: 'fatartifacts.metrics.Registry' = None
+
+  # The hashlib algorithm of the digests that are computed while objects
+  # are uploaded and stored with them. #None disables recording digests.
+  digest_algorithm: str = 'sha256'
+
+
+def check_config(config):
+  """
+  Validates the options of the *config* that would otherwise only fail
+  when a request uses them. Call it when the REST-Api is configured, like
+  #fatartifacts.web.server and #fatartifacts.web.asgi.App do.
+
+  Raises:
+    ValueError: If an option is invalid.
+  """
+
+  offload = getattr(config, 'download_offload', Config.download_offload)
+  if offload and offload not in ('x-sendfile', 'x-accel-redirect'):
+    raise ValueError('invalid download_offload: {!r}'.format(offload))
+  if offload == 'x-accel-redirect':
+    for name in ('download_offload_root', 'download_offload_prefix'):
+      value = getattr(config, name, None)
+      if not value or not isinstance(value, str):
+        raise ValueError('download_offload = {!r} requires the {} option'
+                         .format(offload, name))
+
+  algorithm = getattr(config, 'digest_algorithm', Config.digest_algorithm)
+  if algorithm and algorithm not in hashlib.algorithms_available:
+    raise ValueError('invalid digest_algorithm: {!r}'.format(algorithm))
+
 
 def jsonify(cls=None):
   """
-  Simple decorator to ensure that a JSON response is sent.
+  Simple decorator to ensure that a JSON response is sent. The response is
+  serialized with #fatartifacts.utils.serialize, unless a #json.JSONEncoder
+  subclass is specified with *cls*.
   """
 
+  def dumps(obj):
+    if cls is None:
+      return serialize.dumps(obj)
+    return json.dumps(obj, cls=cls)
+
   def decorator(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
       try:
         result = func(*args, **kwargs)
+        if isinstance(result, Response):
+          return result
         if isinstance(result, tuple):
           result, status = result
         else:
           status = 200
-        return Response(json.dumps(result, cls=cls), status=status, mimetype='text/json')
+        return Response(dumps(result), status=status, mimetype='text/json')
       except HTTPException as e:
-        return Response(json.dumps({
+        return Response(dumps({
           'message': str(e)
         }), status=e.code, mimetype='text/json')
       except Exception as e:
         current_app.logger.exception(e)
-        return Response(json.dumps({
+        return Response(dumps({
           'message': 'The server has encountered an internal server error.'
         }), status=500, mimetype='text/json')
     return wrapper
@@ -57,17 +137,6 @@ def jsonify(cls=None):
   return decorator
 
 
-class JsonEncoder(json.JSONEncoder):
-  """
-  Our custom JSON encoder that is capable of encoding datetime.
-  """
-
-  def default(self, o):
-    if isinstance(o, datetime.datetime):
-      return str(o)
-    return super().default(o)
-
-
 def close_input_stream(func):
   """
   A decorator that ensures that the `wsgi.input` stream is closed. This is
@@ -80,14 +149,18 @@ def close_input_stream(func):
     try:
       return func(*a, **kw)
     finally:
+      # Not every WSGI server's input stream has a close() method (eg.
+      # gunicorn's).
       fp = request.environ.get('wsgi.input')
-      if fp:
+      if fp and hasattr(fp, 'close'):
         fp.close()
   return wrapper
 
 
-def check_bool_header(header_name, default=False):
-  value = request.headers.get(header_name, None)
+def check_bool_header(header_name, default=False, headers=None):
+  if headers is None:
+    headers = request.headers
+  value = headers.get(header_name, None)
   if value is None:
     return default
   value = value.strip().lower()
@@ -96,85 +169,557 @@ def check_bool_header(header_name, default=False):
   return False
 
 
-def get_object_url(info: database.ObjectInfo, default=NotImplemented) -> str:
+def get_object_url(info: database.ObjectInfo, default=NotImplemented,
+                   read_url=None) -> str:
   """
   Returns the publicly accessible URL for the object. If the object already
   has a web URL as URI and the `web_urls_are_public` configuration option is
   enabled, that URL is returned as is. Otherwise, it will return the URL to
-  read the object's data using the #read() route.
+  read the object's data using the #read() route, or the URL returned by
+  *read_url* for the object's location if specified.
   """
 
   if info.has_web_uri() and config.web_urls_are_public:
     return info.uri
   if default is NotImplemented:
+    if read_url is not None:
+      return read_url(info.location)
     return url_for(__name__ + '.read', path=str(info.location))
   return default
 
 
-def get_location_as_json(loc):
-  def object_to_json(x):
-    return {
-      'location': str(x.location),
-      'metadata': x.metadata,
-      'dateCreated': x.date_created,
-      'dateUpdated': x.date_updated,
-      'filename': x.filename,
-      'url': get_object_url(x),
-      'mime': x.mime
-    }
-  def location_to_json(x):
-    return {
-      'location': str(x.location),
-      'metadata': x.metadata,
-      'dateCreated': x.date_created,
-      'dateUpdated': x.date_updated
-    }
+def encode_cursor(name: str) -> str:
+  """
+  Encodes the name of the last child of a listing page into an opaque
+  cursor string that can be passed to the next request.
+  """
+
+  return base64.urlsafe_b64encode(name.encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> str:
+  """
+  Decodes a cursor created with #encode_cursor(). Raises a #ValueError if
+  the *cursor* is invalid.
+  """
+
+  try:
+    return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8')
+  except (binascii.Error, UnicodeError) as exc:
+    raise ValueError('invalid cursor') from exc
+
+
+def parse_listing_args(args):
+  """
+  Parses the filter and pagination query parameters for a location listing
+  from the *args* mapping. Returns a tuple of (filter, limit, after) where
+  the #database.Filter may be #None. Raises a #ValueError with a message for
+  the client if any of the parameters are invalid.
+  """
+
+  filter = database.Filter(
+    startswith=args.get('startswith') or None,
+    endswith=args.get('endswith') or None,
+    contains=args.get('contains') or None,
+    has_object=args.get('hasObject') or None)
+  if not any(filter):
+    filter = None
+
+  limit = args.get('limit')
+  if limit is not None:
+    try:
+      limit = int(limit)
+      if limit <= 0:
+        raise ValueError
+    except ValueError:
+      raise ValueError('Invalid limit parameter.')
+
+  after = args.get('cursor')
+  if after is not None:
+    try:
+      after = decode_cursor(after)
+    except ValueError:
+      raise ValueError('Invalid cursor parameter.')
+
+  return filter, limit, after
+
+
+def get_listing_args():
+  """
+  Like #parse_listing_args() for the current request. Aborts with 400 on
+  invalid parameters.
+  """
+
+  try:
+    return parse_listing_args(request.args)
+  except ValueError as exc:
+    abort(400, str(exc))
+
+
+def get_object_etag(info: database.ObjectInfo) -> str:
+  """
+  Returns the (unquoted) entity tag for an object's file. This is the
+  object's digest if it is known, thus mirrors can compare it with the
+  digest of their copy. Otherwise it is derived from the object record,
+  which changes whenever the object is uploaded again.
+  """
+
+  if info.digest:
+    return info.digest
+  date_updated = info.date_updated.isoformat() if info.date_updated else ''
+  key = '\0'.join([str(info.location), info.uri, date_updated])
+  return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+
+# Names of the hashlib algorithms in the `Digest` header (RFC 3230).
+DIGEST_HEADER_ALGORITHMS = {'md5': 'MD5', 'sha1': 'SHA', 'sha256': 'SHA-256',
+                            'sha512': 'SHA-512'}
+
+
+def get_digest_header(digest: Optional[str]) -> Optional[str]:
+  """
+  Returns the value of the `Digest` response header for an object *digest*
+  in the format `<algorithm>:<hexdigest>`, or #None if the algorithm can
+  not be expressed in the header.
+  """
+
+  algorithm, _, hexdigest = (digest or '').partition(':')
+  if algorithm not in DIGEST_HEADER_ALGORITHMS:
+    return None
+  value = base64.b64encode(binascii.unhexlify(hexdigest)).decode('ascii')
+  return DIGEST_HEADER_ALGORITHMS[algorithm] + '=' + value
+
+
+def parse_expected_digests(header: str) -> Dict[str, str]:
+  """
+  Parses an `X-Expected-Digest` header, a comma-separated list of digests in
+  the format `<algorithm>:<hexdigest>`. Returns a dictionary that maps the
+  hashlib algorithms to the normalized digests.
+
+  Raises:
+    ValueError: If the header is malformed or names an unknown algorithm.
+  """
+
+  result = {}
+  for item in header.split(','):
+    algorithm, sep, hexdigest = item.strip().partition(':')
+    algorithm, hexdigest = algorithm.lower(), hexdigest.strip().lower()
+    # The shake algorithms have no fixed digest length.
+    if algorithm not in hashlib.algorithms_available or algorithm.startswith('shake_'):
+      raise ValueError('unsupported digest algorithm: {!r}'.format(algorithm))
+    if not hexdigest:
+      raise ValueError('missing digest for {!r}'.format(algorithm))
+    result[algorithm] = algorithm + ':' + hexdigest
+  return result
+
+
+def parse_byte_ranges(header, size, max_ranges=16):
+  """
+  Parses the value of a HTTP `Range` *header* for a file of *size* bytes
+  into a list of (start, end) tuples where *end* is exclusive. Returns #None
+  if the header is missing, malformed or specifies more than *max_ranges*
+  ranges, in which case the full file should be served. An empty list is
+  returned if none of the ranges can be satisfied.
+  """
+
+  if not header:
+    return None
+  unit, _, value = header.partition('=')
+  if unit.strip().lower() != 'bytes':
+    return None
+  specs = [x.strip() for x in value.split(',') if x.strip()]
+  if not specs or len(specs) > max_ranges:
+    return None
+
+  ranges = []
+  for spec in specs:
+    first, sep, last = (x.strip() for x in spec.partition('-'))
+    if not sep or not (first or last):
+      return None
+    if (first and not first.isdigit()) or (last and not last.isdigit()):
+      return None
+    if not first:  # suffix-byte-range-spec, eg. "-500"
+      if int(last) == 0:
+        continue
+      start, end = max(size - int(last), 0), size
+    else:
+      start = int(first)
+      end = min(int(last) + 1, size) if last else size
+      if last and int(last) < start:
+        return None
+    if start < size:
+      ranges.append((start, end))
+  return ranges
+
+
+def get_offload_header(location, obj) -> Optional[Tuple[str, str]]:
+  """
+  Returns the (name, value) of the header that hands the download of the
+  object's file off to the frontend server, according to the
+  `download_offload` configuration option (see #check_config()). Returns
+  #None if downloads are not offloaded or if the storage does not keep the
+  file on the local filesystem.
+  """
+
+  offload = getattr(config, 'download_offload', None)
+  path = config.storage.get_local_path(location, obj.filename, obj.uri) if offload else None
+  if not path:
+    return None
+  if offload == 'x-sendfile':
+    return 'X-Sendfile', path
+  relpath = os.path.relpath(path, config.download_offload_root).replace(os.sep, '/')
+  return 'X-Accel-Redirect', \
+      config.download_offload_prefix.rstrip('/') + '/' + urllib.parse.quote(relpath)
+
+
+def multipart_byteranges(obj, location, ranges, size, boundary, chunk_size=64*1024):
+  """
+  Builds the body of a `multipart/byteranges` response for the list of
+  (start, end) *ranges*. Returns a tuple of a generator for the body and the
+  total content length. The ranges are read from the storage lazily.
+  """
+
+  parts = []
+  for start, end in ranges:
+    header = '--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'\
+        .format(boundary, obj.mime, start, end - 1, size).encode('latin1')
+    parts.append((header, start, end))
+  trailer = '\r\n--{}--\r\n'.format(boundary).encode('latin1')
+  length = sum(len(h) + (e - s) for h, s, e in parts) + \
+      2 * (len(parts) - 1) + len(trailer)
+
+  def generate():
+    for index, (header, start, end) in enumerate(parts):
+      if index != 0:
+        yield b'\r\n'
+      yield header
+      fp = config.storage.open_read_range(
+          location, obj.filename, obj.uri, start, end - start)
+      try:
+        while True:
+          data = fp.read(chunk_size)
+          if not data:
+            break
+          yield data
+      finally:
+        fp.close()
+    yield trailer
+
+  return generate(), length
+
+
+def object_to_json(x: database.ObjectInfo, read_url=None) -> dict:
+  return {
+    'location': str(x.location),
+    'metadata': x.metadata,
+    'dateCreated': x.date_created,
+    'dateUpdated': x.date_updated,
+    'filename': x.filename,
+    'url': get_object_url(x, read_url=read_url),
+    'mime': x.mime,
+    'digest': x.digest
+  }
+
+
+def location_to_json(x: database.LocationInfo) -> dict:
+  return {
+    'location': str(x.location),
+    'metadata': x.metadata,
+    'dateCreated': x.date_created,
+    'dateUpdated': x.date_updated
+  }
+
+
+def get_location_as_json(loc, filter=None, limit=None, after=None,
+                         user_id=NotImplemented, read_url=None):
+  """
+  Returns a tuple of `'object'` or `'location'` and the JSON representation
+  of the location *loc*, including its children. The children are filtered
+  with the permissions of *user_id* (which defaults to the current request's
+  user). *read_url* is passed to #get_object_url().
+  """
+
+  if user_id is NotImplemented:
+    user_id = request.user_id
 
   ac = config.accesscontrol
-  assert ac.get_permissions(loc, request.user_id).can_read  # already verified
+  assert ac.get_permissions(loc, user_id).can_read  # already verified
 
   is_object = len(loc) == config.database.num_levels()
   if is_object:
-    return 'object', object_to_json(config.database.get_object(loc))
+    return 'object', object_to_json(config.database.get_object(loc), read_url)
 
+  # Request one more element than the limit to find out whether there is
+  # a next page.
+  fetch_limit = None if limit is None else limit + 1
   result = location_to_json(config.database.get_location(loc))
   if len(loc) == config.database.num_levels() - 1:  # Children are objects
-    result['objects'] = [
-      object_to_json(x) for x in config.database.list_objects(loc)
-      if ac.get_permissions(x.location, request.user_id).can_read
-    ]
+    key, to_json = 'objects', functools.partial(object_to_json, read_url=read_url)
+    children = list(config.database.list_objects(loc, filter, fetch_limit, after))
   else:
-    result['children'] = [
-      location_to_json(x) for x in config.database.list_location(loc)
-      if ac.get_permissions(x.location, request.user_id).can_read
-    ]
+    key, to_json = 'children', location_to_json
+    children = list(config.database.list_location(loc, filter, fetch_limit, after))
+
+  next_cursor = None
+  if limit is not None and len(children) > limit:
+    del children[limit:]
+    next_cursor = encode_cursor(children[-1].location[-1])
+
+  # The cursor is determined before the access-control filter so that the
+  # next page continues after the last child seen by the database.
+  permissions = ac.get_permissions_many([x.location for x in children], user_id)
+  result[key] = [
+    to_json(x) for x, perm in zip(children, permissions)
+    if perm.can_read
+  ]
+  result['nextCursor'] = next_cursor
 
   return 'location', result
 
 
-@close_input_stream
-def _handle_put_object(loc):
+class LocationStream(NamedObject):
+  """
+  The result of #stream_location_as_json(). For an object, *kind* is
+  `'object'` and *data* is the object's JSON representation. For a location,
+  *data* is the location's JSON representation without its children, which
+  are yielded by the *children* generator instead. The `nextCursor` is added
+  to *data* when the generator is exhausted.
   """
-  Handles the upload of an object's file and metadata. The metadata must be
-  streamed before the file contents. The following headers are required:
 
-  * Content-Length: <length of the full payload, metadata + file>
-  * Content-Type: application/vnd.fatartifacts+putobject
-  * X-Metadata-Length: <the length in bytes of the JSON metadata>
-  * X-Metadata-Encoding: <optional, the encoding of the JSON metadata. Defaults to utf8>
-  * X-File-Name: <the name of the uploaded file>
-  * X-File-ContentType: <the MIME type of the uploaded file>
-  * X-Update-If-Exists: If this header is set and not empty, the object
-    will be updated if it already exists, otherwise a 409 error is returned.
+  kind: str
+  data: dict
+  key: Optional[str]
+  children: Optional[Iterator[dict]]
 
-  The request body has no special delimiters or encoding, but is simply split
-  into two blocks:
 
-        [       METADATA (X-Metadata-Length bytes)        ]
-        [ FILE (Content-Length - X-Metadata-Length bytes) ]
+def stream_location_as_json(loc, filter=None, limit=None, after=None,
+                            user_id=NotImplemented, read_url=None,
+                            batch_size=500) -> LocationStream:
+  """
+  Like #get_location_as_json(), but the children are only fetched from the
+  database when the returned generator is consumed, in pages of
+  *batch_size* children (using the same keyset pagination as the REST-Api).
+  Every page is queried in a separate query context, thus this function
+  must be called outside of a query context.
+  """
+
+  if user_id is NotImplemented:
+    user_id = request.user_id
+
+  db = config.database
+  ac = config.accesscontrol
+  assert ac.get_permissions(loc, user_id).can_read  # already verified
+
+  with db.query_context():
+    if len(loc) == db.num_levels():
+      return LocationStream('object', object_to_json(db.get_object(loc), read_url), None, None)
+    data = location_to_json(db.get_location(loc))
+
+  if len(loc) == db.num_levels() - 1:  # Children are objects
+    key, list_children = 'objects', db.list_objects
+    to_json = functools.partial(object_to_json, read_url=read_url)
+  else:
+    key, list_children, to_json = 'children', db.list_location, location_to_json
+
+  def generate():
+    remaining, last = limit, after
+    while remaining is None or remaining > 0:
+      count = batch_size if remaining is None else min(batch_size, remaining)
+      with db.query_context():
+        batch = list(list_children(loc, filter, count, last))
+      if batch:
+        last = batch[-1].location[-1]
+        permissions = ac.get_permissions_many([x.location for x in batch], user_id)
+        for x, perm in zip(batch, permissions):
+          if perm.can_read:
+            yield to_json(x)
+      if len(batch) < count:
+        data['nextCursor'] = None
+        return
+      if remaining is not None:
+        remaining -= len(batch)
+    # The limit is reached, check whether there is a next page.
+    with db.query_context():
+      has_more = any(True for x in list_children(loc, filter, 1, last))
+    data['nextCursor'] = encode_cursor(last) if has_more else None
+
+  return LocationStream('location', data, key, generate())
+
+
+def get_listing_format(accept) -> Optional[str]:
+  """
+  Returns the format in which a location listing should be streamed based
+  on the #werkzeug.datastructures.MIMEAccept *accept*. This is `'json'` if
+  the client explicitly accepts `application/json`, `'ndjson'` for
+  `application/x-ndjson`, or #None if the listing should be sent as a
+  single `text/json` document.
+  """
+
+  mimetype = accept.best_match(['text/json', 'application/json', 'application/x-ndjson'])
+  return {'application/json': 'json', 'application/x-ndjson': 'ndjson'}.get(mimetype)
+
+
+def encode_location_stream(stream: LocationStream, format: str,
+                           buffer_size=64*1024) -> Iterator[bytes]:
+  """
+  Encodes a #LocationStream into chunks of about *buffer_size* bytes. In the
+  `'json'` *format*, the result is the same document as the one returned by
+  the `GET /location` route. In the `'ndjson'` format, the first line holds
+  the `status` and the location (or object) without its children, followed
+  by one line per child and a last line that only holds the `nextCursor`.
+  """
+
+  dumps = serialize.dumps
+  buffer = []
+  size = 0
+
+  head = dumps({'status': 'Result', stream.kind: stream.data})
+  if format == 'ndjson':
+    head += b'\n'
+  elif stream.children is not None:
+    # Open the list of children inside the location's JSON object.
+    head = head[:-2] + ',"{}":['.format(stream.key).encode('utf8')
+  buffer.append(head)
+  size += len(head)
+
+  if stream.children is not None:
+    first = True
+    for child in stream.children:
+      if format == 'ndjson':
+        data = dumps(child) + b'\n'
+      elif first:
+        data = dumps(child)
+      else:
+        data = b',' + dumps(child)
+      first = False
+      buffer.append(data)
+      size += len(data)
+      if size >= buffer_size:
+        yield b''.join(buffer)
+        buffer, size = [], 0
+    cursor = dumps(stream.data['nextCursor'])
+    if format == 'ndjson':
+      buffer.append(b'{"nextCursor":' + cursor + b'}\n')
+    else:
+      buffer.append(b'],"nextCursor":' + cursor + b'}}')
+
+  yield b''.join(buffer)
+
+
+def delete_object_files(objects: List[database.ObjectInfo], logger) -> int:
+  """
+  Deletes the files of the *objects* that have been deleted from the
+  database from the storage. Errors are logged to *logger*. Returns the
+  number of files that could not be deleted (not counting files that did
+  not exist).
+  """
+
+  files = [(x.location, x.filename, x.uri) for x in objects]
+  errors = config.storage.delete_files(files)
+  failed = 0
+  for info, exc in zip(objects, errors):
+    if isinstance(exc, storage.FileDoesNotExist):
+      logger.warning('On deleting object %s: File does not exist (URI %s)',
+                     info.location, info.uri)
+    elif exc is not None:
+      logger.error('On deleting object %s', info.location, exc_info=exc)
+      failed += 1
+  return failed
+
+
+def prefers_async(headers) -> bool:
+  """
+  Returns #True if the request has a `Prefer: respond-async` header (see
+  RFC 7240).
+  """
+
+  prefs = headers.get('Prefer', '').split(',')
+  return any(x.split(';')[0].strip().lower() == 'respond-async' for x in prefs)
+
+
+class DeleteJob(object):
+  """
+  Deletes the files of the objects that have been deleted from the database
+  in a background thread, in batches of *batch_size* files. This is used
+  for `DELETE` requests with `Prefer: respond-async`, so that the request
+  does not time out while a large number of files is deleted. The progress
+  can be queried with `GET /jobs/<id>` from the process that runs the job.
   """
 
-  content_length = request.headers.get('Content-Length', '')
+  #: Recently started jobs by their ID.
+  jobs = TTLCache(1024, ttl=3600)
+
+  def __init__(self, location: database.Location, user_id: Optional[str],
+               objects: List[database.ObjectInfo], batch_size=1000):
+    self.id = str(uuid.uuid4())
+    self.location = location
+    self.user_id = user_id
+    self.total = len(objects)
+    self.processed = 0
+    self.failed = 0
+    self.done = False
+    self.batch_size = batch_size
+    self._objects = objects
+
+  @classmethod
+  def start(cls, location, user_id, objects, logger) -> 'DeleteJob':
+    job = cls(location, user_id, objects)
+    cls.jobs.put(job.id, job)
+    threading.Thread(target=job.run, args=(logger,), daemon=True).start()
+    return job
+
+  def run(self, logger):
+    try:
+      for i in range(0, self.total, self.batch_size):
+        batch = self._objects[i:i + self.batch_size]
+        self.failed += delete_object_files(batch, logger)
+        self.processed += len(batch)
+    except Exception:
+      logger.exception('Delete job %s failed.', self.id)
+    finally:
+      self.done = True
+      self._objects = None
+
+  def to_json(self) -> dict:
+    return {
+      'id': self.id,
+      'at': str(self.location),
+      'state': 'done' if self.done else 'running',
+      'total': self.total,
+      'processed': self.processed,
+      'failed': self.failed
+    }
+
+
+def get_delete_job(job_id: str, user_id: Optional[str]):
+  """
+  Returns the response for `GET /jobs/<job_id>`. Jobs are only visible to
+  the user that started them.
+  """
+
+  job = DeleteJob.jobs.get(job_id)
+  if job is None or job.user_id != user_id:
+    return {'status': 'JobDoesNotExist', 'id': job_id}, 404
+  return {'status': 'Result', 'job': job.to_json()}
+
+
+class PutObjectArgs(NamedObject):
+  content_length: int
+  metadata_length: int
+  metadata_encoding: str
+  file_name: str
+  file_content_type: str
+  update_if_exists: bool
+  expected_digests: Dict[str, str]
+
+
+def parse_put_object_headers(headers) -> PutObjectArgs:
+  """
+  Parses and validates the request *headers* of an object upload (see
+  #_handle_put_object()). Aborts with 400 if a header is missing or invalid.
+  """
+
+  content_length = headers.get('Content-Length', '')
   try:
     content_length = int(content_length)
     if content_length <= 0:
@@ -182,12 +727,12 @@ def _handle_put_object(loc):
   except ValueError:
     abort(400, 'Missing or invalid Content-Length header.')
 
-  content_type = request.headers.get('Content-Type', '')
+  content_type = headers.get('Content-Type', '')
   expect_type = 'application/vnd.fatartifacts+putobject'
   if content_type != expect_type:
     abort(400, 'Expected Content-Type: {}, got {}'.format(expect_type, content_type))
 
-  metadata_length = request.headers.get('X-Metadata-Length', '')
+  metadata_length = headers.get('X-Metadata-Length', '')
   try:
     metadata_length = int(metadata_length)
     if metadata_length <= 0 or metadata_length > content_length:
@@ -195,27 +740,373 @@ def _handle_put_object(loc):
   except ValueError:
     abort(400, 'Missing or invalid X-Metadata-Length header.')
 
-  file_name = request.headers.get('X-File-Name', '')
-  file_content_type = request.headers.get('X-File-ContentType', '')
+  file_name = headers.get('X-File-Name', '')
+  file_content_type = headers.get('X-File-ContentType', '')
   if not file_name or not file_content_type:
     abort(400, 'Missing X-File-Name or X-File-ContentType headers.')
 
-  metadata_encoding = request.headers.get('X-Metadata-Encoding', 'utf8')
+  expected_digests = {}
+  if headers.get('X-Expected-Digest'):
+    try:
+      expected_digests = parse_expected_digests(headers['X-Expected-Digest'])
+    except ValueError as exc:
+      abort(400, 'Invalid X-Expected-Digest header ({})'.format(exc))
+
+  return PutObjectArgs(
+    content_length=content_length,
+    metadata_length=metadata_length,
+    metadata_encoding=headers.get('X-Metadata-Encoding', 'utf8'),
+    file_name=file_name,
+    file_content_type=file_content_type,
+    update_if_exists=check_bool_header('X-Update-If-Exists', headers=headers),
+    expected_digests=expected_digests)
+
+
+def check_object_location(loc: database.Location, update_if_exists: bool):
+  """
+  Checks that an object can be created at *loc* before its file is
+  received. Must be called in a query context.
+
+  Raises:
+    database.LocationDoesNotExist: If the parent location does not exist.
+    database.LocationAlreadyExists: If the object exists and
+      *update_if_exists* is #False.
+  """
+
+  try:
+    config.database.get_object(loc)
+  except database.LocationDoesNotExist:
+    config.database.get_location(loc.parent)
+  else:
+    if not update_if_exists:
+      raise database.LocationAlreadyExists(loc)
+
+
+def open_hashing_stream(wstream: storage.WriteStream, args: PutObjectArgs) \
+    -> storage.HashingWriteStream:
+  """
+  Wraps the #storage.WriteStream of an object upload to compute the digest
+  that is stored with the object and the digests the client expects.
+  """
+
+  algorithms = set(args.expected_digests)
+  algorithm = getattr(config, 'digest_algorithm', Config.digest_algorithm)
+  if algorithm:
+    algorithms.add(algorithm)
+  return storage.HashingWriteStream(wstream, algorithms)
+
+
+def verify_object_digests(loc, wstream: storage.HashingWriteStream, args: PutObjectArgs):
+  """
+  Compares the digests of the uploaded file with the `X-Expected-Digest`
+  header. Returns the error response for the first mismatch, or #None.
+  """
+
+  for algorithm, expected in args.expected_digests.items():
+    digest = wstream.get_digest(algorithm)
+    if digest != expected:
+      return {'status': 'DigestMismatch', 'at': str(loc), 'expected': expected,
+              'digest': digest}, 400
+  return None
+
+
+def get_input_stream():
+  """
+  Returns the stream to read the body of the current request from. The
+  #werkzeug.wsgi.LimitedStream has no `readinto()`, thus the WSGI input is
+  returned if it supports it, and the caller must not read more than the
+  `Content-Length` from it.
+  """
+
+  fp = request.environ.get('wsgi.input')
+  if fp is not None and hasattr(fp, 'readinto'):
+    return fp
+  return request.stream
+
+
+def receive_file(wstream: storage.WriteStream, length: int) -> int:
+  """
+  Copies *length* bytes of the request body to the *wstream* with
+  #copy_stream() and logs the throughput. Raises #ClientDisconnected if the
+  body ends before.
+  """
+
+  buffer_size = getattr(config, 'upload_buffer_size', Config.upload_buffer_size)
+  start = time.perf_counter()
+  received = copy_stream(get_input_stream(), wstream, length, buffer_size)
+  if received < length:
+    raise ClientDisconnected()
+  log_throughput(current_app.logger, request.path, received, time.perf_counter() - start)
+  return received
+
+
+def log_throughput(logger, path: str, num_bytes: int, seconds: float):
+  logger.info('Received %d bytes at %s in %.3fs (%.1f MiB/s)', num_bytes, path,
+              seconds, num_bytes / max(seconds, 1e-6) / (1024 * 1024))
+
+
+def get_object_digest(wstream: storage.HashingWriteStream) -> Optional[str]:
+  algorithm = getattr(config, 'digest_algorithm', Config.digest_algorithm)
+  return wstream.get_digest(algorithm) if algorithm else None
+
+
+def decode_object_metadata(data: bytes, encoding: str) -> dict:
+  """
+  Decodes the JSON metadata of an object upload. Aborts with 400 if the
+  metadata can not be decoded or is not a JSON object.
+  """
+
   try:
-    metadata = request.stream.read(metadata_length).decode(metadata_encoding)
-  except UnicodeDecodeError as exc:
-    abort(400, 'Could not decode metadata as {}'.format(metadata_encoding))
+    # The serializer decodes UTF-8 itself.
+    if codecs.lookup(encoding).name != 'utf-8':
+      data = data.decode(encoding)
+  except (UnicodeDecodeError, LookupError) as exc:
+    abort(400, 'Could not decode metadata as {}'.format(encoding))
 
   try:
-    metadata = json.loads(metadata)
+    metadata = serialize.loads(data)
     if not isinstance(metadata, dict):
       raise ValueError('expected JSON object')
   except ValueError as e:
     abort(400, 'Could not decode metadata as JSON ({})'.format(e))
 
-  update_if_exists = check_bool_header('X-Update-If-Exists')
+  return metadata
+
+
+def create_upload(user_id, content_type: str, payload: bytes):
+  """
+  Creates a #storage.ChunkedUpload from the JSON *payload* of a
+  `POST /uploads` request and returns the response. The location of the
+  object is checked like for a regular upload, but the object is only
+  created in the database when the upload is comitted (see
+  #commit_upload()).
+  """
+
+  if content_type and content_type != 'application/json':
+    abort(400, 'Expected Content-Type: application/json, got {}'.format(content_type))
+  try:
+    args = serialize.loads(payload)
+    if not isinstance(args, dict):
+      raise ValueError('expected JSON object')
+  except ValueError as e:
+    abort(400, 'JSON payload could not be parsed ({})'.format(e))
+
+  loc = args.get('location')
+  filename = args.get('filename')
+  mime = args.get('mime')
+  size = args.get('size')
+  chunk_size = args.get('chunkSize', getattr(config, 'upload_chunk_size', Config.upload_chunk_size))
+  max_chunk_size = getattr(config, 'upload_max_chunk_size', Config.upload_max_chunk_size)
+  max_chunks = getattr(config, 'upload_max_chunks', Config.upload_max_chunks)
+  metadata = args.get('metadata', {})
+  update_if_exists = args.get('updateIfExists', False)
+  if not all(isinstance(x, str) and x for x in (loc, filename, mime)):
+    abort(400, 'Missing location, filename or mime.')
+  if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+    abort(400, 'Missing or invalid size.')
+  if not isinstance(chunk_size, int) or isinstance(chunk_size, bool) or \
+      not 0 < chunk_size <= max_chunk_size:
+    abort(400, 'Invalid chunkSize, the maximum is {}.'.format(max_chunk_size))
+  if -(-size // chunk_size) > max_chunks:
+    abort(400, 'The upload can have at most {} chunks, use a larger chunkSize.'.format(max_chunks))
+  if not isinstance(metadata, dict):
+    abort(400, 'Invalid metadata, expected JSON object.')
+
+  loc = database.Location(loc)
+  if len(loc) != config.database.num_levels() or not config.storage.supports_location(loc):
+    return {'status': 'BadRequest', 'at': str(loc),
+            'message': 'The location is not supported by the repository.'}, 400
+  perm = config.accesscontrol.get_permissions(loc, user_id)
+  if not perm.can_read or not perm.can_write:
+    return {'status': 'PermissionDenied', 'at': str(loc)}, 403
+
+  try:
+    with config.database.query_context():
+      try:
+        config.database.get_object(loc)
+      except database.LocationDoesNotExist:
+        config.database.get_location(loc.parent)
+      else:
+        if not update_if_exists:
+          raise database.LocationAlreadyExists(loc)
+  except database.LocationDoesNotExist as e:
+    return {'status': 'LocationDoesNotExist', 'at': str(e.location)}, 404
+  except database.LocationAlreadyExists as e:
+    return {'status': 'LocationAlreadyExists', 'at': str(e.location)}, 409
+
+  data = {'userId': user_id, 'mime': mime, 'metadata': metadata,
+          'updateIfExists': bool(update_if_exists)}
+  try:
+    upload = config.storage.create_chunked_upload(loc, filename, size, chunk_size, data)
+  except NotImplementedError:
+    abort(501, 'The repository does not support chunked uploads.')
+  except ValueError as e:
+    abort(400, str(e))
+  return {'status': 'Created', 'upload': upload_to_json(upload, set())}, 201
+
+
+def find_upload(upload_id: str, user_id: Optional[str]) -> Optional[storage.ChunkedUpload]:
+  """
+  Opens the #storage.ChunkedUpload with the specified ID. Returns #None if
+  it does not exist, or if it was created by another user.
+  """
+
+  try:
+    upload = config.storage.open_chunked_upload(upload_id)
+  except (storage.UploadDoesNotExist, NotImplementedError):
+    return None
+  if upload.data.get('userId') != user_id:
+    return None
+  return upload
+
+
+def upload_does_not_exist(upload_id: str):
+  return {'status': 'UploadDoesNotExist', 'id': upload_id}, 404
+
+
+def upload_to_json(upload: storage.ChunkedUpload, received: Set[int] = None) -> dict:
+  if received is None:
+    received = upload.get_chunks()
+  return {
+    'id': upload.id,
+    'at': str(upload.location),
+    'filename': upload.filename,
+    'mime': upload.data['mime'],
+    'size': upload.size,
+    'chunkSize': upload.chunk_size,
+    'numChunks': upload.num_chunks,
+    'received': sorted(received),
+    'missing': [x for x in range(upload.num_chunks) if x not in received]
+  }
+
+
+def open_upload_chunk(upload: storage.ChunkedUpload, index: int, headers) -> storage.WriteStream:
+  """
+  Opens the chunk *index* of the *upload* for a `PUT /uploads/<id>/<index>`
+  request. Aborts with 404 if the upload has no such chunk and with 400 if
+  the `Content-Length` in the request *headers* is not the chunk's length.
+  """
+
+  try:
+    length = upload.chunk_length(index)
+  except IndexError:
+    abort(404, 'The upload has no chunk {}.'.format(index))
+  if headers.get('Content-Length') != str(length):
+    abort(400, 'Expected Content-Length: {}'.format(length))
+  return upload.open_chunk(index)
+
+
+def commit_upload(upload: storage.ChunkedUpload, user_id: Optional[str]):
+  """
+  Commits the *upload* and creates the object in the database. If chunks
+  are missing, the response has status 409 and lists the `missing` chunks.
+  The digest of the object is computed while the upload is comitted.
+  """
+
+  loc = upload.location
+  perm = config.accesscontrol.get_permissions(loc, user_id)
+  if not perm.can_read or not perm.can_write:
+    return {'status': 'PermissionDenied', 'at': str(loc)}, 403
+  missing = upload.get_missing_chunks()
+  if missing:
+    return {'status': 'IncompleteUpload', 'at': str(loc), 'missing': missing}, 409
+
+  data = upload.data
+  algorithm = getattr(config, 'digest_algorithm', Config.digest_algorithm)
+  info = database.ObjectInfo(loc, metadata=data['metadata'], filename=upload.filename,
+      uri=upload.uri, mime=data['mime'])
+  try:
+    # The upload is only comitted if the object can be created, and the
+    # object is rolled back if the upload can not be comitted.
+    with config.database.query_context():
+      is_new_object = config.database.create_object(info, data['updateIfExists'])
+      digests = upload.commit([algorithm] if algorithm else [])
+      if digests.get(algorithm):
+        info.digest = digests[algorithm]
+        config.database.create_object(info, update_if_exists=True)
+  except database.LocationDoesNotExist as e:
+    return {'status': 'LocationDoesNotExist', 'at': str(e.location)}, 404
+  except database.LocationAlreadyExists as e:
+    return {'status': 'LocationAlreadyExists', 'at': str(e.location)}, 409
+  except storage.IncompleteUpload:
+    return {'status': 'IncompleteUpload', 'at': str(loc),
+            'missing': upload.get_missing_chunks()}, 409
+  except storage.UploadDoesNotExist:
+    return upload_does_not_exist(upload.id)
+
+  status = 'Created' if is_new_object else 'Updated'
+  return {'status': status, 'at': str(loc), 'digest': info.digest}
+
+
+def issue_token(user_id, args, headers):
+  """
+  Issues a bearer token for *user_id* with the #TokenAuthorizer and returns
+  the JSON response. The lifetime of the token can be specified with the
+  `ttl` parameter in *args*. Tokens can not be issued to anonymous users or
+  to requests that are themselves authorized with a token.
+  """
+
+  if not isinstance(config.auth, TokenAuthorizer):
+    abort(404, 'The repository does not issue tokens.')
+  if user_id is None or config.auth.get_bearer_token(headers) is not None:
+    abort(403, 'Tokens can only be issued with the credentials of a user.')
+
+  ttl = args.get('ttl')
+  if ttl is not None:
+    try:
+      ttl = int(ttl)
+      if ttl <= 0:
+        raise ValueError
+    except ValueError:
+      abort(400, 'Invalid ttl parameter.')
+
+  token, expires = config.auth.issue_token(user_id, ttl)
+  return {'status': 'Created', 'token': token,
+          'expires': datetime.datetime.utcfromtimestamp(expires)}
+
+
+@close_input_stream
+def _handle_put_object(loc):
+  """
+  Handles the upload of an object's file and metadata. The metadata must be
+  streamed before the file contents. The following headers are required:
+
+  * Content-Length: <length of the full payload, metadata + file>
+  * Content-Type: application/vnd.fatartifacts+putobject
+  * X-Metadata-Length: <the length in bytes of the JSON metadata>
+  * X-Metadata-Encoding: <optional, the encoding of the JSON metadata. Defaults to utf8>
+  * X-File-Name: <the name of the uploaded file>
+  * X-File-ContentType: <the MIME type of the uploaded file>
+  * X-Update-If-Exists: If this header is set and not empty, the object
+    will be updated if it already exists, otherwise a 409 error is returned.
+  * X-Expected-Digest: <optional, comma-separated `<algorithm>:<hexdigest>`
+    digests of the file. The upload fails with 400 if one does not match.>
+
+  The file is hashed while it is received, and the object is only created
+  in the database after the upload is complete and verified.
+
+  The request body has no special delimiters or encoding, but is simply split
+  into two blocks:
+
+        [       METADATA (X-Metadata-Length bytes)        ]
+        [ FILE (Content-Length - X-Metadata-Length bytes) ]
+  """
+
+  args = parse_put_object_headers(request.headers)
+  metadata = decode_object_metadata(
+    request.stream.read(args.metadata_length), args.metadata_encoding)
+  file_name, content_length = args.file_name, args.content_length
+  file_content_type, update_if_exists = args.file_content_type, args.update_if_exists
   # XXX Limit artifact upload size?
 
+  try:
+    with config.database.query_context():
+      check_object_location(loc, update_if_exists)
+  except database.LocationDoesNotExist as e:
+    return {'status': 'LocationDoesNotExist', 'at': str(e.location)}, 404
+  except database.LocationAlreadyExists as e:
+    return {'status': 'LocationAlreadyExists', 'at': str(e.location)}, 409
+
   # Open the write stream in the storage.
   try:
     wstream, uri = config.storage.open_write_file(loc, file_name, content_length)
@@ -223,28 +1114,128 @@ def _handle_put_object(loc):
     current_app.logger.exception(e)
     abort(500)
 
-  with wstream, config.database.query_context():
-    # Create an entry in the database.
-    info = database.ObjectInfo(loc, metadata=metadata, filename=file_name,
-        uri=uri, mime=file_content_type)
-    try:
-      is_new_object = config.database.create_object(info, update_if_exists)
-    except database.LocationDoesNotExist as e:
-      wstream.abort()
-      return {'status': 'LocationDoesNotExist', 'at': str(e.location)}, 404
-    except database.LocationAlreadyExists as e:
-      wstream.abort()
-      return {'status': 'LocationAlreadyExists', 'at': str(e.location)}, 409
+  # Upload the data to the write stream.
+  wstream = open_hashing_stream(wstream, args)
+  try:
+    receive_file(wstream, content_length - args.metadata_length)
+  except storage.WriteOverflow as exc:
+    wstream.abort()
+    return {'status': 'BadRequest', 'at': str(loc),
+            'message': 'WriteOverflow -- received more data than specified in the request'}, 400
+  except BaseException:
+    wstream.abort()
+    raise
+  mismatch = verify_object_digests(loc, wstream, args)
+  if mismatch:
+    wstream.abort()
+    return mismatch
 
-    # Upload the data to the write stream.
-    try:
-      shutil.copyfileobj(request.stream, wstream)
-    except storage.WriteOverflow as exc:
-      return {'status': 'BadRequest', 'at': str(loc),
-              'message': 'WriteOverflow -- received more data than specified in the request'}, 400
+  # Create an entry in the database, the file is only comitted with it.
+  info = database.ObjectInfo(loc, metadata=metadata, filename=file_name,
+      uri=uri, mime=file_content_type, digest=get_object_digest(wstream))
+  try:
+    with wstream, config.database.query_context():
+      is_new_object = config.database.create_object(info, update_if_exists)
+  except database.LocationDoesNotExist as e:
+    return {'status': 'LocationDoesNotExist', 'at': str(e.location)}, 404
+  except database.LocationAlreadyExists as e:
+    return {'status': 'LocationAlreadyExists', 'at': str(e.location)}, 409
 
   status = 'Created' if is_new_object else 'Updated'
-  return {'status': status, 'at': str(loc)}
+  return {'status': status, 'at': str(loc), 'digest': info.digest}
+
+
+@close_input_stream
+def _handle_put_chunk(upload, index):
+  """
+  Handles the upload of a chunk of a #storage.ChunkedUpload. The
+  `Content-Length` must be the length of the chunk.
+  """
+
+  try:
+    wstream = open_upload_chunk(upload, index, request.headers)
+    with wstream:
+      receive_file(wstream, upload.chunk_length(index))
+  except storage.UploadDoesNotExist:
+    return upload_does_not_exist(upload.id)
+  except (storage.WriteOverflow, storage.IncompleteUpload) as exc:
+    return {'status': 'BadRequest', 'upload': upload.id, 'chunk': index,
+            'message': 'The chunk is incomplete ({})'.format(exc)}, 400
+  return {'status': 'Received', 'upload': upload.id, 'chunk': index}
+
+
+def get_http_metrics() -> Optional[metrics.HttpMetrics]:
+  registry = getattr(config, 'metrics', None)
+  return metrics.get_http_metrics(registry) if registry is not None else None
+
+
+def get_route_name(endpoint: Optional[str]) -> str:
+  # The view function's name, the same as the ASGI application's route.
+  return endpoint.rpartition('.')[2] if endpoint else ''
+
+
+def count_sent_bytes(iterable, sent: List[int]):
+  """
+  Passes through the chunks of a streamed response body, adding up their
+  length in `sent[0]`.
+  """
+
+  try:
+    for data in iterable:
+      sent[0] += len(data)
+      yield data
+  finally:
+    close = getattr(iterable, 'close', None)
+    if close is not None:
+      close()
+
+
+@app.before_request
+def _start_request_metrics():
+  http_metrics = get_http_metrics()
+  if http_metrics is not None:
+    http_metrics.in_flight.inc()
+    g.metrics_start = time.perf_counter()
+
+
+@app.after_request
+def _finish_request_metrics(response):
+  """
+  Records the request in the #metrics.HttpMetrics. Responses of unknown
+  length (ie. streamed listings) are recorded when they have been sent,
+  all others when they are passed to the WSGI server.
+  """
+
+  start = g.pop('metrics_start', None)
+  if start is None:
+    return response
+  http_metrics = get_http_metrics()
+  req = request._get_current_object()
+  args = (get_route_name(req.endpoint), req.method, response.status_code)
+  received = req.content_length or 0
+  content_length = response.content_length
+
+  if content_length is None and not response.direct_passthrough:
+    sent = [0]
+    def finish():
+      http_metrics.finish(*args, time.perf_counter() - start, received, sent[0])
+    response.response = count_sent_bytes(response.response, sent)
+    response.call_on_close(finish)
+  else:
+    sent = 0 if req.method == 'HEAD' else content_length or 0
+    http_metrics.finish(*args, time.perf_counter() - start, received, sent)
+  return response
+
+
+@app.route('/metrics', endpoint='metrics')
+@check_auth(config)
+def expose_metrics():
+  registry = getattr(config, 'metrics', None)
+  if registry is None:
+    abort(404)
+  if not config.accesscontrol.get_permissions(database.Location(''), request.user_id).can_read:
+    abort(403)
+  return Response(registry.expose(), content_type=metrics.CONTENT_TYPE)
 
 
 @app.route('/info', methods=['GET'])
@@ -259,9 +1250,16 @@ def info():
   }
 
 
+@app.route('/token', methods=['POST'])
+@jsonify()
+@check_auth(config)
+def token():
+  return issue_token(request.user_id, request.args, request.headers)
+
+
 @app.route('/location', methods=['GET'], strict_slashes=False)
 @app.route('/location/<path:path>', methods=['GET', 'PUT', 'DELETE'])
-@jsonify(cls=JsonEncoder)
+@jsonify()
 @check_auth(config)
 def location(path=''):
   ac = config.accesscontrol
@@ -296,16 +1294,11 @@ def location(path=''):
       return {'status': 'LocationHasChildren', 'at': str(e.location)}, 409
     except database.LocationDoesNotExist as e:
       return {'status': 'LocationDoesNotExist', 'at': str(e.location)}, 404
-    # Delete the storage for all deleted objects.
-    for info in deleted_objects:
-      try:
-        config.storage.delete_file(info.location, info.filename, info.uri)
-      except storage.FileDoesNotExist as e:
-        # XXX log to proper logging facility
-        print('[warning] On deleting object {}: File does not exist (URI {})'
-            .format(info.location, info.uri))
-      except Exception as e:
-        current_app.logger.exception(e)
+    if prefers_async(request.headers):
+      job = DeleteJob.start(loc, request.user_id, deleted_objects,
+                            current_app._get_current_object().logger)
+      return {'status': 'Accepted', 'at': str(loc), 'job': job.to_json()}, 202
+    delete_object_files(deleted_objects, current_app.logger)
     return {'status': 'Deleted', 'at': str(loc)}
 
   if request.method == 'PUT':
@@ -319,7 +1312,7 @@ def location(path=''):
               'message': 'Expected Content-Type: application/json, got {}'.format(content_type)}, 400
     if content_type:
       try:
-        metadata = json.load(request.stream)
+        metadata = serialize.loads(request.stream.read())
         if not isinstance(metadata, dict):
           raise ValueError('expected JSON object')
       except ValueError as e:
@@ -342,9 +1335,22 @@ def location(path=''):
   if request.method == 'GET':
     # XXX Return object information if this is an object location
     result = {'status': 'Result'}
+    filter, limit, after = get_listing_args()
+    format = get_listing_format(request.accept_mimetypes)
+    if format:
+      try:
+        stream = stream_location_as_json(loc, filter, limit, after)
+      except database.LocationDoesNotExist as e:
+        return {'status': 'LocationDoesNotExist'}, 404
+      except database.InvalidLocationQuery as e:
+        return {'status': 'BadRequest', 'at': str(e.location),
+                'message': 'The location is not supported by the repository.'}, 400
+      mimetype = 'application/x-ndjson' if format == 'ndjson' else 'application/json'
+      return Response(stream_with_context(encode_location_stream(stream, format)),
+                      mimetype=mimetype)
     try:
       with config.database.query_context():
-        key, data = get_location_as_json(loc)
+        key, data = get_location_as_json(loc, filter, limit, after)
       result[key] = data
     except database.LocationDoesNotExist as e:
       return {'status': 'LocationDoesNotExist'}, 404
@@ -354,6 +1360,49 @@ def location(path=''):
     return result
 
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+@jsonify()
+@check_auth(config)
+def job(job_id):
+  return get_delete_job(job_id, request.user_id)
+
+
+@app.route('/uploads', methods=['POST'])
+@jsonify()
+@check_auth(config)
+def uploads():
+  return create_upload(request.user_id, request.headers.get('Content-Type', ''),
+                       request.get_data())
+
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'POST', 'DELETE'])
+@jsonify()
+@check_auth(config)
+def upload(upload_id):
+  upload = find_upload(upload_id, request.user_id)
+  if upload is None:
+    return upload_does_not_exist(upload_id)
+  if request.method == 'POST':
+    return commit_upload(upload, request.user_id)
+  if request.method == 'DELETE':
+    upload.abort()
+    return {'status': 'Deleted', 'id': upload_id}
+  try:
+    return {'status': 'Result', 'upload': upload_to_json(upload)}
+  except storage.UploadDoesNotExist:
+    return upload_does_not_exist(upload_id)
+
+
+@app.route('/uploads/<upload_id>/<int:index>', methods=['PUT'])
+@jsonify()
+@check_auth(config)
+def upload_chunk(upload_id, index):
+  upload = find_upload(upload_id, request.user_id)
+  if upload is None:
+    return upload_does_not_exist(upload_id)
+  return _handle_put_chunk(upload, index)
+
+
 @app.route('/read/<path:path>')
 @check_auth(config)
 def read(path):
@@ -371,11 +1420,66 @@ def read(path):
   if url is not None:
     return redirect(url)
 
-  # XXX Support HTTP Range header?
+  etag = get_object_etag(obj)
+  headers = {'Accept-Ranges': 'bytes', 'ETag': werkzeug.http.quote_etag(etag)}
+  digest_header = get_digest_header(obj.digest)
+  if digest_header:
+    headers['Digest'] = digest_header
+  if obj.date_updated:
+    headers['Last-Modified'] = werkzeug.http.http_date(obj.date_updated)
+  if not werkzeug.http.is_resource_modified(request.environ, etag,
+      last_modified=obj.date_updated):
+    return Response(status=304, headers=headers)
+
   try:
-    fp, size = config.storage.open_read_file(location, obj.filename, obj.uri)
+    size = config.storage.get_file_size(location, obj.filename, obj.uri)
   except storage.FileDoesNotExist:
     abort(404)
-  response = send_file(fp, mimetype=obj.mime, as_attachment=True, attachment_filename=obj.filename)
-  response.headers.add('Content-Length', str(size))
+
+  # The Range header must be ignored if the If-Range condition doesn't match.
+  ranges = None
+  if_range = request.headers.get('If-Range')
+  if if_range is None or if_range.strip() in (headers['ETag'], headers.get('Last-Modified')):
+    ranges = parse_byte_ranges(request.headers.get('Range'), size)
+  if ranges == []:
+    headers['Content-Range'] = 'bytes */{}'.format(size)
+    return Response(status=416, headers=headers)
+
+  response = Response(mimetype=obj.mime, headers=headers, direct_passthrough=True)
+  response.headers.add('Content-Disposition', 'attachment', filename=obj.filename)
+  response.cache_control.public = True
+  response.cache_control.max_age = current_app.get_send_file_max_age(obj.filename)
+
+  # The frontend server handles Range requests itself.
+  offload_header = get_offload_header(location, obj)
+  if offload_header:
+    response.headers[offload_header[0]] = offload_header[1]
+    return response
+
+  # Note: wrap_file() uses the WSGI server's file wrapper, which can send
+  # real files with sendfile() (eg. gunicorn) without copying the data
+  # through Python.
+  try:
+    if not ranges:
+      fp, size = config.storage.open_read_file(location, obj.filename, obj.uri)
+      response.response = werkzeug.wsgi.wrap_file(request.environ, fp)
+      response.content_length = size
+    elif len(ranges) == 1:
+      start, end = ranges[0]
+      fp = config.storage.open_read_range(
+          location, obj.filename, obj.uri, start, end - start)
+      response.status_code = 206
+      response.response = werkzeug.wsgi.wrap_file(request.environ, fp)
+      response.content_length = end - start
+      response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end - 1, size)
+    else:
+      boundary = uuid.uuid4().hex
+      body, length = multipart_byteranges(obj, location, ranges, size, boundary)
+      response.status_code = 206
+      response.response = body
+      response.content_length = length
+      response.headers['Content-Type'] = 'multipart/byteranges; boundary=' + boundary
+  except storage.FileDoesNotExist:
+    abort(404)
+
   return response
@@ -14,6 +14,12 @@ auth = HardcodedAuthorizer({
   'root': 'sha1:' + hashlib.sha1('alpine'.encode('utf8')).hexdigest()
 })
 
+# Issue signed bearer tokens via POST /token, so that clients that send many
+# requests do not need their password verified on every request. Requests
+# without a token are authorized by the HardcodedAuthorizer.
+#from fatartifacts.web.auth import TokenAuthorizer
+#auth = TokenAuthorizer(os.environ['FATARTIFACTS_TOKEN_SECRET'], fallback=auth)
+
 # Artifact access-control layer. Gives full permissions only to group IDs
 # that are prefixed with the current user ID.
 accesscontrol = UserSpaceAccessControl(isolate=False)
@@ -22,9 +28,22 @@ accesscontrol = UserSpaceAccessControl(isolate=False)
 database = PonyDatabase(num_levels=4)
 database.connect('sqlite', os.path.join(storage_dir, 'db.sqlite'), create_db=True)
 
+# Cache location and object lookups (eg. for clients that poll for builds).
+#from fatartifacts.database.cache import CachingDatabase
+#database = CachingDatabase(database, maxsize=4096, ttl=60, negative_ttl=5)
+
+# Keep the caches of all server processes coherent.
+#from fatartifacts.database.invalidation import SqliteInvalidationBus
+#bus = SqliteInvalidationBus(os.path.join(storage_dir, 'invalidations.sqlite'))
+#database = CachingDatabase(database, ttl=3600, bus=bus)
+
 # Artifact storage layer.
 storage = FsStorage(storage_dir)
 
+# Deduplicate identical files (eg. the same artifact uploaded under many tags).
+#from fatartifacts.storage.cas import ContentAddressedStorage
+#storage = ContentAddressedStorage(storage, os.path.join(storage_dir, 'cas.sqlite'))
+
 #from fatartifacts.storage.azureblob import AzureBlobStorage
 #storage = AzureBlobStorage.with_block_blob_service(
 #  container = 'artifacts',
@@ -32,12 +51,49 @@ storage = FsStorage(storage_dir)
 #  account_key = 'rs41bCH1B1jHrsIQ122X4t+fVq9BvJ9zXzlDEy58EY/PKZKef4ew0WeA8PDoQDnRW5ZQSKgIKaaSISyvxZ1k7g=='
 #)
 
+# Collect request, database and storage timings and expose them in the
+# Prometheus text format at GET /metrics (readable by users that can read
+# the root location).
+#from fatartifacts.metrics import Registry, register_cache_metrics
+#from fatartifacts.database.instrumented import InstrumentedDatabase
+#from fatartifacts.storage.instrumented import InstrumentedStorage
+#metrics = Registry()
+#register_cache_metrics(metrics, database)  # if it is a CachingDatabase
+#database = InstrumentedDatabase(database, metrics)
+#storage = InstrumentedStorage(storage, metrics)
+
 # Set this to false if the Web URLs generated by the storage backend are not
 # accesible without authentication. The REST API will generate URLs to the
 # /read endpoint which will pipe the content of the storage to the user using
 # their artifact repository credentials.
 web_urls_are_public = True
 
+# Hand off downloads from the /read endpoint to the frontend server so that
+# files on the local filesystem never pass through Python. Set to
+# 'x-sendfile' (Apache mod_xsendfile, lighttpd) or 'x-accel-redirect'
+# (nginx). For nginx, download_offload_prefix must be an `internal` location
+# that serves the download_offload_root directory. If None, the files are
+# passed to the WSGI server's file wrapper (eg. gunicorn uses sendfile()).
+download_offload = None
+download_offload_root = storage_dir
+download_offload_prefix = '/_storage/'
+
+# Chunked uploads (POST /uploads): the default chunk size, the largest chunk
+# size a client can request and the maximum number of chunks of an upload.
+#upload_chunk_size = 8 * 1024 * 1024
+#upload_max_chunk_size = 256 * 1024 * 1024
+#upload_max_chunks = 10000
+
+# The size of the buffer that uploaded files are received in. With the ASGI
+# server, every buffer costs one call to the thread pool, so larger buffers
+# help on fast links. Throughput is logged per upload at the INFO level.
+#upload_buffer_size = 256 * 1024
+
+# The hashlib algorithm of the digests that are computed while objects are
+# uploaded, stored with the objects and sent in the ETag and Digest headers
+# of downloads. Set to None to disable recording digests.
+#digest_algorithm = 'sha256'
+
 # REST-Api prefix.
 rest_prefix = '/api'
 
@@ -7,7 +7,8 @@ setup(
   description = 'General-purpose artifact repository.',
   entry_points = {
     'console_scripts': [
-      'fatartifacts-rest-cli=fatartifacts.web.cli:main_and_exit'
+      'fatartifacts-rest-cli=fatartifacts.web.cli:main_and_exit',
+      'fatartifacts-gc=fatartifacts.gc:main_and_exit'
     ]
   }
 )
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import sqlite3
+
+import pytest
+
+from fatartifacts.database.base import Location
+from fatartifacts.storage.base import HashingWriteStream
+from fatartifacts.storage.cas import ContentAddressedStorage
+from fatartifacts.storage.fs import FsStorage
+
+
+@pytest.fixture
+def storage(tmp_path):
+  return ContentAddressedStorage(FsStorage(str(tmp_path / 'files')), str(tmp_path / 'cas.sqlite'))
+
+
+def open_write(storage, name, data):
+  stream, uri = storage.open_write_file(Location('a:1:' + name), 'f.bin', len(data))
+  stream.write(data)
+  return stream, uri
+
+
+def get_blobs(storage):
+  db = sqlite3.connect(storage.index_path)
+  try:
+    return db.execute('SELECT uri, refs FROM blobs').fetchall()
+  finally:
+    db.close()
+
+
+def read(storage, name, uri):
+  fp, size = storage.open_read_file(Location('a:1:' + name), 'f.bin', uri)
+  with fp:
+    return fp.read()
+
+
+def test_deduplicates_identical_files(storage):
+  uris = []
+  for name in ['x', 'y']:
+    stream, uri = open_write(storage, name, b'data')
+    stream.close()
+    uris.append(uri)
+  (blob_uri, refs), = get_blobs(storage)
+  assert refs == 2
+  assert read(storage, 'y', uris[1]) == b'data'
+
+  storage.delete_file(Location('a:1:x'), 'f.bin', uris[0])
+  assert get_blobs(storage) == [(blob_uri, 1)]
+  storage.delete_file(Location('a:1:y'), 'f.bin', uris[1])
+  assert get_blobs(storage) == []
+  assert not os.path.exists(blob_uri[7:])
+
+
+def test_concurrent_upload_of_same_content(storage):
+  # The second upload is comitted while the first one closes its backend
+  # stream, the first upload's blob must be discarded.
+  first, first_uri = open_write(storage, 'x', b'data')
+  second, second_uri = open_write(storage, 'y', b'data')
+  backend_close = first._stream.close
+  def close():
+    backend_close()
+    second.close()
+  first._stream.close = close
+  first.close()
+
+  (blob_uri, refs), = get_blobs(storage)
+  assert refs == 2
+  assert read(storage, 'x', first_uri) == b'data'
+  assert read(storage, 'y', second_uri) == b'data'
+  blobs = [f for _, _, files in os.walk(storage.backend.directory) for f in files]
+  assert len(blobs) == 1
+
+
+def test_hashing_stream_reuses_digest(storage):
+  stream, uri = storage.open_write_file(Location('a:1:x'), 'f.bin', 4)
+  hashing = HashingWriteStream(stream, ['sha256', 'md5'])
+  assert hashing.hashers['sha256'] is stream.hashers['sha256']
+  hashing.write(b'data')
+  hashing.close()
+  assert hashing.get_digest('sha256') == 'sha256:' + hashlib.sha256(b'data').hexdigest()
+  assert hashing.get_digest('md5') == 'md5:' + hashlib.md5(b'data').hexdigest()
+  assert storage.get_digest(Location('a:1:x'), 'f.bin', uri) == hashing.get_digest('sha256')
+
+
+def test_update_with_other_filename_releases_blob(storage):
+  location = Location('a:1:x')
+  uris = []
+  for filename, data in [('a.txt', b'first'), ('b.txt', b'second')]:
+    stream, uri = storage.open_write_file(location, filename, len(data))
+    stream.write(data)
+    stream.close()
+    uris.append(uri)
+  assert uris[0] == uris[1]
+  (blob_uri, refs), = get_blobs(storage)
+  assert refs == 1
+  assert read(storage, 'x', uris[1]) == b'second'
+
+  storage.delete_file(location, 'b.txt', uris[1])
+  assert get_blobs(storage) == []
+  assert not os.path.exists(blob_uri[7:])
@@ -0,0 +1,91 @@
+import os
+import time
+
+import pytest
+
+from fatartifacts.database.base import Location, LocationInfo, ObjectInfo
+from fatartifacts.database.ponyorm import PonyDatabase
+from fatartifacts.gc import GarbageCollector
+from fatartifacts.storage.fs import FsStorage
+
+
+@pytest.fixture
+def setup(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  os.mkdir('real')
+  os.symlink('real', 'link')
+  database = PonyDatabase(num_levels=3)
+  database.connect('sqlite', str(tmp_path / 'db.sqlite'), create_db=True)
+  with database.query_context():
+    database.create_location(LocationInfo(Location('a'), {}))
+    database.create_location(LocationInfo(Location('a:1'), {}))
+  storage = FsStorage(str(tmp_path / 'real'))
+  return database, storage
+
+
+def put(database, storage, name, uri=None):
+  """
+  Writes the file of the object *name* to the *storage* and creates the
+  object with the *uri*, which defaults to the storage's URI.
+  """
+
+  location = Location('a:1:' + name)
+  stream, storage_uri = storage.open_write_file(location, 'f.bin', 4)
+  stream.write(b'data')
+  stream.close()
+  path = storage_uri[7:]
+  old = time.time() - 7200
+  os.utime(path, (old, old))
+  with database.query_context():
+    database.create_object(ObjectInfo(location, {}, filename='f.bin',
+      mime='application/octet-stream', uri=uri or storage_uri))
+  return path
+
+
+def test_keeps_files_of_deviating_uris(setup):
+  database, storage = setup
+  paths = [
+    put(database, storage, 'exact'),
+    put(database, storage, 'relative', 'file://' + os.path.join('real', '0-a', '0-1', '0-relative-f.bin')),
+    put(database, storage, 'symlink', 'file://' + os.path.join(os.getcwd(), 'link', '0-a', '0-1', '0-symlink-f.bin')),
+  ]
+  orphan = put(database, storage, 'orphan')
+  with database.query_context():
+    database.delete_location(Location('a:1:orphan'), False)
+
+  stats = GarbageCollector(database, storage, rate=None).run()
+  assert (stats.scanned, stats.referenced, stats.orphans, stats.deleted) == (4, 3, 1, 1)
+  assert all(os.path.isfile(x) for x in paths)
+  assert not os.path.exists(orphan)
+
+
+def test_keeps_unreferenced_files_if_uri_is_unknown(setup):
+  database, storage = setup
+  path = put(database, storage, 'web', 'https://example.org/f.bin')
+  orphan = put(database, storage, 'orphan')
+  with database.query_context():
+    database.delete_location(Location('a:1:orphan'), False)
+
+  stats = GarbageCollector(database, storage, rate=None).run()
+  assert (stats.orphans, stats.deleted) == (2, 0)
+  assert os.path.isfile(path)
+  assert os.path.isfile(orphan)
+
+
+def test_keeps_chunked_uploads_until_upload_max_age(setup):
+  database, storage = setup
+  uploads = []
+  for age in [7200, 3 * 24 * 3600]:
+    upload = storage.create_chunked_upload(Location('a:1:u'), 'f.bin', 4, 4, {})
+    stream = upload.open_chunk(0)
+    stream.write(b'data')
+    stream.close()
+    old = time.time() - age
+    os.utime(upload.directory, (old, old))
+    os.utime(upload.data_path, (old, old))
+    uploads.append(upload.directory)
+
+  stats = GarbageCollector(database, storage, rate=None, upload_max_age=24 * 3600).run()
+  assert (stats.skipped, stats.uploads, stats.deleted) == (1, 1, 1)
+  assert os.path.isdir(uploads[0])
+  assert not os.path.exists(uploads[1])
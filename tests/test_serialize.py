@@ -0,0 +1,25 @@
+import pytest
+
+from fatartifacts.utils import serialize
+
+
+def get_backends():
+  backends = []
+  for cls in serialize.BACKENDS:
+    try:
+      backends.append(cls())
+    except ImportError:
+      pass
+  return backends
+
+
+@pytest.mark.parametrize('serializer', get_backends(), ids=lambda x: x.name)
+@pytest.mark.parametrize('data', [b'{"a":NaN}', b'[Infinity]', '{"a":[1,-Infinity]}'])
+def test_rejects_non_finite_constants(serializer, data):
+  with pytest.raises(ValueError):
+    serializer.loads(data)
+
+
+@pytest.mark.parametrize('serializer', get_backends(), ids=lambda x: x.name)
+def test_decodes_constants_in_strings(serializer):
+  assert serializer.loads(b'{"NaN":"-Infinity"}') == {'NaN': '-Infinity'}